@@ -0,0 +1,129 @@
+"""
+LoRA adapters served on top of the single base model
+
+Adapters are loaded from local directories (peft format) into the base
+model on first use and kept in an LRU set of resident adapters. Every LoRA
+layer gets a forward pre-hook that passes peft's per-row `adapter_names`,
+so one forward pass can mix rows for different adapters (and the plain
+base model). The names for the current thread are set with `use()`.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+BASE_ADAPTER = "__base__"  # peft's name for "no adapter" in a mixed batch
+
+
+class AdapterManager:
+    """Loads, evicts and selects LoRA adapters on a shared base model"""
+
+    def __init__(self, model, adapter_paths: Dict[str, str], max_resident: int = 4):
+        from peft import PeftModel
+        from peft.tuners.lora import LoraLayer
+
+        self._peft_model_class = PeftModel
+        self._lora_layer_class = LoraLayer
+        self.model = model
+        self.adapter_paths = dict(adapter_paths)
+        self.max_resident = max(1, max_resident)
+        self.peft_model = None
+
+        self._resident: "OrderedDict[str, int]" = OrderedDict()  # name -> requests using it, LRU first
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._hooked = set()
+        self.loads = 0
+        self.evictions = 0
+
+    def names(self) -> List[str]:
+        """Configured adapter names"""
+        return list(self.adapter_paths)
+
+    def acquire(self, name: Optional[str]):
+        """Make an adapter resident and mark it in use until release()"""
+        if name is None:
+            return
+        if name not in self.adapter_paths:
+            raise ValueError(f"Unknown adapter: {name}")
+        with self._lock:
+            if name not in self._resident:
+                self._evict_unused(self.max_resident - 1)
+                self._load(name)
+                self._resident[name] = 0
+            self._resident[name] += 1
+            self._resident.move_to_end(name)
+
+    def release(self, name: Optional[str]):
+        """Mark an adapter acquired with acquire() as no longer used by that request"""
+        if name is None:
+            return
+        with self._lock:
+            self._resident[name] -= 1
+
+    @contextmanager
+    def use(self, names: List[Optional[str]]):
+        """Run this thread's forward passes with one adapter per batch row (None = base model)"""
+        previous = getattr(self._local, "names", None)
+        self._local.names = [BASE_ADAPTER if name is None else name for name in names]
+        try:
+            yield
+        finally:
+            self._local.names = previous
+
+    @contextmanager
+    def activate(self, name: Optional[str]):
+        """acquire() + use() for a single-adapter generation"""
+        self.acquire(name)
+        try:
+            with self.use([name]):
+                yield
+        finally:
+            self.release(name)
+
+    def _load(self, name: str):
+        path = self.adapter_paths[name]
+        print(f"Loading LoRA adapter '{name}' from {path}")
+        if self.peft_model is None:
+            # Injects the LoRA layers into self.model in place; the wrapper only manages adapters
+            self.peft_model = self._peft_model_class.from_pretrained(
+                self.model, path, adapter_name=name, is_trainable=False)
+        else:
+            self.peft_model.load_adapter(path, adapter_name=name, is_trainable=False)
+        self.loads += 1
+
+        for module in self.model.modules():
+            if isinstance(module, self._lora_layer_class) and id(module) not in self._hooked:
+                module.register_forward_pre_hook(self._inject_adapter_names, with_kwargs=True)
+                self._hooked.add(id(module))
+
+    def _evict_unused(self, keep: int):
+        """Delete least recently used adapters that no request holds until at most `keep` remain"""
+        for name in [n for n, users in self._resident.items() if users == 0]:
+            if len(self._resident) <= keep:
+                break
+            print(f"Evicting LoRA adapter '{name}'")
+            self.peft_model.delete_adapter(name)
+            del self._resident[name]
+            self.evictions += 1
+
+    def _inject_adapter_names(self, module, args, kwargs):
+        x = args[0] if args else kwargs["x"]
+        names = getattr(self._local, "names", None)
+        if names is None:
+            names = [BASE_ADAPTER]
+        if len(names) == 1 and x.shape[0] != 1:
+            names = names * x.shape[0]
+        kwargs["adapter_names"] = names
+        return args, kwargs
+
+    def get_stats(self) -> Dict:
+        """Resident adapters (LRU first) with their in-flight request counts"""
+        with self._lock:
+            return {
+                "available": self.names(),
+                "resident": dict(self._resident),
+                "max_resident": self.max_resident,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
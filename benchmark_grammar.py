@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark the per-token overhead of grammar-constrained (JSON/regex) decoding
+
+Only the tokenizer is loaded: decode steps are simulated with random logits,
+so the numbers isolate the cost of masking and advancing the automaton.
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from config import MODEL_NAME, LOCAL_MODEL_PATH, DEVICE, TRUST_REMOTE_CODE
+from grammar import compile_constraint, token_vocabulary
+
+DEFAULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "email": {"type": "string"},
+        "tags": {"type": "array", "items": {"type": "string"}},
+        "active": {"type": "boolean"},
+    },
+}
+
+
+def simulate(constraint, vocab_size: int, max_steps: int, eos_token_id: int):
+    """Decode one sequence with random logits; returns per-step overhead in ms"""
+    processor = constraint.processor()
+    timings = []
+    for _ in range(max_steps):
+        logits = torch.randn(1, vocab_size, device=DEVICE)
+        start = time.perf_counter()
+        masked = processor.apply(logits)
+        token = int(torch.multinomial(torch.softmax(masked, dim=-1), 1))
+        processor.advance(0, token)
+        timings.append(1000 * (time.perf_counter() - start))
+        if token == eos_token_id:
+            break
+    return timings
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    return {
+        "tokens": len(timings),
+        "mean_ms": round(statistics.mean(timings), 4),
+        "p50_ms": round(ordered[len(ordered) // 2], 4),
+        "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark constrained decoding overhead")
+    parser.add_argument("--schema", type=str, default=None, help="Path to a JSON schema file")
+    parser.add_argument("--regex", type=str, default=None, help="Regex constraint (instead of a schema)")
+    parser.add_argument("--runs", type=int, default=5, help="Simulated generations (default: 5)")
+    parser.add_argument("--max-steps", type=int, default=256, help="Tokens per generation (default: 256)")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    model_path = LOCAL_MODEL_PATH if LOCAL_MODEL_PATH and os.path.exists(LOCAL_MODEL_PATH) else MODEL_NAME
+    print(f"Loading tokenizer: {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=TRUST_REMOTE_CODE)
+
+    schema = DEFAULT_SCHEMA
+    if args.schema:
+        with open(args.schema, "r", encoding="utf-8") as f:
+            schema = json.load(f)
+
+    start = time.perf_counter()
+    vocabulary = token_vocabulary(tokenizer)
+    vocab_seconds = time.perf_counter() - start
+
+    constraint = compile_constraint(tokenizer, json_schema=None if args.regex else schema, regex=args.regex)
+
+    # Baseline: the work an unconstrained step does on the same logits
+    baseline = []
+    for _ in range(args.max_steps):
+        logits = torch.randn(1, len(tokenizer), device=DEVICE)
+        start = time.perf_counter()
+        int(torch.multinomial(torch.softmax(logits, dim=-1), 1))
+        baseline.append(1000 * (time.perf_counter() - start))
+
+    cold = simulate(constraint, len(tokenizer), args.max_steps, tokenizer.eos_token_id)
+    warm = []
+    for _ in range(args.runs - 1):
+        warm.extend(simulate(constraint, len(tokenizer), args.max_steps, tokenizer.eos_token_id))
+
+    results = {
+        "tokenizer": model_path,
+        "device": DEVICE,
+        "vocabulary_tokens": len(vocabulary),
+        "vocabulary_seconds": round(vocab_seconds, 3),
+        "compile_seconds": round(constraint.compile_seconds, 3),
+        "unconstrained_sampling": summarize(baseline),
+        "constrained_first_run": summarize(cold),
+        "constrained_cached": summarize(warm) if warm else None,
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
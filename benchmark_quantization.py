@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Compare precision and quantization modes for a model
+
+Each mode (fp32, bf16, fp16, 8-bit, 4-bit) that this machine supports is
+loaded through ChatBot in its own subprocess, so load time and peak memory
+are not skewed by the previous mode. For each mode the script records load
+time, peak RSS (and CUDA memory), prefill and decode throughput, and
+perplexity on a bundled text sample, then writes a JSON report and a
+markdown table and names the cheapest mode within the quality bar.
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_TEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_data", "sample.txt")
+
+MODES = ["fp32", "bf16", "fp16", "8bit", "4bit"]
+
+
+def available_modes():
+    """Modes this machine can run, with the reason for each one it cannot"""
+    import torch
+
+    cuda = torch.cuda.is_available()
+    try:
+        import bitsandbytes  # noqa: F401
+        has_bnb = True
+    except ImportError:
+        has_bnb = False
+
+    skipped = {}
+    if not cuda:
+        skipped["fp16"] = "float16 needs CUDA (too slow on CPU)"
+    elif not torch.cuda.is_bf16_supported():
+        skipped["bf16"] = "GPU does not support bfloat16"
+    for mode in ("8bit", "4bit"):
+        if not has_bnb:
+            skipped[mode] = "bitsandbytes not installed"
+        elif not cuda:
+            skipped[mode] = "bitsandbytes quantization needs CUDA"
+    return [m for m in MODES if m not in skipped], skipped
+
+
+def run_mode(mode: str, model_path: str, text_path: str, prompt_tokens: int, decode_tokens: int) -> dict:
+    """Load one mode and measure it (runs inside the worker subprocess)"""
+    import torch
+
+    from chatbot import ChatBot
+    from config import DEVICE
+    from memory import PeakMemoryMonitor
+
+    dtypes = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+    monitor = PeakMemoryMonitor().start()
+
+    start = time.perf_counter()
+    chatbot = ChatBot(local_model_path=model_path, load_in_8bit=mode == "8bit", load_in_4bit=mode == "4bit",
+                      dtype=dtypes.get(mode))
+    load_seconds = time.perf_counter() - start
+
+    def sync():
+        if DEVICE == "cuda":
+            torch.cuda.synchronize()
+
+    with open(text_path, "r", encoding="utf-8") as f:
+        text_ids = chatbot.tokenizer(f.read(), return_tensors="pt")["input_ids"].to(DEVICE)
+
+    with torch.no_grad():
+        # Perplexity over the whole sample, fed in chunks with the KV cache
+        lm_head = chatbot.model.get_output_embeddings()
+        past = None
+        nll_sum = 0.0
+        scored = 0
+        for chunk_start in range(0, text_ids.shape[1] - 1, 256):
+            chunk = text_ids[:, chunk_start:chunk_start + 257]
+            outputs = chatbot.model.base_model(input_ids=chunk[:, :-1], past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
+            logits = lm_head(outputs.last_hidden_state).float()
+            nll_sum += torch.nn.functional.cross_entropy(logits[0], chunk[0, 1:], reduction="sum").item()
+            scored += chunk.shape[1] - 1
+        del past
+
+        # Prefill throughput (one warmup run first)
+        prompt = text_ids[:, :prompt_tokens]
+        mask = torch.ones_like(prompt)
+        chatbot._forward(prompt, mask)
+        sync()
+        runs = 3
+        start = time.perf_counter()
+        for _ in range(runs):
+            logits, past = chatbot._forward(prompt, mask)
+        sync()
+        prefill_seconds = (time.perf_counter() - start) / runs
+
+        # Decode throughput (greedy, from the prefilled prompt)
+        start = time.perf_counter()
+        for _ in range(decode_tokens):
+            token = logits.argmax(dim=-1, keepdim=True)
+            mask = torch.cat([mask, mask.new_ones((1, 1))], dim=1)
+            logits, past = chatbot._forward(token, mask, past)
+        sync()
+        decode_seconds = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "device": DEVICE,
+        "load_seconds": round(load_seconds, 2),
+        "perplexity": round(math.exp(nll_sum / scored), 3),
+        "prefill_tokens_per_s": round(prompt.shape[1] / prefill_seconds, 1),
+        "decode_tokens_per_s": round(decode_tokens / decode_seconds, 2),
+        **monitor.stop(),
+    }
+
+
+def run_worker(mode: str, args) -> dict:
+    """Run one mode in a fresh Python process; returns its result or an error"""
+    command = [sys.executable, os.path.abspath(__file__), "--worker", mode, "--text", args.text,
+               "--prompt-tokens", str(args.prompt_tokens), "--decode-tokens", str(args.decode_tokens)]
+    if args.model:
+        command += ["--model", args.model]
+    process = subprocess.run(command, capture_output=True, text=True)
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    error = (process.stderr.strip().splitlines() or [f"worker exited with code {process.returncode}"])[-1]
+    return {"mode": mode, "error": error}
+
+
+def memory_mb(result: dict) -> float:
+    """Memory used by a mode: CUDA peak on GPU, otherwise peak RSS"""
+    return result.get("peak_cuda_mb") or result["peak_rss_mb"]
+
+
+def markdown_table(results, recommended) -> str:
+    lines = [
+        "| Mode | Load (s) | Peak RSS (MB) | Peak CUDA (MB) | Prefill (tok/s) | Decode (tok/s) | Perplexity |",
+        "|---|---|---|---|---|---|---|",
+    ]
+    for r in results:
+        if "error" in r:
+            lines.append(f"| {r['mode']} | failed: {r['error']} | | | | | |")
+            continue
+        name = f"**{r['mode']}**" if r["mode"] == recommended else r["mode"]
+        lines.append(
+            f"| {name} | {r['load_seconds']} | {r['peak_rss_mb']} | {r['peak_cuda_mb'] or '-'} | "
+            f"{r['prefill_tokens_per_s']} | {r['decode_tokens_per_s']} | {r['perplexity']} |"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark precision/quantization modes")
+    parser.add_argument("--model", type=str, default=None, help="Local model path (default: LOCAL_MODEL_PATH)")
+    parser.add_argument("--modes", type=str, default=",".join(MODES), help="Comma-separated modes to try")
+    parser.add_argument("--text", type=str, default=DEFAULT_TEXT, help="Text sample for perplexity")
+    parser.add_argument("--prompt-tokens", type=int, default=512, help="Prompt length for prefill timing")
+    parser.add_argument("--decode-tokens", type=int, default=64, help="Tokens generated for decode timing")
+    parser.add_argument("--max-perplexity-increase", type=float, default=0.05,
+                        help="Quality bar relative to the most precise mode (default: 0.05 = +5%%)")
+    parser.add_argument("--output", type=str, default="quantization_benchmark",
+                        help="Output path prefix for the .json and .md reports")
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_mode(args.worker, args.model, args.text, args.prompt_tokens, args.decode_tokens)
+        print("RESULT " + json.dumps(result))
+        return
+
+    requested = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = [m for m in requested if m not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)} (choose from {', '.join(MODES)})")
+    requested.sort(key=MODES.index)  # Most precise first: it is the quality reference
+    available, skipped = available_modes()
+
+    results = []
+    for mode in requested:
+        if mode not in available:
+            print(f"Skipping {mode}: {skipped[mode]}")
+            continue
+        print(f"Benchmarking {mode}...")
+        results.append(run_worker(mode, args))
+        print(json.dumps(results[-1]))
+
+    # Cheapest (by memory) mode whose perplexity is within the bar of the most precise one
+    measured = [r for r in results if "error" not in r]
+    recommended = None
+    if measured:
+        reference = measured[0]
+        limit = reference["perplexity"] * (1 + args.max_perplexity_increase)
+        passing = [r for r in measured if r["perplexity"] <= limit]
+        recommended = min(passing, key=memory_mb)["mode"]
+
+    report = {
+        "model": args.model,
+        "text": os.path.basename(args.text),
+        "reference_mode": measured[0]["mode"] if measured else None,
+        "max_perplexity_increase": args.max_perplexity_increase,
+        "recommended": recommended,
+        "skipped": {m: skipped[m] for m in requested if m in skipped},
+        "results": results,
+    }
+    table = markdown_table(results, recommended)
+
+    with open(args.output + ".json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    with open(args.output + ".md", "w", encoding="utf-8") as f:
+        f.write(f"# Quantization benchmark\n\n{table}\n\n")
+        if recommended:
+            f.write(f"Recommended: **{recommended}** (lowest memory within "
+                    f"+{args.max_perplexity_increase:.0%} perplexity of {report['reference_mode']})\n")
+
+    print("\n" + table)
+    if recommended:
+        print(f"\nRecommended: {recommended}")
+    print(f"Reports written to {args.output}.json and {args.output}.md")
+
+
+if __name__ == "__main__":
+    main()
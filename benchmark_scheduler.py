@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Measure how a long prompt affects the inter-token latency of running streams
+
+A few short "background" streams are decoding when one long prompt arrives.
+The gaps between the background streams' tokens are recorded for each token
+budget; the largest budget prefills the long prompt in a single step, which
+is what generation without chunked prefill does.
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+
+import torch
+
+from chatbot import ChatBot
+from config import DEVICE, TEMPERATURE, TOP_P, SCHEDULER_MAX_SEQUENCES
+from scheduler import ChunkedPrefillScheduler
+
+DEFAULT_TEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_data", "sample.txt")
+
+
+def consume(request, timestamps):
+    """Record the arrival time of every event of a scheduled request"""
+    for _ in request:
+        timestamps.append(time.perf_counter())
+
+
+def run(chatbot: ChatBot, budget: int, short_ids: torch.Tensor, long_ids: torch.Tensor,
+        streams: int, new_tokens: int, warmup_tokens: int):
+    """Start the background streams, inject the long prompt, and collect token gaps"""
+    scheduler = ChunkedPrefillScheduler(chatbot, token_budget=budget, min_prefill_chunk=min(32, budget),
+                                        max_sequences=SCHEDULER_MAX_SEQUENCES)
+    try:
+        timestamps = [[] for _ in range(streams)]
+        threads = []
+        for i in range(streams):
+            request = scheduler.submit(short_ids, [{}], new_tokens, TEMPERATURE, TOP_P)
+            thread = threading.Thread(target=consume, args=(request, timestamps[i]))
+            thread.start()
+            threads.append(thread)
+
+        while min(len(t) for t in timestamps) < warmup_tokens and any(t.is_alive() for t in threads):
+            time.sleep(0.01)
+
+        injected = time.perf_counter()
+        long_choices = [{}]
+        long_request = scheduler.submit(long_ids, long_choices, 1, TEMPERATURE, TOP_P)
+        for _ in long_request:
+            pass
+        time_to_first_token = time.perf_counter() - injected
+
+        for thread in threads:
+            thread.join()
+        stats = scheduler.get_stats()
+    finally:
+        scheduler.stop()
+
+    gaps = [1000 * (b - a) for t in timestamps for a, b in zip(t, t[1:])]
+    during = [1000 * (b - a) for t in timestamps for a, b in zip(t, t[1:])
+              if b >= injected and a <= injected + time_to_first_token]
+    ordered = sorted(gaps)
+    return {
+        "token_budget": budget,
+        "background_tokens": sum(len(t) for t in timestamps),
+        "itl_ms_p50": round(statistics.median(gaps), 2) if gaps else None,
+        "itl_ms_p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2) if gaps else None,
+        "itl_ms_max_during_long_prefill": round(max(during), 2) if during else None,
+        "long_prompt_ttft_s": round(time_to_first_token, 3),
+        "steps": stats["steps"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chunked prefill against one-shot prefill")
+    parser.add_argument("--text", type=str, default=DEFAULT_TEXT, help="Text used to build the long prompt")
+    parser.add_argument("--long-prompt-tokens", type=int, default=4096, help="Length of the injected prompt")
+    parser.add_argument("--budgets", type=str, default="256,512,1024",
+                        help="Comma-separated per-step token budgets to compare")
+    parser.add_argument("--streams", type=int, default=4, help="Background streams decoding concurrently")
+    parser.add_argument("--new-tokens", type=int, default=128, help="Tokens generated per background stream")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    chatbot = ChatBot()
+
+    short_ids = chatbot._tokenize_messages([{"role": "user", "content": "Write a long story about the sea."}])
+    with open(args.text, "r", encoding="utf-8") as f:
+        text_ids = chatbot.tokenizer(f.read(), add_special_tokens=False)["input_ids"]
+    repeats = args.long_prompt_tokens // len(text_ids) + 1
+    long_ids = torch.tensor([(text_ids * repeats)[:args.long_prompt_tokens]], device=DEVICE)
+
+    # The last budget covers the whole prompt plus the decodes: one-shot prefill, as without chunking
+    unchunked = args.long_prompt_tokens + args.streams
+    budgets = [int(b) for b in args.budgets.split(",")] + [unchunked]
+    results = {"long_prompt_tokens": args.long_prompt_tokens, "streams": args.streams, "runs": []}
+    for budget in budgets:
+        label = "unchunked" if budget == unchunked else f"budget {budget}"
+        print(f"Running {label}...")
+        result = run(chatbot, budget, short_ids, long_ids, args.streams, args.new_tokens,
+                     warmup_tokens=min(16, args.new_tokens // 2))
+        results["runs"].append(result)
+        print(json.dumps(result))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Measure quality and latency of the streaming (attention-sink) context
+
+A long text is streamed through the model in chunks. At each checkpoint
+(1k, 8k and 32k total tokens by default) the script records perplexity on
+the next tokens of the text, per-token decode latency, and KV cache size.
+With --baseline the same run is repeated with a full (never evicted) cache
+for comparison; it is expected to run out of memory at long lengths.
+
+The text is never repeated: a repeating text lets the model copy upcoming
+tokens from its context, which makes perplexity meaningless. By default the
+WikiText-2 test split is used (needs the `datasets` package); pass --text
+with one or more long files to use other text.
+"""
+import argparse
+import json
+import math
+import statistics
+import time
+
+import torch
+
+from chatbot import ChatBot
+from config import DEVICE, ATTENTION_SINK_TOKENS, STREAMING_WINDOW_TOKENS, STREAMING_PREFILL_CHUNK
+from memory import PeakMemoryMonitor, is_out_of_memory, release_cached_memory
+from streaming_context import SinkKVCache, rotary_inv_freq
+
+
+def load_text(paths) -> str:
+    """Concatenate the given files, or fetch the WikiText-2 test split"""
+    if paths:
+        texts = []
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                texts.append(f.read())
+        return "\n\n".join(texts)
+    try:
+        from datasets import load_dataset
+    except ImportError:
+        raise SystemExit("Install `datasets` for the default WikiText-2 text, or pass --text with long, "
+                         "non-repeating text files")
+    return "".join(load_dataset("wikitext", "wikitext-2-raw-v1", split="test")["text"])
+
+
+def feed(chatbot: ChatBot, cache: SinkKVCache, token_ids: torch.Tensor, chunk_size: int,
+         return_logits: bool = False):
+    """Stream tokens through the model; optionally return logits for every position"""
+    all_logits = []
+    for start in range(0, token_ids.shape[1], chunk_size):
+        chunk = token_ids[:, start:start + chunk_size]
+        outputs = chatbot.model.base_model(
+            input_ids=chunk,
+            attention_mask=cache.attention_mask(chunk.shape[1], DEVICE),
+            past_key_values=cache.past,
+            use_cache=True
+        )
+        cache.update(outputs.past_key_values, chunk.shape[1])
+        if return_logits:
+            all_logits.append(chatbot.model.get_output_embeddings()(outputs.last_hidden_state).float())
+    return torch.cat(all_logits, dim=1) if return_logits else None
+
+
+def run(chatbot: ChatBot, token_ids: torch.Tensor, checkpoints, window: int, eval_tokens: int,
+        decode_steps: int):
+    """Stream the text once, measuring at each checkpoint"""
+    cache = SinkKVCache(ATTENTION_SINK_TOKENS, window, rotary_inv_freq(chatbot.model))
+    monitor = PeakMemoryMonitor().start()
+    results = []
+    fed = 0
+    with torch.no_grad():
+        for checkpoint in checkpoints:
+            try:
+                feed(chatbot, cache, token_ids[:, fed:checkpoint], STREAMING_PREFILL_CHUNK)
+                fed = checkpoint
+
+                # Quality: perplexity of the following tokens given the streamed context
+                target = token_ids[:, fed:fed + eval_tokens]
+                logits = feed(chatbot, cache, target, STREAMING_PREFILL_CHUNK, return_logits=True)
+                fed += target.shape[1]
+                nll = torch.nn.functional.cross_entropy(logits[0, :-1], target[0, 1:])
+
+                # Latency: single-token decode steps at this context length
+                latencies = []
+                token = target[:, -1:]
+                for _ in range(decode_steps):
+                    start = time.perf_counter()
+                    outputs = chatbot.model.base_model(
+                        input_ids=token,
+                        attention_mask=cache.attention_mask(1, DEVICE),
+                        past_key_values=cache.past,
+                        use_cache=True
+                    )
+                    cache.update(outputs.past_key_values, 1)
+                    next_logits = chatbot.model.get_output_embeddings()(outputs.last_hidden_state[:, -1, :])
+                    token = next_logits.argmax(dim=-1, keepdim=True)
+                    if DEVICE == "cuda":
+                        torch.cuda.synchronize()
+                    latencies.append(1000 * (time.perf_counter() - start))
+
+                results.append({
+                    "total_tokens": checkpoint,
+                    "perplexity": round(math.exp(nll.item()), 3),
+                    "decode_ms_mean": round(statistics.mean(latencies), 2),
+                    "decode_ms_p50": round(statistics.median(latencies), 2),
+                    "cached_tokens": cache.length,
+                    "kv_mb": round(cache.nbytes() / 1024**2, 1),
+                })
+                print(json.dumps(results[-1]))
+            except Exception as e:
+                if not is_out_of_memory(e):
+                    raise
+                release_cached_memory()
+                results.append({"total_tokens": checkpoint, "error": "out of memory"})
+                print(json.dumps(results[-1]))
+                break
+    return {"checkpoints": results, **monitor.stop()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the attention-sink streaming context")
+    parser.add_argument("--text", type=str, nargs="+", default=None,
+                        help="Text files to stream, concatenated (default: WikiText-2 test split)")
+    parser.add_argument("--checkpoints", type=str, default="1024,8192,32768",
+                        help="Comma-separated total token counts to measure at")
+    parser.add_argument("--window", type=int, default=STREAMING_WINDOW_TOKENS, help="Rolling window size")
+    parser.add_argument("--eval-tokens", type=int, default=256, help="Tokens scored for perplexity")
+    parser.add_argument("--decode-steps", type=int, default=32, help="Decode steps timed per checkpoint")
+    parser.add_argument("--baseline", action="store_true", help="Also run with a full, never-evicted cache")
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    checkpoints = sorted(int(c) for c in args.checkpoints.split(","))
+    chatbot = ChatBot()
+
+    text_ids = chatbot.tokenizer(load_text(args.text), add_special_tokens=False)["input_ids"]
+    # Each checkpoint scores the `eval_tokens` that follow it; drop checkpoints the text cannot cover
+    usable = [c for c in checkpoints if c + args.eval_tokens <= len(text_ids)]
+    if len(usable) < len(checkpoints):
+        print(f"Warning: the text has only {len(text_ids)} tokens, skipping checkpoints "
+              f"{', '.join(str(c) for c in checkpoints if c not in usable)}")
+    if not usable:
+        raise SystemExit("Text too short for any checkpoint")
+    checkpoints = usable
+    token_ids = torch.tensor([text_ids], device=DEVICE)
+
+    results = {"window_tokens": args.window, "sink_tokens": ATTENTION_SINK_TOKENS}
+    print(f"Streaming context (window {args.window})...")
+    results["streaming"] = run(chatbot, token_ids, checkpoints, args.window, args.eval_tokens, args.decode_steps)
+    if args.baseline:
+        print("Full cache baseline...")
+        results["full_cache"] = run(chatbot, token_ids, checkpoints, float("inf"), args.eval_tokens,
+                                    args.decode_steps)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
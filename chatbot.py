@@ -3,11 +3,28 @@ Chatbot implementation using Xenova/gpt-4o model
 """
 import torch
 import os
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList, pipeline
+from huggingface_hub import snapshot_download
 from typing import List, Dict, Optional
 import warnings
 warnings.filterwarnings("ignore")
 
+import kv_cache
+import sampling
+from adapters import AdapterManager
+from grammar import compile_constraint
+from kv_store import KVStore
+from pipeline import GenerationPipeline, IncrementalDetokenizer
+from pipeline_parallel import PipelineParallelModel
+from scheduler import ChunkedPrefillScheduler
+from streaming_context import SinkKVCache, rotary_inv_freq
+from memory import MemoryBudget, is_out_of_memory, release_cached_memory
+from profiling import PROFILER
+from torch.profiler import record_function
 from config import (
     MODEL_NAME,
     LOCAL_MODEL_PATH,
@@ -20,25 +37,66 @@ from config import (
     MAX_HISTORY_LENGTH,
     LOAD_IN_8BIT,
     LOAD_IN_4BIT,
-    TRUST_REMOTE_CODE
+    TRUST_REMOTE_CODE,
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_MAX_ENTRIES,
+    SEMANTIC_CACHE_PATH,
+    SEMANTIC_CACHE_EMBEDDING_MODEL,
+    MEMORY_BUDGET_MB,
+    MEMORY_SAFETY_FRACTION,
+    GENERATION_PIPELINE,
+    LORA_ADAPTERS,
+    MAX_RESIDENT_ADAPTERS,
+    PIPELINE_STAGES,
+    PIPELINE_DTYPE,
+    PIPELINE_PREFILL_CHUNK,
+    CHUNKED_PREFILL,
+    SCHEDULER_TOKEN_BUDGET,
+    SCHEDULER_MIN_PREFILL_CHUNK,
+    SCHEDULER_MAX_SEQUENCES,
+    STREAMING_CONTEXT,
+    ATTENTION_SINK_TOKENS,
+    STREAMING_WINDOW_TOKENS,
+    STREAMING_PREFILL_CHUNK,
+    KV_SPILL_PATH,
+    KV_SPILL_IDLE_SECONDS,
+    KV_SPILL_QUOTA_MB,
+    KV_SPILL_COMPRESS
 )
 
 
 class ChatBot:
     """Chatbot class using Xenova/gpt-4o model"""
     
-    def __init__(self):
-        """Initialize the chatbot with the model"""
+    def __init__(self, local_model_path: Optional[str] = None, load_in_8bit: Optional[bool] = None,
+                 load_in_4bit: Optional[bool] = None, dtype: Optional[torch.dtype] = None):
+        """Initialize the chatbot with the model
+        
+        Arguments default to LOCAL_MODEL_PATH, LOAD_IN_8BIT and LOAD_IN_4BIT from config.py;
+        `dtype` overrides the default precision (float16 on CUDA, float32 on CPU).
+        """
+        if local_model_path is None:
+            local_model_path = LOCAL_MODEL_PATH
+        if load_in_8bit is None:
+            load_in_8bit = LOAD_IN_8BIT
+        if load_in_4bit is None:
+            load_in_4bit = LOAD_IN_4BIT
+        self.local_model_path = local_model_path
+        self.load_in_8bit = load_in_8bit
+        self.load_in_4bit = load_in_4bit
+        
         # Determine model path (local or Hugging Face)
-        if LOCAL_MODEL_PATH and os.path.exists(LOCAL_MODEL_PATH):
-            model_path = LOCAL_MODEL_PATH
+        if local_model_path and os.path.exists(local_model_path):
+            model_path = local_model_path
             print(f"Loading model from local path: {model_path}")
         else:
             model_path = MODEL_NAME
-            if LOCAL_MODEL_PATH:
-                print(f"Warning: Local model path '{LOCAL_MODEL_PATH}' not found, using Hugging Face: {MODEL_NAME}")
+            if local_model_path:
+                print(f"Warning: Local model path '{local_model_path}' not found, using Hugging Face: {MODEL_NAME}")
             else:
                 print(f"Loading model from Hugging Face: {MODEL_NAME}")
+        self.model_path = model_path
         
         print(f"Device: {DEVICE}")
         
@@ -54,56 +112,144 @@ class ChatBot:
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             
-            # Load model
-            if LOCAL_MODEL_PATH and os.path.exists(LOCAL_MODEL_PATH):
-                print("Loading model from local storage...")
+            if PIPELINE_STAGES > 1:
+                # Decoder layers are split across stage processes; this one holds no weights
+                print(f"Starting {PIPELINE_STAGES} pipeline stages (each loads its own layers)...")
+                self.model = None
+                weights_path = model_path
+                if not os.path.isdir(weights_path):
+                    weights_path = snapshot_download(model_path, allow_patterns=["*.json", "*.safetensors"])
+                self.parallel = PipelineParallelModel(
+                    weights_path,
+                    PIPELINE_STAGES,
+                    dtype=dtype or getattr(torch, PIPELINE_DTYPE),
+                    prefill_chunk=PIPELINE_PREFILL_CHUNK
+                )
             else:
-                print("Loading model (this may take a while on first run - downloading from Hugging Face)...")
+                self.parallel = None
+                # Load model
+                if local_model_path and os.path.exists(local_model_path):
+                    print("Loading model from local storage...")
+                else:
+                    print("Loading model (this may take a while on first run - downloading from Hugging Face)...")
             
-            model_kwargs = {
-                "trust_remote_code": TRUST_REMOTE_CODE,
-            }
+                model_kwargs = {
+                    "trust_remote_code": TRUST_REMOTE_CODE,
+                }
+            
+                # Set dtype based on device
+                if DEVICE == "cuda" and torch.cuda.is_available():
+                    model_kwargs["torch_dtype"] = torch.float16
+                    model_kwargs["device_map"] = "auto"
+                else:
+                    model_kwargs["torch_dtype"] = torch.float32
+                    model_kwargs["device_map"] = None
+                if dtype is not None:
+                    model_kwargs["torch_dtype"] = dtype
+            
+                # Handle quantization
+                if load_in_8bit:
+                    try:
+                        from transformers import BitsAndBytesConfig
+                        model_kwargs["load_in_8bit"] = True
+                        model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+                    except ImportError:
+                        print("Warning: bitsandbytes not available, loading in full precision")
+                elif load_in_4bit:
+                    try:
+                        from transformers import BitsAndBytesConfig
+                        model_kwargs["load_in_4bit"] = True
+                        model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_4bit=True)
+                    except ImportError:
+                        print("Warning: bitsandbytes not available, loading in full precision")
+            
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    **model_kwargs
+                )
+            
+                # Move to device if not using device_map
+                if model_kwargs.get("device_map") is None:
+                    self.model = self.model.to(DEVICE)
+            
+                self.model.eval()
             
-            # Set dtype based on device
-            if DEVICE == "cuda" and torch.cuda.is_available():
-                model_kwargs["torch_dtype"] = torch.float16
-                model_kwargs["device_map"] = "auto"
+            # Initialize conversation history
+            self.conversation_history: List[Dict[str, str]] = []
+            
+            print("Model loaded successfully!")
+            if self.model is not None:
+                print(f"Model is using device: {next(self.model.parameters()).device}")
             else:
-                model_kwargs["torch_dtype"] = torch.float32
-                model_kwargs["device_map"] = None
+                ignored = [name for name, enabled in (
+                    ("GENERATION_PIPELINE", GENERATION_PIPELINE),
+                    ("CHUNKED_PREFILL", CHUNKED_PREFILL),
+                    ("STREAMING_CONTEXT", STREAMING_CONTEXT),
+                    ("LORA_ADAPTERS", bool(LORA_ADAPTERS)),
+                ) if enabled]
+                if ignored:
+                    print(f"Warning: {', '.join(ignored)} not supported with PIPELINE_STAGES, ignoring")
+            single_process = self.model is not None
             
-            # Handle quantization
-            if LOAD_IN_8BIT:
-                try:
-                    from transformers import BitsAndBytesConfig
-                    model_kwargs["load_in_8bit"] = True
-                    model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
-                except ImportError:
-                    print("Warning: bitsandbytes not available, loading in full precision")
-            elif LOAD_IN_4BIT:
+            # Optional LoRA adapters on top of the base model
+            self.adapters = None
+            self.adapter = None  # Adapter used by chat() unless a request picks another
+            if LORA_ADAPTERS and single_process:
                 try:
-                    from transformers import BitsAndBytesConfig
-                    model_kwargs["load_in_4bit"] = True
-                    model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_4bit=True)
+                    self.adapters = AdapterManager(self.model, LORA_ADAPTERS, MAX_RESIDENT_ADAPTERS)
+                    print(f"LoRA adapters available: {', '.join(self.adapters.names())}")
                 except ImportError:
-                    print("Warning: bitsandbytes not available, loading in full precision")
+                    print("Warning: peft not available, LoRA adapters disabled")
             
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                **model_kwargs
+            # Memory admission control for generation (KV cache + activations)
+            self.memory_budget = MemoryBudget(
+                self.model.config if single_process else self.parallel.config,
+                dtype=self.model.dtype if single_process else self.parallel.dtype,
+                device=DEVICE,
+                budget_mb=MEMORY_BUDGET_MB,
+                safety_fraction=MEMORY_SAFETY_FRACTION
             )
             
-            # Move to device if not using device_map
-            if model_kwargs.get("device_map") is None:
-                self.model = self.model.to(DEVICE)
+            # Optional staged pipeline (tokenization/detokenization off the model thread)
+            self.pipeline = None
+            if GENERATION_PIPELINE and not CHUNKED_PREFILL and single_process:
+                self.pipeline = GenerationPipeline(self)
             
-            self.model.eval()
+            # Optional continuous scheduler (chunked prefill interleaved with decode)
+            self.scheduler = None
+            if CHUNKED_PREFILL and single_process:
+                self.scheduler = ChunkedPrefillScheduler(
+                    self,
+                    token_budget=SCHEDULER_TOKEN_BUDGET,
+                    min_prefill_chunk=SCHEDULER_MIN_PREFILL_CHUNK,
+                    max_sequences=SCHEDULER_MAX_SEQUENCES
+                )
             
-            # Initialize conversation history
-            self.conversation_history: List[Dict[str, str]] = []
+            # Optional bounded-memory streaming context (attention sinks + sliding window)
+            self.stream_cache = None
+            self._stream_text = ""  # Prompt text already held (or evicted) by stream_cache
+            self._stream_adapter = None  # LoRA adapter stream_cache was computed with
+            self._rope_inv_freq = rotary_inv_freq(self.model) if STREAMING_CONTEXT and single_process else None
+            self._stream_lock = threading.Lock()
+            self._stream_used = time.monotonic()
             
-            print("Model loaded successfully!")
-            print(f"Model is using device: {next(self.model.parameters()).device}")
+            # Optional disk tier: an idle conversation's streaming cache is spilled and freed
+            self.kv_store = None
+            self._stream_spilled = False
+            self._session_id = uuid.uuid4().hex
+            self._spill_stop = threading.Event()
+            if KV_SPILL_PATH and STREAMING_CONTEXT and single_process:
+                self.kv_store = KVStore(KV_SPILL_PATH, quota_mb=KV_SPILL_QUOTA_MB, compress=KV_SPILL_COMPRESS)
+                threading.Thread(target=self._spill_idle_loop, daemon=True).start()
+            elif KV_SPILL_PATH and not STREAMING_CONTEXT:
+                print("Warning: KV_SPILL_PATH is set but STREAMING_CONTEXT is off, nothing will be spilled")
+            elif KV_SPILL_PATH:
+                print("Warning: KV_SPILL_PATH is ignored with PIPELINE_STAGES, nothing will be spilled")
+            
+            # Optional semantic cache for repeated first-turn questions
+            self.semantic_cache = None
+            if SEMANTIC_CACHE_ENABLED:
+                self._init_semantic_cache()
             
         except Exception as e:
             print(f"Error loading model: {e}")
@@ -114,102 +260,790 @@ class ChatBot:
             print("4. Check if you have sufficient RAM/VRAM")
             raise
     
-    def format_prompt(self, user_message: str) -> str:
-        """Format the prompt with system message and conversation history"""
+    def _init_semantic_cache(self):
+        """Set up the embedding model and vector index for the semantic cache"""
+        from semantic_cache import SemanticCache
+        
+        # The chat model's hidden states are too anisotropic for a cosine threshold
+        # (unrelated questions score close to 1), so a dedicated embedding model is required
+        if not SEMANTIC_CACHE_EMBEDDING_MODEL:
+            print("Warning: the semantic cache needs SEMANTIC_CACHE_EMBEDDING_MODEL "
+                  "(e.g. sentence-transformers/all-MiniLM-L6-v2), disabling it")
+            return
+        
+        from transformers import AutoModel
+        print(f"Loading semantic cache embedding model: {SEMANTIC_CACHE_EMBEDDING_MODEL}")
+        self.embedding_tokenizer = AutoTokenizer.from_pretrained(SEMANTIC_CACHE_EMBEDDING_MODEL)
+        self.embedding_model = AutoModel.from_pretrained(SEMANTIC_CACHE_EMBEDDING_MODEL).to(DEVICE)
+        self.embedding_model.eval()
+        
+        self.semantic_cache = SemanticCache(
+            dim=self.embedding_model.config.hidden_size,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            path=SEMANTIC_CACHE_PATH,
+            models={"embedding": SEMANTIC_CACHE_EMBEDDING_MODEL, "chat": self.model_path}
+        )
+        print(f"Semantic cache enabled (threshold: {SEMANTIC_CACHE_THRESHOLD})")
+    
+    def embed(self, texts: List[str]):
+        """Embed texts as mean-pooled last hidden states (float32 NumPy array)"""
+        inputs = self.embedding_tokenizer(
+            texts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=512
+        ).to(self.embedding_model.device)
+        
+        with torch.no_grad():
+            hidden = self.embedding_model(**inputs).last_hidden_state
+        
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        return pooled.float().cpu().numpy()
+    
+    def format_messages(self, messages: List[Dict[str, str]]) -> str:
+        """Render a list of chat messages into a prompt ending with the assistant turn"""
         # Try to use the model's chat template if available
         if hasattr(self.tokenizer, "apply_chat_template") and self.tokenizer.chat_template is not None:
-            # Prepare messages for chat template
-            messages = []
-            
-            # Add system message if history is empty
-            if not self.conversation_history:
-                messages.append({"role": "system", "content": SYSTEM_PROMPT})
-            
-            # Add recent conversation history
-            recent_history = self.conversation_history[-MAX_HISTORY_LENGTH:]
-            for msg in recent_history:
-                messages.append({"role": msg["role"], "content": msg["content"]})
-            
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
-            
-            # Apply chat template
-            formatted = self.tokenizer.apply_chat_template(
+            return self.tokenizer.apply_chat_template(
                 messages,
                 tokenize=False,
                 add_generation_prompt=True
             )
-            return formatted
-        else:
-            # Fallback to simple formatting
-            if not self.conversation_history:
-                formatted = f"{SYSTEM_PROMPT}\n\n"
-            else:
-                formatted = ""
-            
-            # Add recent conversation history
-            recent_history = self.conversation_history[-MAX_HISTORY_LENGTH:]
-            for msg in recent_history:
-                role = msg["role"]
-                content = msg["content"]
-                if role == "user":
-                    formatted += f"User: {content}\n"
-                elif role == "assistant":
-                    formatted += f"Assistant: {content}\n"
-            
-            # Add current user message
-            formatted += f"User: {user_message}\nAssistant:"
-            
-            return formatted
+        
+        # Fallback to simple formatting
+        formatted = ""
+        for msg in messages:
+            role = msg["role"]
+            content = msg["content"]
+            if role == "system":
+                formatted += f"{content}\n\n"
+            elif role == "user":
+                formatted += f"User: {content}\n"
+            elif role == "assistant":
+                formatted += f"Assistant: {content}\n"
+        formatted += "Assistant:"
+        return formatted
+    
+    def format_prompt(self, user_message: str) -> str:
+        """Format the prompt with system message and conversation history"""
+        return self.format_messages(self._prompt_messages(user_message))
+    
+    def _prompt_messages(self, user_message: str) -> List[Dict[str, str]]:
+        """Build the message list for a reply: system prompt, recent history, new message"""
+        messages = []
+        
+        # Add system message if history is empty
+        if not self.conversation_history:
+            messages.append({"role": "system", "content": SYSTEM_PROMPT})
+        
+        # Add recent conversation history
+        recent_history = self.conversation_history[-MAX_HISTORY_LENGTH:]
+        for msg in recent_history:
+            messages.append({"role": msg["role"], "content": msg["content"]})
+        
+        # Add current user message
+        messages.append({"role": "user", "content": user_message})
+        
+        return messages
+    
+    def _clean_response(self, generated_text: str) -> str:
+        """Clean up response (remove any trailing user/assistant labels and special tokens)"""
+        generated_text = generated_text.strip()
+        generated_text = generated_text.split("User:")[0].strip()
+        generated_text = generated_text.split("Assistant:")[0].strip()
+        
+        # Remove common chat template artifacts
+        for token in ["<|im_end|>", "<|endoftext|>", "</s>", "<|end|>"]:
+            if generated_text.endswith(token):
+                generated_text = generated_text[:-len(token)].strip()
+        
+        return generated_text
+    
+    def _finish_reply(self, generated_text: str, constrained: bool) -> str:
+        """Final reply text: constrained output is already exactly what was asked for"""
+        return generated_text.strip() if constrained else self._clean_response(generated_text)
+    
+    def get_constraint(self, json_schema: Optional[Dict] = None, regex: Optional[str] = None):
+        """Compiled output constraint for a JSON schema or regex (None if neither is given)"""
+        if json_schema is None and regex is None:
+            return None
+        return compile_constraint(self.tokenizer, json_schema=json_schema, regex=regex)
+    
+    def check_adapter(self, adapter: Optional[str]):
+        """Raise ValueError unless `adapter` is None or a configured LoRA adapter"""
+        if adapter is not None and (self.adapters is None or adapter not in self.adapters.names()):
+            raise ValueError(f"Unknown adapter: {adapter}")
     
-    def generate_response(self, user_message: str) -> str:
-        """Generate a response to the user message"""
+    def set_adapter(self, adapter: Optional[str]):
+        """Select the LoRA adapter used by chat() (None for the base model)"""
+        self.check_adapter(adapter)
+        self.adapter = adapter
+    
+    def _adapter(self, adapter: Optional[str]):
+        """Context that loads `adapter` (if needed) and applies it to this thread's forward passes"""
+        if adapter is None:
+            return nullcontext()
+        return self.adapters.activate(adapter)
+    
+    def _use_adapters(self, adapters: List[Optional[str]]):
+        """Context applying one adapter per batch row to this thread's forward passes"""
+        if self.adapters is None:
+            return nullcontext()
+        return self.adapters.use(adapters)
+    
+    def generate_response(self, user_message: str, json_schema: Optional[Dict] = None,
+                          regex: Optional[str] = None, adapter: Optional[str] = None) -> str:
+        """Generate a response to the user message
+        
+        With `json_schema` (or `regex`) the output is constrained during decoding
+        to match it, so JSON replies are valid without retries. `adapter` names
+        a LoRA adapter to generate with (None for the base model).
+        """
+        try:
+            constraint = self.get_constraint(json_schema, regex)
+        except ValueError as e:
+            return f"Error generating response: invalid constraint: {e}"
         try:
-            # Format prompt
-            prompt = self.format_prompt(user_message)
+            self.check_adapter(adapter)
+        except ValueError as e:
+            return f"Error generating response: {e}"
+        processor = constraint.processor() if constraint is not None else None
+        
+        if self.parallel is not None:
+            try:
+                with PROFILER.capture("generate_parallel"):
+                    return self._generate_parallel(user_message, constraint)
+            except Exception as e:
+                return f"Error generating response: {e}"
+        
+        if STREAMING_CONTEXT:
+            try:
+                with PROFILER.capture("generate_streaming"), self._adapter(adapter), self._stream_lock:
+                    return self._generate_streaming(processor, adapter)
+            except Exception as e:
+                return f"Error generating response: {e}"
+        
+        if self.scheduler is not None:
+            try:
+                return self._generate_scheduled(user_message, constraint, adapter)
+            except Exception as e:
+                return f"Error generating response: {e}"
+        
+        if self.pipeline is not None:
+            try:
+                return self.pipeline.submit(self._prompt_messages(user_message), MAX_NEW_TOKENS,
+                                            logits_processor=processor, adapter=adapter).result()
+            except Exception as e:
+                return f"Error generating response: {e}"
+        
+        try:
+            with PROFILER.capture("generate_response"):
+                # Format prompt
+                with record_function("chatbot.tokenize"):
+                    prompt = self.format_prompt(user_message)
+                    
+                    # Tokenize input
+                    inputs = self.tokenizer(
+                        prompt,
+                        return_tensors="pt",
+                        truncation=True,
+                        max_length=2048
+                    ).to(DEVICE)
+                
+                # Generate response (fewer new tokens if memory is tight)
+                prompt_tokens = inputs["input_ids"].shape[1]
+                _, max_new_tokens = self.memory_budget.plan(1, prompt_tokens, MAX_NEW_TOKENS)
+                with self._adapter(adapter):
+                    outputs = self._generate_with_retry(inputs, max_new_tokens, logits_processor=processor)
+                
+                # Decode response
+                with record_function("chatbot.detokenize"):
+                    generated_text = self.tokenizer.decode(
+                        outputs[0][inputs["input_ids"].shape[1]:],
+                        skip_special_tokens=True
+                    )
+                    generated_text = self._finish_reply(generated_text, processor is not None)
             
-            # Tokenize input
-            inputs = self.tokenizer(
-                prompt,
+            return generated_text
+            
+        except Exception as e:
+            return f"Error generating response: {e}"
+    
+    def _generate_scheduled(self, user_message: str, constraint=None, adapter: Optional[str] = None) -> str:
+        """Generate a reply through the scheduler, interleaved with other running requests"""
+        with record_function("chatbot.tokenize"):
+            input_ids = self.tokenizer(
+                self.format_prompt(user_message),
                 return_tensors="pt",
                 truncation=True,
                 max_length=2048
-            ).to(DEVICE)
-            
-            # Generate response
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=MAX_NEW_TOKENS,
-                    temperature=TEMPERATURE,
-                    top_p=TOP_P,
-                    do_sample=DO_SAMPLE,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
+            )["input_ids"].to(DEVICE)
+        
+        choices = [{}]
+        for _ in self.scheduler.submit(input_ids, choices, MAX_NEW_TOKENS, TEMPERATURE, TOP_P,
+                                       constraint=constraint, adapter=adapter):
+            pass
+        
+        return self._finish_reply(choices[0]["text"], constraint is not None)
+    
+    def _generate_parallel(self, user_message: str, constraint=None) -> str:
+        """Generate a reply through the pipeline-parallel stages"""
+        with record_function("chatbot.tokenize"):
+            input_ids = self.tokenizer(
+                self.format_prompt(user_message),
+                return_tensors="pt",
+                truncation=True,
+                max_length=2048
+            )["input_ids"]
+        
+        choices = [{}]
+        for _ in self._sample_parallel(input_ids, choices, MAX_NEW_TOKENS, TEMPERATURE, TOP_P,
+                                       constraint=constraint):
+            pass
+        
+        return self._finish_reply(choices[0]["text"], constraint is not None)
+    
+    def _generate_streaming(self, processor=None, adapter: Optional[str] = None) -> str:
+        """Reply to the latest user message from the session's streaming KV cache.
+        
+        Only text not yet fed to the cache (normally just the new turn) is
+        prefilled, in chunks, so each turn costs time proportional to its own
+        length. The cache keeps the system prompt as attention sinks plus a
+        rolling window of recent tokens, so memory stays flat however long
+        the conversation gets; the full history is never truncated or re-run.
+        """
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        messages += [{"role": msg["role"], "content": msg["content"]} for msg in self.conversation_history]
+        full_prompt = self.format_messages(messages)
+        if self._stream_spilled:
+            self._restore_stream_cache()
+        
+        if self.stream_cache is None or not full_prompt.startswith(self._stream_text) \
+                or adapter != self._stream_adapter:
+            # First turn, the history no longer matches what was fed, or other adapter weights: start over
+            self.stream_cache = SinkKVCache(
+                num_sink_tokens=self._count_sink_tokens(),
+                window_tokens=STREAMING_WINDOW_TOKENS,
+                inv_freq=self._rope_inv_freq
+            )
+            self._stream_text = ""
+            self._stream_adapter = adapter
+        
+        new_text = full_prompt[len(self._stream_text):]
+        with record_function("chatbot.tokenize"):
+            new_ids = self.tokenizer(
+                new_text,
+                return_tensors="pt",
+                add_special_tokens=not self._stream_text
+            )["input_ids"].to(DEVICE)
+        
+        cache = self.stream_cache
+        eos_token_id = self.tokenizer.eos_token_id
+        generated: List[int] = []
+        token = None
+        with torch.no_grad():
+            with record_function("chatbot.prefill"):
+                for start in range(0, new_ids.shape[1], STREAMING_PREFILL_CHUNK):
+                    chunk = new_ids[:, start:start + STREAMING_PREFILL_CHUNK]
+                    logits, past = self._forward(chunk, cache.attention_mask(chunk.shape[1], DEVICE), cache.past)
+                    cache.update(past, chunk.shape[1])
             
-            # Decode response
-            generated_text = self.tokenizer.decode(
-                outputs[0][inputs["input_ids"].shape[1]:],
-                skip_special_tokens=True
-            ).strip()
+            for _ in range(MAX_NEW_TOKENS):
+                with record_function("chatbot.sample"):
+                    if processor is not None:
+                        logits = processor.apply(logits)
+                    token = int(sampling.sample_next_tokens(logits, TEMPERATURE, TOP_P, do_sample=DO_SAMPLE)[0])
+                    if processor is not None:
+                        processor.advance(0, token)
+                
+                # EOS is fed too, so the cache ends exactly where the next turn's text starts
+                with record_function("chatbot.decode"):
+                    token_ids = torch.tensor([[token]], device=DEVICE)
+                    logits, past = self._forward(token_ids, cache.attention_mask(1, DEVICE), cache.past)
+                    cache.update(past, 1)
+                if token == eos_token_id:
+                    break
+                generated.append(token)
+        
+        with record_function("chatbot.detokenize"):
+            generated_text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        reply = self._finish_reply(generated_text, processor is not None)
+        
+        # The history will hold `reply`, so record the fed text the way the next turn renders it. If
+        # cleanup only trimmed whitespace the cache still matches; if it cut text, the next turn starts over.
+        fed_text = full_prompt + self.tokenizer.decode(generated + ([token] if token == eos_token_id else []))
+        stable_text = full_prompt + reply + (self.tokenizer.decode([token]) if token == eos_token_id else "")
+        rendered = self.format_messages(messages + [{"role": "assistant", "content": reply}])
+        if reply == generated_text.strip() and rendered.startswith(stable_text):
+            self._stream_text = stable_text
+        else:
+            self._stream_text = fed_text
+        self._stream_used = time.monotonic()
+        return reply
+    
+    def _spill_idle_loop(self):
+        """Background thread: spill the streaming cache once the conversation has been idle"""
+        interval = min(5.0, KV_SPILL_IDLE_SECONDS / 4)
+        while not self._spill_stop.wait(interval):
+            if self.stream_cache is None or time.monotonic() - self._stream_used < KV_SPILL_IDLE_SECONDS:
+                continue
+            with self._stream_lock:
+                # Re-check: a turn may have run while we waited for the lock
+                if self.stream_cache is not None and time.monotonic() - self._stream_used >= KV_SPILL_IDLE_SECONDS:
+                    self._spill_stream_cache()
+    
+    def _spill_stream_cache(self):
+        """Write the streaming cache to the KV store and free it (caller holds _stream_lock)"""
+        cache = self.stream_cache
+        if cache.past is None:
+            return
+        layers = kv_cache.to_legacy(cache.past)
+        metadata = {
+            "num_sink_tokens": cache.num_sink_tokens,
+            "window_tokens": cache.window_tokens,
+            "evict_chunk": cache.evict_chunk,
+            "seen_tokens": cache.seen_tokens,
+            "evicted_tokens": cache.evicted_tokens,
+            "devices": [str(key.device) for key, _ in layers],  # Layers may span GPUs (device_map)
+        }
+        if not self.kv_store.put(self._session_id, [t for layer in layers for t in layer], metadata):
+            return  # Larger than the whole quota: keep it in memory
+        self.stream_cache = None
+        self._stream_spilled = True
+        release_cached_memory()
+    
+    def _restore_stream_cache(self):
+        """Map a spilled streaming cache back from the KV store (caller holds _stream_lock)"""
+        self._stream_spilled = False
+        entry = self.kv_store.get(self._session_id)
+        if entry is None:
+            return  # Evicted to stay under the disk quota; the next turn re-prefills
+        tensors, meta = entry
+        cache = SinkKVCache(
+            num_sink_tokens=meta["num_sink_tokens"],
+            window_tokens=meta["window_tokens"],
+            inv_freq=self._rope_inv_freq,
+            evict_chunk=meta["evict_chunk"]
+        )
+        cache.past = kv_cache.from_legacy([
+            (key.to(device), value.to(device))
+            for key, value, device in zip(tensors[0::2], tensors[1::2], meta["devices"])
+        ])
+        cache.seen_tokens = meta["seen_tokens"]
+        cache.evicted_tokens = meta["evicted_tokens"]
+        self.stream_cache = cache
+    
+    def _count_sink_tokens(self) -> int:
+        """Tokens to pin as attention sinks: the rendered system prompt (at least ATTENTION_SINK_TOKENS)"""
+        system = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if hasattr(self.tokenizer, "apply_chat_template") and self.tokenizer.chat_template is not None:
+            system_text = self.tokenizer.apply_chat_template(system, tokenize=False)
+        else:
+            system_text = f"{SYSTEM_PROMPT}\n\n"
+        return max(ATTENTION_SINK_TOKENS, len(self.tokenizer(system_text)["input_ids"]))
+    
+    def _generate_with_retry(self, inputs, max_new_tokens: int, streamer=None,
+                             logits_processor=None) -> torch.Tensor:
+        """Run model.generate, retrying with half the new tokens after an out-of-memory error"""
+        processors = LogitsProcessorList([logits_processor]) if logits_processor is not None else None
+        while True:
+            estimate = self.memory_budget.estimate_bytes(1, inputs["input_ids"].shape[1], max_new_tokens)
+            try:
+                with torch.no_grad(), record_function("chatbot.generate"), self.memory_budget.reserve(estimate):
+                    return self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        temperature=TEMPERATURE,
+                        top_p=TOP_P,
+                        do_sample=DO_SAMPLE,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        eos_token_id=self.tokenizer.eos_token_id,
+                        streamer=streamer,
+                        logits_processor=processors,
+                    )
+            except Exception as e:
+                # A streamed or constrained generation cannot be restarted once tokens went out
+                if not is_out_of_memory(e) or max_new_tokens <= 16 or streamer is not None \
+                        or logits_processor is not None:
+                    raise
+                release_cached_memory()
+                max_new_tokens //= 2
+                print(f"Out of memory during generation, retrying with max_new_tokens={max_new_tokens}")
+    
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, past_key_values=None,
+                 position_ids: Optional[torch.Tensor] = None):
+        """Run the decoder and return (last-position logits, updated KV cache).
+
+        Only the last position goes through the LM head, so prefilling a long
+        prompt never materializes a (tokens x vocab) logits tensor. Batches with
+        left padding must pass `position_ids`.
+        """
+        outputs = self.model.base_model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            position_ids=position_ids,
+            use_cache=True
+        )
+        logits = self.model.get_output_embeddings()(outputs.last_hidden_state[:, -1, :])
+        return logits, outputs.past_key_values
+    
+    def _sample_choices(self, input_ids: torch.Tensor, choices: List[Dict], max_new_tokens: int,
+                        temperature: float, top_p: float, stop: Optional[List[str]] = None,
+                        constraint=None, adapter: Optional[str] = None, detokenize: bool = True):
+        """Decode len(choices) samples that share a single prefill of `input_ids`.
+        
+        The prompt is run through the model once, its KV cache is repeated for
+        every choice, and the choices are then decoded together as one batch.
+        Yields (index, text_delta, finish_reason) events as text becomes final;
+        each choice dict accumulates "tokens", "text" and "finish_reason".
+        
+        Choices are split into batches that fit the memory budget. If a batch
+        still runs out of memory it is split in half and retried; choices that
+        already produced tokens resume from where they stopped. A `constraint`
+        (see grammar.py) masks the logits of every row at every step, and
+        `adapter` selects the LoRA adapter to decode with. `detokenize=False`
+        yields token events instead of text (see _accept_tokens).
+        """
+        stop = [s for s in (stop or []) if s]
+        self._init_choices(choices)
+        
+        batch_size, max_new_tokens = self.memory_budget.plan(len(choices), input_ids.shape[1], max_new_tokens)
+        indexes = list(range(len(choices)))
+        pending = [indexes[i:i + batch_size] for i in range(0, len(indexes), batch_size)]
+        
+        while pending:
+            group = pending.pop(0)
+            estimate = self.memory_budget.estimate_bytes(len(group), input_ids.shape[1], max_new_tokens)
+            try:
+                with self.memory_budget.reserve(estimate), self._adapter(adapter):
+                    yield from self._decode_group(input_ids, choices, group, max_new_tokens,
+                                                  temperature, top_p, stop, constraint, detokenize)
+            except Exception as e:
+                if not is_out_of_memory(e):
+                    raise
+                release_cached_memory()
+                unfinished = [i for i in group if choices[i]["finish_reason"] is None]
+                if len(unfinished) <= 1:
+                    raise MemoryError("Out of memory generating a single sequence") from e
+                print(f"Out of memory with a batch of {len(group)}, splitting and retrying")
+                # Fresh choices can still share a prefill; resumed ones each need their own
+                fresh = [i for i in unfinished if not choices[i]["tokens"]]
+                resumed = [[i] for i in unfinished if choices[i]["tokens"]]
+                halves = [fresh[:len(fresh) // 2], fresh[len(fresh) // 2:]] if len(fresh) > 1 else [fresh]
+                pending = resumed + [h for h in halves if h] + pending
+    
+    def _sample_parallel(self, input_ids: torch.Tensor, choices: List[Dict], max_new_tokens: int,
+                         temperature: float, top_p: float, stop: Optional[List[str]] = None,
+                         constraint=None):
+        """Decode len(choices) samples through the pipeline-parallel stages.
+        
+        Same events and choice state as _sample_choices. The prompt is prefilled
+        once in chunks and every stage forks its KV cache for each choice. Each
+        step sends one micro-batch per running choice without waiting, so the
+        choices follow each other through the stages instead of idling them.
+        """
+        stop = [s for s in (stop or []) if s]
+        self._init_choices(choices)
+        n = len(choices)
+        group = list(range(n))
+        _, max_new_tokens = self.memory_budget.plan(n, input_ids.shape[1], max_new_tokens)
+        processor = constraint.processor(n) if constraint is not None else None
+        
+        parent = self.parallel.new_sequence()
+        sequences = [parent]
+        try:
+            with record_function("chatbot.prefill"):
+                logits = self.parallel.prefill(parent, input_ids).result()
+            if n > 1:
+                sequences = [self.parallel.new_sequence() for _ in range(n)]
+                self.parallel.fork(parent, sequences)
+                self.parallel.free([parent])
+            logits = logits.repeat(n, 1)
             
-            # Clean up response (remove any trailing user/assistant labels and special tokens)
-            generated_text = generated_text.split("User:")[0].strip()
-            generated_text = generated_text.split("Assistant:")[0].strip()
+            for _ in range(max_new_tokens):
+                with record_function("chatbot.sample"):
+                    if processor is not None:
+                        logits = processor.apply(logits)
+                    next_tokens = sampling.sample_next_tokens(logits, temperature, top_p, do_sample=DO_SAMPLE)
+                
+                yield from self._accept_tokens(choices, group, next_tokens, max_new_tokens, stop, processor)
+                
+                running = [i for i in group if choices[i]["finish_reason"] is None]
+                if not running:
+                    break
+                with record_function("chatbot.decode"):
+                    futures = [(i, self.parallel.forward(sequences[i], next_tokens[i:i + 1, None]))
+                               for i in running]
+                    for i, future in futures:
+                        logits[i] = future.result()[0]
+        finally:
+            self.parallel.free([parent] + sequences)
+    
+    def _init_choices(self, choices: List[Dict]):
+        """Reset the per-choice decoding state used by _accept_tokens"""
+        for choice in choices:
+            choice.update({
+                "tokens": [],
+                "text": "",
+                "emitted": 0,
+                "finish_reason": None,
+                "stop_requested": False,  # The text reached a stop string
+                "detokenizer": IncrementalDetokenizer(self.tokenizer)
+            })
+    
+    def _decode_group(self, input_ids: torch.Tensor, choices: List[Dict], group: List[int],
+                      max_new_tokens: int, temperature: float, top_p: float, stop: List[str],
+                      constraint=None, detokenize: bool = True):
+        """Decode the choices in `group` as one batch (see _sample_choices)"""
+        n = len(group)
+        eos_token_id = self.tokenizer.eos_token_id
+        
+        # A resumed choice (always alone in its group) re-prefills its own tokens
+        resumed_tokens = choices[group[0]]["tokens"] if n == 1 else []
+        if resumed_tokens:
+            input_ids = torch.cat([input_ids, input_ids.new_tensor([resumed_tokens])], dim=1)
+        
+        processor = constraint.processor(n) if constraint is not None else None
+        if processor is not None:
+            for token in resumed_tokens:
+                processor.advance(0, token)
+        
+        with torch.no_grad():
+            prompt_mask = torch.ones_like(input_ids)
+            with record_function("chatbot.prefill"):
+                logits, past = self._forward(input_ids, prompt_mask)
+            past = kv_cache.repeat_batch(past, n)
+            logits = logits.repeat(n, 1)
+            attention_mask = prompt_mask.repeat(n, 1)
             
-            # Remove common chat template artifacts
-            for token in ["<|im_end|>", "<|endoftext|>", "</s>", "<|end|>"]:
-                if generated_text.endswith(token):
-                    generated_text = generated_text[:-len(token)].strip()
+            for _ in range(max_new_tokens - len(resumed_tokens)):
+                with record_function("chatbot.sample"):
+                    if processor is not None:
+                        logits = processor.apply(logits)
+                    next_tokens = sampling.sample_next_tokens(logits, temperature, top_p, do_sample=DO_SAMPLE)
+                
+                yield from self._accept_tokens(choices, group, next_tokens, max_new_tokens, stop, processor,
+                                               detokenize)
+                
+                if all(choices[index]["finish_reason"] is not None for index in group):
+                    break
+                
+                # Finished rows keep decoding EOS so the batch stays rectangular
+                next_tokens = next_tokens.masked_fill(
+                    torch.tensor([choices[i]["finish_reason"] is not None for i in group], device=next_tokens.device),
+                    eos_token_id
+                )
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((n, 1))], dim=1)
+                with record_function("chatbot.decode"):
+                    logits, past = self._forward(next_tokens[:, None], attention_mask, past)
+    
+    def _accept_tokens(self, choices: List[Dict], group: List[int], next_tokens: torch.Tensor,
+                       max_new_tokens: int, stop: List[str], processor=None, detokenize: bool = True):
+        """Record one sampled token per row of `group`, yielding (index, text_delta, finish_reason).
+        
+        With `detokenize=False` the text is left to another thread: events are
+        (index, token, finish_reason), token None for EOS, for that thread to
+        pass to _accept_text. A row it marks "stop_requested" finishes here on
+        the next step.
+        """
+        eos_token_id = self.tokenizer.eos_token_id
+        
+        for row, index in enumerate(group):
+            choice = choices[index]
+            if choice["finish_reason"] is not None:
+                continue
+            if choice["stop_requested"]:
+                choice["finish_reason"] = "stop"
+                continue
+            token = int(next_tokens[row])
+            if processor is not None:
+                processor.advance(row, token)
+            if token == eos_token_id:
+                choice["finish_reason"] = "stop"
+                token = None
+            else:
+                choice["tokens"].append(token)
+                if len(choice["tokens"]) >= max_new_tokens:
+                    choice["finish_reason"] = "length"
             
-            return generated_text
+            if not detokenize:
+                yield index, token, choice["finish_reason"]
+                continue
+            yield from self._accept_text(choice, index, token, choice["finish_reason"], stop)
+            if choice["stop_requested"]:
+                choice["finish_reason"] = "stop"
+    
+    def _accept_text(self, choice: Dict, index: int, token: Optional[int], finish_reason: Optional[str],
+                     stop: List[str]):
+        """Add a token's text to a choice, yielding (index, text_delta, finish_reason) once text is final.
+        
+        The text is cut at the first stop string, which finishes the choice and
+        sets its "stop_requested"; later tokens of the choice are ignored.
+        """
+        if choice["stop_requested"]:
+            return
+        # Hold back enough text that a partially generated stop string is never emitted
+        holdback = max((len(s) for s in stop), default=1) - 1
+        
+        if token is not None:
+            with record_function("chatbot.detokenize"):
+                choice["text"] += choice["detokenizer"].add([token])
+            positions = [p for p in (choice["text"].find(s) for s in stop) if p != -1]
+            if positions:
+                choice["text"] = choice["text"][:min(positions)]
+                choice["stop_requested"] = True
+                finish_reason = "stop"
+        
+        # Emit everything that can no longer change
+        text = choice["text"]
+        if finish_reason is None:
+            text = text[:len(text) - holdback] if holdback else text
+        if len(text) > choice["emitted"] or finish_reason is not None:
+            delta = text[choice["emitted"]:]
+            choice["emitted"] = max(choice["emitted"], len(text))
+            yield index, delta, finish_reason
+    
+    def _tokenize_messages(self, messages: List[Dict[str, str]]) -> torch.Tensor:
+        """Template and tokenize messages, keeping the most recent 2048 tokens"""
+        prompt = self.format_messages(messages)
+        input_ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"]
+        return input_ids[:, -2048:].to(DEVICE)
+    
+    def stream_completions(self, messages: List[Dict[str, str]], n: int = 1,
+                           max_tokens: Optional[int] = None, temperature: Optional[float] = None,
+                           top_p: Optional[float] = None, stop: Optional[List[str]] = None,
+                           usage: Optional[Dict[str, int]] = None, json_schema: Optional[Dict] = None,
+                           regex: Optional[str] = None, adapter: Optional[str] = None):
+        """Stream n sampled replies to `messages` as (index, text_delta, finish_reason) events.
+        
+        Does not touch the conversation history. If a `usage` dict is given it
+        is filled with prompt/completion token counts when the stream ends.
+        `json_schema`/`regex` constrain the replies and `adapter` picks the LoRA
+        adapter (see generate_response).
+        """
+        constraint = self.get_constraint(json_schema, regex)
+        self.check_adapter(adapter)
+        choices = [{} for _ in range(n)]
+        
+        if self.pipeline is not None:
+            # Templating and tokenization overlap with other requests' model work
+            prompt_usage: Dict[str, int] = {}
+            yield from self.pipeline.stream(
+                messages,
+                choices,
+                max_new_tokens=max_tokens or MAX_NEW_TOKENS,
+                temperature=TEMPERATURE if temperature is None else temperature,
+                top_p=TOP_P if top_p is None else top_p,
+                stop=stop,
+                constraint=constraint,
+                adapter=adapter,
+                usage=prompt_usage
+            )
+            prompt_tokens = prompt_usage["prompt_tokens"]
+        else:
+            prompt_tokens = yield from self._stream_completions_inline(
+                messages, choices, max_tokens, temperature, top_p, stop, constraint, adapter)
+        
+        if usage is not None:
+            usage["prompt_tokens"] = prompt_tokens
+            usage["completion_tokens"] = sum(len(c["tokens"]) for c in choices)
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    
+    def _stream_completions_inline(self, messages: List[Dict[str, str]], choices: List[Dict],
+                                   max_tokens: Optional[int], temperature: Optional[float],
+                                   top_p: Optional[float], stop: Optional[List[str]], constraint,
+                                   adapter: Optional[str]):
+        """stream_completions without the pipeline; returns the prompt length"""
+        # The scheduler profiles its own steps; this thread would only wait on a queue
+        with PROFILER.capture("completions") if self.scheduler is None else nullcontext():
+            with record_function("chatbot.tokenize"):
+                input_ids = self._tokenize_messages(messages)
             
-        except Exception as e:
-            return f"Error generating response: {e}"
+            if self.parallel is not None:
+                yield from self._sample_parallel(
+                    input_ids,
+                    choices,
+                    max_new_tokens=max_tokens or MAX_NEW_TOKENS,
+                    temperature=TEMPERATURE if temperature is None else temperature,
+                    top_p=TOP_P if top_p is None else top_p,
+                    stop=stop,
+                    constraint=constraint
+                )
+            elif self.scheduler is not None:
+                yield from self.scheduler.submit(
+                    input_ids,
+                    choices,
+                    max_new_tokens=max_tokens or MAX_NEW_TOKENS,
+                    temperature=TEMPERATURE if temperature is None else temperature,
+                    top_p=TOP_P if top_p is None else top_p,
+                    stop=stop,
+                    constraint=constraint,
+                    adapter=adapter
+                )
+            else:
+                yield from self._sample_choices(
+                    input_ids,
+                    choices,
+                    max_new_tokens=max_tokens or MAX_NEW_TOKENS,
+                    temperature=TEMPERATURE if temperature is None else temperature,
+                    top_p=TOP_P if top_p is None else top_p,
+                    stop=stop,
+                    constraint=constraint,
+                    adapter=adapter
+                )
+        return input_ids.shape[1]
     
-    def chat(self, user_message: str) -> str:
-        """Main chat method that handles conversation history"""
+    def generate_completions(self, messages: List[Dict[str, str]], n: int = 1,
+                             max_tokens: Optional[int] = None, temperature: Optional[float] = None,
+                             top_p: Optional[float] = None, stop: Optional[List[str]] = None,
+                             json_schema: Optional[Dict] = None, regex: Optional[str] = None,
+                             adapter: Optional[str] = None) -> Dict:
+        """Generate n replies to `messages` sharing one prompt prefill.
+        
+        Returns {"choices": [{"index", "text", "finish_reason"}], "usage": {...}}.
+        """
+        usage: Dict[str, int] = {}
+        texts = [""] * n
+        finish_reasons = [None] * n
+        for index, delta, finish_reason in self.stream_completions(
+                messages, n, max_tokens, temperature, top_p, stop, usage, json_schema, regex, adapter):
+            texts[index] += delta
+            finish_reasons[index] = finish_reason
+        
+        return {
+            "choices": [
+                {"index": i, "text": texts[i], "finish_reason": finish_reasons[i] or "length"}
+                for i in range(n)
+            ],
+            "usage": usage
+        }
+    
+    def chat(self, user_message: str, json_schema: Optional[Dict] = None, regex: Optional[str] = None,
+             adapter: Optional[str] = None) -> str:
+        """Main chat method that handles conversation history
+        
+        `adapter` overrides the session's LoRA adapter (see set_adapter) for this message.
+        Raises ValueError for an invalid constraint or unknown adapter, before the
+        message is added to the history.
+        """
+        constrained = json_schema is not None or regex is not None
+        if adapter is None:
+            adapter = self.adapter
+        self.get_constraint(json_schema, regex)  # Compiled constraints are cached for generate_response
+        self.check_adapter(adapter)
+        
+        # Only first-turn base-model messages are cacheable; later turns depend on history
+        embedding = None
+        cached = None
+        if self.semantic_cache is not None and not self.conversation_history and not constrained \
+                and adapter is None:
+            embedding = self.embed([user_message])[0]
+            cached = self.semantic_cache.lookup(embedding)
+        
         # Add user message to history
         self.conversation_history.append({
             "role": "user",
@@ -217,7 +1051,12 @@ class ChatBot:
         })
         
         # Generate response
-        response = self.generate_response(user_message)
+        if cached is not None:
+            response = cached
+        else:
+            response = self.generate_response(user_message, json_schema=json_schema, regex=regex, adapter=adapter)
+            if embedding is not None and not response.startswith("Error generating response:"):
+                self.semantic_cache.add(user_message, embedding, response)
         
         # Add assistant response to history
         self.conversation_history.append({
@@ -227,11 +1066,98 @@ class ChatBot:
         
         return response
     
+    def warmup(self):
+        """Run a short generation so kernels and allocator pools are initialized"""
+        input_ids = self._tokenize_messages([{"role": "user", "content": "Hello"}])
+        if self.parallel is not None:
+            for _ in self._sample_parallel(input_ids, [{}], 8, TEMPERATURE, TOP_P):
+                pass
+            return
+        with torch.no_grad():
+            self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=8,
+                do_sample=False,
+                pad_token_id=self.tokenizer.eos_token_id,
+            )
+    
     def clear_history(self):
         """Clear conversation history"""
         self.conversation_history = []
+        with self._stream_lock:
+            self.stream_cache = None
+            self._stream_text = ""
+            if self._stream_spilled:
+                self.kv_store.delete(self._session_id)
+                self._stream_spilled = False
         print("Conversation history cleared.")
     
+    def close(self):
+        """Stop background workers that hold a reference to the model"""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.parallel is not None:
+            self.parallel.close()
+        self._spill_stop.set()
+        if self.kv_store is not None:
+            self.kv_store.delete(self._session_id)
+    
     def get_history(self) -> List[Dict[str, str]]:
         """Get current conversation history"""
         return self.conversation_history.copy()
+    
+    def get_memory_status(self) -> Dict[str, float]:
+        """Get memory budget and current headroom"""
+        return self.memory_budget.get_status()
+    
+    def get_pipeline_stats(self) -> Optional[Dict[str, Dict[str, float]]]:
+        """Get per-stage queue depths and timings (None if the pipeline is disabled)"""
+        if self.pipeline is None:
+            return None
+        return self.pipeline.get_stats()
+    
+    def get_streaming_stats(self) -> Optional[Dict[str, float]]:
+        """Get streaming-context cache size and eviction counts (None if the mode is off)"""
+        if not STREAMING_CONTEXT or self.parallel is not None:
+            return None
+        cache = self.stream_cache
+        if cache is None:
+            stats = {"cached_tokens": 0, "seen_tokens": 0, "evicted_tokens": 0, "kv_mb": 0.0}
+        else:
+            stats = {
+                "cached_tokens": cache.length,
+                "seen_tokens": cache.seen_tokens,
+                "evicted_tokens": cache.evicted_tokens,
+                "kv_mb": round(cache.nbytes() / 1024**2, 1),
+            }
+        if self.kv_store is not None:
+            stats["spilled"] = self._stream_spilled
+            stats["spill_store"] = self.kv_store.get_stats()
+        return stats
+    
+    def get_scheduler_stats(self) -> Optional[Dict[str, float]]:
+        """Get scheduler queue depth and per-step latency (None if chunked prefill is off)"""
+        if self.scheduler is None:
+            return None
+        return self.scheduler.get_stats()
+    
+    def get_parallel_stats(self) -> Optional[Dict]:
+        """Get the layer split and per-stage busy time (None if pipeline parallelism is off)"""
+        if self.parallel is None:
+            return None
+        return self.parallel.get_stats()
+    
+    def get_adapter_stats(self) -> Optional[Dict]:
+        """Get the session adapter and resident LoRA adapters (None if none are configured)"""
+        if self.adapters is None:
+            return None
+        return {"session": self.adapter, **self.adapters.get_stats()}
+    
+    def get_cache_stats(self) -> Optional[Dict[str, float]]:
+        """Get semantic cache metrics (None if the cache is disabled)"""
+        if self.semantic_cache is None:
+            return None
+        return self.semantic_cache.get_stats()
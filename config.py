@@ -37,6 +37,7 @@ MAX_NEW_TOKENS = 512
 TEMPERATURE = 0.7
 TOP_P = 0.9
 DO_SAMPLE = True
+MAX_COMPLETION_CHOICES = 8  # Largest `n` accepted by /v1/chat/completions
 
 # Chat configuration
 SYSTEM_PROMPT = "You are a helpful, harmless, and honest assistant."
@@ -46,3 +47,74 @@ MAX_HISTORY_LENGTH = 10  # Number of previous messages to keep in context
 LOAD_IN_8BIT = False
 LOAD_IN_4BIT = False
 TRUST_REMOTE_CODE = True
+
+# Memory budget for generation (KV cache + activations, on top of the model weights)
+# 0 = use whatever the device reports as available. Requests are shrunk (smaller batches,
+# fewer new tokens) to fit, and out-of-memory errors split the batch and retry.
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_SAFETY_FRACTION = 0.9  # Fraction of available memory considered usable
+
+# Staged generation pipeline: templating/tokenization and detokenization run in their own
+# worker threads, overlapping with the model's forward passes
+GENERATION_PIPELINE = os.getenv("GENERATION_PIPELINE", "false").lower() == "true"
+
+# Pipeline-parallel execution: split the decoder layers across this many local worker processes
+# (0 or 1 = off). Each stage loads only its own layers and runs on its own block of CPUs;
+# activations move between stages through shared memory, and prompt chunks and concurrent
+# requests flow through the stages back to back. Meant for CPU boxes; needs a safetensors checkpoint.
+PIPELINE_STAGES = int(os.getenv("PIPELINE_STAGES", "0"))
+PIPELINE_DTYPE = os.getenv("PIPELINE_DTYPE", "float32")  # e.g. "bfloat16" to halve stage memory
+PIPELINE_PREFILL_CHUNK = 256  # Prompt tokens per micro-batch
+
+# LoRA adapters served on top of the base model (requires peft)
+# Format: "support=/models/lora/support,sales=/models/lora/sales". Pick one per request with the
+# `adapter` field of /api/chat or the `model` field of /v1/chat/completions.
+LORA_ADAPTERS = {
+    name.strip(): path.strip()
+    for name, _, path in (item.partition("=") for item in os.getenv("LORA_ADAPTERS", "").split(","))
+    if name.strip() and path.strip()
+}
+MAX_RESIDENT_ADAPTERS = int(os.getenv("MAX_RESIDENT_ADAPTERS", "4"))  # Least recently used are unloaded
+
+# Chunked prefill: one scheduler thread owns the model and interleaves requests step by step.
+# Each step decodes one token for every running sequence, then spends the rest of the token
+# budget on prefill chunks of newly arrived prompts, so a long prompt no longer stalls the
+# streams already running. Takes precedence over GENERATION_PIPELINE.
+CHUNKED_PREFILL = os.getenv("CHUNKED_PREFILL", "false").lower() == "true"
+SCHEDULER_TOKEN_BUDGET = int(os.getenv("SCHEDULER_TOKEN_BUDGET", "512"))  # Tokens per model step
+SCHEDULER_MIN_PREFILL_CHUNK = 32  # Prompt tokens prefilled per step even when decoding uses the budget
+SCHEDULER_MAX_SEQUENCES = 16  # Sequences decoded concurrently (also limited by the memory budget)
+
+# Streaming context: instead of re-prefilling (and truncating) the history every turn, keep the
+# conversation's KV cache as the system prompt ("attention sinks") plus a rolling window of recent
+# tokens, evicting the middle. Memory and per-token latency stay flat for arbitrarily long chats.
+STREAMING_CONTEXT = os.getenv("STREAMING_CONTEXT", "false").lower() == "true"
+ATTENTION_SINK_TOKENS = 4  # Minimum number of leading tokens always kept
+STREAMING_WINDOW_TOKENS = int(os.getenv("STREAMING_WINDOW_TOKENS", "2048"))  # Recent tokens kept
+STREAMING_PREFILL_CHUNK = 512  # New-turn tokens prefilled per forward pass
+# With a spill directory, a conversation's streaming cache that sits idle is written to a
+# memory-mapped file store and freed; the next turn maps it back instead of re-prefilling.
+# Only used with STREAMING_CONTEXT. Entries from earlier runs are deleted at startup.
+KV_SPILL_PATH = os.getenv("KV_SPILL_PATH", None)  # e.g. "./cache/kv" to enable
+KV_SPILL_IDLE_SECONDS = max(1.0, float(os.getenv("KV_SPILL_IDLE_SECONDS", "120")))  # At least 1s
+KV_SPILL_QUOTA_MB = float(os.getenv("KV_SPILL_QUOTA_MB", "4096"))  # Least recently used entries go first
+KV_SPILL_COMPRESS = os.getenv("KV_SPILL_COMPRESS", "false").lower() == "true"  # zlib: less disk, slower
+
+# Semantic response cache
+# Reuses replies for first-turn questions that are near-duplicates of earlier ones.
+# Requires SEMANTIC_CACHE_EMBEDDING_MODEL: a (small) sentence-embedding model, e.g.
+# "sentence-transformers/all-MiniLM-L6-v2". The cache stays off without it.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Cosine similarity
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1024"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", None)  # e.g. "./cache/semantic" to persist
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", None)
+
+# Admin / debug endpoints (/debug/profile, ...)
+# Requests must send "Authorization: Bearer <ADMIN_TOKEN>". Endpoints are disabled when unset.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# On-demand profiling
+PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", "./profiles")  # Chrome traces and folded stacks
+PROFILE_MAX_SECONDS = 300  # Upper bound on any profiling session
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between Python stack samples
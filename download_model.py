@@ -1,66 +1,348 @@
 #!/usr/bin/env python3
 """
 Script to download and save a model locally for VPS deployment
+
+Files are fetched straight from the Hub's HTTP endpoints: large files are
+split into ranges that download concurrently, progress is kept next to each
+file (`<file>.part` plus `<file>.part.json`) so an interrupted download
+resumes where it stopped, and every file is hashed while it downloads and
+checked against the repo's SHA256 (LFS files) or git blob id (small files).
+Files that are already present (e.g. from an older download) are hashed once
+too; verified files are recorded in `.download_verified.json` so later runs
+skip them. No model is loaded to verify the result.
 """
+import argparse
+import hashlib
+import json
 import os
 import sys
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from huggingface_hub import snapshot_download
-import argparse
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+DEFAULT_ENDPOINT = os.getenv("HF_ENDPOINT", "https://huggingface.co")
+BLOCK_SIZE = 1024 * 1024  # Read/hash granularity
+MAX_ATTEMPTS = 4
+VERIFIED_FILE = ".download_verified.json"  # name -> hash of every file checked so far
+
+
+def _token() -> Optional[str]:
+    return os.getenv("HF_TOKEN") or os.getenv("HUGGING_FACE_HUB_TOKEN")
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects, but never sends the token on to another host (CDN, mirror target)"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_request = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new_request is not None and \
+                urllib.parse.urlsplit(newurl).netloc != urllib.parse.urlsplit(req.full_url).netloc:
+            new_request.remove_header("Authorization")
+        return new_request
+
+
+_OPENER = urllib.request.build_opener(_RedirectHandler)
+
+
+def _open(url: str, start: Optional[int] = None, end: Optional[int] = None, timeout: float = 60):
+    """GET a URL, optionally a byte range [start, end]"""
+    headers = {"User-Agent": "gpt4o-download-model"}
+    token = _token()
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    if start is not None:
+        headers["Range"] = f"bytes={start}-{end}"
+    return _OPENER.open(urllib.request.Request(url, headers=headers), timeout=timeout)
+
+
+def list_files(endpoint: str, model_name: str, revision: str) -> List[Dict]:
+    """Files of a model repo with their sizes and expected hashes"""
+    url = (f"{endpoint}/api/models/{model_name}/revision/{urllib.parse.quote(revision, safe='')}"
+           "?blobs=true")
+    with _open(url) as response:
+        info = json.load(response)
+    files = []
+    for sibling in info.get("siblings", []):
+        lfs = sibling.get("lfs")
+        files.append({
+            "name": sibling["rfilename"],
+            "size": lfs["size"] if lfs else sibling.get("size"),
+            "sha256": lfs["sha256"] if lfs else None,
+            "git_sha1": None if lfs else sibling.get("blobId"),
+        })
+    return files
+
+
+def _new_hasher(entry: Dict):
+    """Hasher for a file's expected digest: SHA256 for LFS files, else the git blob id"""
+    if entry["sha256"]:
+        return hashlib.sha256()
+    hasher = hashlib.sha1()
+    hasher.update(f"blob {entry['size']}\0".encode())
+    return hasher
+
+
+def _file_digest(path: str, entry: Dict) -> str:
+    hasher = _new_hasher(entry)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _load_verified(local_path: str) -> Dict[str, Optional[str]]:
+    try:
+        with open(os.path.join(local_path, VERIFIED_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_verified(local_path: str, verified: Dict[str, Optional[str]]):
+    path = os.path.join(local_path, VERIFIED_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(verified, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+class Progress:
+    """Thread-safe byte counter with a periodic throughput report"""
+
+    def __init__(self, total: int, resumed: int):
+        self.total = total
+        self.done = resumed
+        self.resumed = resumed
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, n: int):
+        with self._lock:
+            self.done += n
+
+    def line(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-6)
+        rate = (self.done - self.resumed) / elapsed
+        remaining = (self.total - self.done) / rate if rate > 0 else float("inf")
+        eta = f"{remaining:.0f}s" if remaining != float("inf") else "?"
+        percent = 100 * self.done / self.total if self.total else 100.0
+        return (f"{self.done / 1024**2:,.0f}/{self.total / 1024**2:,.0f} MB ({percent:.1f}%) "
+                f"at {rate / 1024**2:.1f} MB/s, ETA {eta}")
+
+    def report(self, interval: float = 2.0):
+        while not self._stopped.wait(interval):
+            print(f"  {self.line()}", flush=True)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class FileDownload:
+    """One file split into fixed-size parts; the parts done so far survive restarts"""
+
+    def __init__(self, entry: Dict, local_path: str, chunk_size: int):
+        self.entry = entry
+        self.size = entry["size"]
+        self.path = os.path.join(local_path, *entry["name"].split("/"))
+        self.part_path = self.path + ".part"
+        self.state_path = self.path + ".part.json"
+        self.chunk_size = chunk_size
+        self.num_parts = max(1, -(-self.size // chunk_size))
+        self.expected = entry["sha256"] or entry["git_sha1"]
+        self._lock = threading.Lock()
 
-def download_model(model_name, local_path, use_local_files_only=False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.done = set()
+        state = self._load_state()
+        if state is not None and os.path.exists(self.part_path):
+            self.done = set(state["done"])
+        else:
+            with open(self.part_path, "wb") as f:
+                f.truncate(self.size)
+
+        # Parts are hashed in order as soon as the ones before them are done
+        self.hasher = _new_hasher(entry)
+        self.hashed = 0
+
+    def _load_state(self) -> Optional[Dict]:
+        """Saved progress, if it is for this exact file version and part size"""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (state.get("size"), state.get("hash"), state.get("chunk_size")) != \
+                (self.size, self.expected, self.chunk_size):
+            return None
+        return state
+
+    def _save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"size": self.size, "hash": self.expected, "chunk_size": self.chunk_size,
+                       "done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def part_range(self, index: int):
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size) - 1
+
+    def pending(self) -> List[int]:
+        return [i for i in range(self.num_parts) if i not in self.done]
+
+    def resumed_bytes(self) -> int:
+        return sum(self.part_range(i)[1] - self.part_range(i)[0] + 1 for i in self.done)
+
+    def download_part(self, url: str, index: int, progress: Progress) -> bool:
+        """Fetch one part (with retries); returns True when the whole file is finished"""
+        start, end = self.part_range(index)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            written = 0
+            try:
+                with _open(url, start, end) as response, open(self.part_path, "r+b") as f:
+                    if response.status != 206 and (start != 0 or end != self.size - 1):
+                        raise RuntimeError("server ignored the range request")
+                    f.seek(start)
+                    while written < end - start + 1:
+                        block = response.read(min(BLOCK_SIZE, end - start + 1 - written))
+                        if not block:
+                            raise RuntimeError(f"connection closed after {written} of {end - start + 1} bytes")
+                        f.write(block)
+                        written += len(block)
+                        progress.add(len(block))
+                    f.flush()
+                    os.fsync(f.fileno())
+                break
+            except Exception as e:
+                progress.add(-written)
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                print(f"  Retrying {self.entry['name']} bytes {start}-{end} ({e})", flush=True)
+                time.sleep(2 ** attempt)
+        return self._complete(index)
+
+    def _complete(self, index: int) -> bool:
+        with self._lock:
+            self.done.add(index)
+            self._save_state()
+            with open(self.part_path, "rb") as f:
+                while self.hashed in self.done:
+                    start, end = self.part_range(self.hashed)
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        block = f.read(min(BLOCK_SIZE, remaining))
+                        self.hasher.update(block)
+                        remaining -= len(block)
+                    self.hashed += 1
+            if self.hashed < self.num_parts:
+                return False
+            self._finish()
+            return True
+
+    def _finish(self):
+        digest = self.hasher.hexdigest()
+        if self.expected and digest != self.expected:
+            os.remove(self.part_path)
+            os.remove(self.state_path)
+            raise ValueError(f"{self.entry['name']}: checksum mismatch (expected {self.expected}, got {digest})")
+        os.replace(self.part_path, self.path)
+        os.remove(self.state_path)
+
+
+def download_model(model_name, local_path, workers: int = 8, chunk_size_mb: int = 64,
+                   endpoint: str = DEFAULT_ENDPOINT, revision: str = "main"):
     """
     Download a model from Hugging Face and save it locally
-    
+
     Args:
         model_name: Hugging Face model identifier (e.g., "Qwen/Qwen2.5-7B-Instruct")
         local_path: Local directory path to save the model
-        use_local_files_only: If True, only use local files (for offline mode)
+        workers: Number of concurrent range downloads
+        chunk_size_mb: Size of each range (and the unit of resume) in MB
+        endpoint: Hub URL (or a compatible mirror / local stand-in server)
+        revision: Branch, tag or commit to download
     """
     print("=" * 60)
     print(f"Downloading Model: {model_name}")
     print(f"Local Path: {local_path}")
     print("=" * 60)
-    
+
     # Create directory if it doesn't exist
     os.makedirs(local_path, exist_ok=True)
-    
+
     try:
-        print("\n[1/3] Downloading model files...")
-        # Download all model files
-        snapshot_download(
-            repo_id=model_name,
-            local_dir=local_path,
-            local_dir_use_symlinks=False,
-            resume_download=True
-        )
-        print("✓ Model files downloaded successfully!")
-        
-        print("\n[2/3] Verifying tokenizer...")
-        # Test loading tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(
-            local_path,
-            trust_remote_code=True
-        )
-        print("✓ Tokenizer verified!")
-        
-        print("\n[3/3] Verifying model (this may take a moment)...")
-        # Test loading model (this will verify all files are correct)
-        # We'll load with low memory to just verify, not fully load
+        print("\n[1/2] Listing model files...")
+        files = list_files(endpoint, model_name, revision)
+        verified = _load_verified(local_path)
+        todo = []
+        for entry in files:
+            path = os.path.join(local_path, *entry["name"].split("/"))
+            expected = entry["sha256"] or entry["git_sha1"]
+            if os.path.exists(path) and os.path.getsize(path) == entry["size"]:
+                if entry["name"] in verified and verified[entry["name"]] == expected:
+                    continue  # Verified by an earlier run
+                # Left by an older download or an interrupted run: hash it once
+                if expected is None or _file_digest(path, entry) == expected:
+                    verified[entry["name"]] = expected
+                    continue
+                print(f"  {entry['name']}: existing file does not match its checksum, downloading again")
+            verified.pop(entry["name"], None)
+            if entry["size"] == 0:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "wb").close()
+                verified[entry["name"]] = expected
+                continue
+            todo.append(FileDownload(entry, local_path, chunk_size_mb * 1024**2))
+        _save_verified(local_path, verified)
+        print(f"✓ {len(files)} files, {len(todo)} to download")
+
+        print(f"\n[2/2] Downloading with {workers} workers (files are verified as they arrive)...")
+        progress = Progress(sum(d.size for d in todo), sum(d.resumed_bytes() for d in todo))
+        if progress.resumed:
+            print(f"  Resuming: {progress.resumed / 1024**2:,.0f} MB already downloaded")
+        reporter = threading.Thread(target=progress.report, daemon=True)
+        reporter.start()
+
+        failed = []
         try:
-            model = AutoModelForCausalLM.from_pretrained(
-                local_path,
-                trust_remote_code=True,
-                torch_dtype="auto",
-                low_cpu_mem_usage=True
-            )
-            print("✓ Model verified!")
-            del model  # Free memory
-        except Exception as e:
-            print(f"⚠ Model verification had issues (may be normal): {e}")
-            print("  Model files are downloaded, but full verification failed.")
-            print("  This might be due to memory constraints. Files should still work.")
-        
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                # Largest files first so the long downloads start early
+                for download in sorted(todo, key=lambda d: -d.size):
+                    url = (f"{endpoint}/{model_name}/resolve/{urllib.parse.quote(revision, safe='')}/"
+                           f"{urllib.parse.quote(download.entry['name'])}")
+                    if not download.pending():
+                        # Every part was done but the run stopped before the final hash
+                        download.done.discard(download.num_parts - 1)
+                    for index in download.pending():
+                        futures[executor.submit(download.download_part, url, index, progress)] = download
+                for future in as_completed(futures):
+                    download = futures[future]
+                    try:
+                        if future.result():
+                            verified[download.entry["name"]] = download.expected
+                            _save_verified(local_path, verified)
+                            print(f"  ✓ {download.entry['name']}", flush=True)
+                    except Exception as e:
+                        if download not in failed:
+                            failed.append(download)
+                            print(f"  ✗ {download.entry['name']}: {e}", flush=True)
+        finally:
+            progress.stop()
+
+        elapsed = time.perf_counter() - progress.start
+        downloaded = progress.done - progress.resumed
+        print(f"  {downloaded / 1024**2:,.0f} MB in {elapsed:.1f}s "
+              f"({downloaded / 1024**2 / max(elapsed, 1e-6):.1f} MB/s)")
+        if failed:
+            raise RuntimeError(f"{len(failed)} file(s) failed; run again to resume: "
+                               + ", ".join(d.entry["name"] for d in failed))
+        print("✓ All files downloaded and verified!")
+
         print("\n" + "=" * 60)
         print("Download Complete!")
         print("=" * 60)
@@ -70,14 +352,15 @@ def download_model(model_name, local_path, use_local_files_only=False):
         print(f"\nOr set environment variable:")
         print(f'  export LOCAL_MODEL_PATH="{local_path}"')
         print("\n" + "=" * 60)
-        
+
     except Exception as e:
         print(f"\n✗ Error downloading model: {e}")
         print("\nTroubleshooting:")
         print("1. Check your internet connection")
         print("2. Verify the model name is correct")
         print("3. Check disk space (models can be 10-50GB+)")
-        print("4. Ensure you have Hugging Face access (some models require login)")
+        print("4. Ensure you have Hugging Face access (some models require login: export HF_TOKEN=...)")
+        print("5. Run the same command again: finished parts are kept and the download resumes")
         sys.exit(1)
 
 
@@ -101,9 +384,33 @@ def main():
         default=None,
         help="Custom name for model directory (default: uses model name)"
     )
-    
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Concurrent range downloads (default: 8)"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        help="Range size in MB; also how much an interrupted download can lose (default: 64)"
+    )
+    parser.add_argument(
+        "--endpoint",
+        type=str,
+        default=DEFAULT_ENDPOINT,
+        help="Hub URL, e.g. a mirror or a local test server (default: $HF_ENDPOINT or huggingface.co)"
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default="main",
+        help="Branch, tag or commit to download (default: main)"
+    )
+
     args = parser.parse_args()
-    
+
     # Determine local path
     if args.name:
         local_path = os.path.join(args.path, args.name)
@@ -111,11 +418,12 @@ def main():
         # Use model name as directory name
         model_dir_name = args.model.replace("/", "_")
         local_path = os.path.join(args.path, model_dir_name)
-    
+
     # Convert to absolute path
     local_path = os.path.abspath(local_path)
-    
-    download_model(args.model, local_path)
+
+    download_model(args.model, local_path, workers=args.workers, chunk_size_mb=args.chunk_size,
+                   endpoint=args.endpoint.rstrip("/"), revision=args.revision)
 
 
 if __name__ == "__main__":
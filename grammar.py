@@ -0,0 +1,583 @@
+"""
+Grammar-constrained decoding - JSON schema / regex to token-level automata
+
+A JSON schema is first translated to a regular expression, which is compiled
+to an NFA and then determinized lazily (DFA states are created the first time
+they are reached). For every DFA state, the set of vocabulary tokens whose
+text keeps the automaton alive is computed once and cached, so constraining a
+decode step is just a lookup plus a logits mask.
+
+Compiled constraints are cached per tokenizer and per schema/regex.
+"""
+import json
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import torch
+
+
+# ---------------------------------------------------------------------------
+# Regular expressions
+# ---------------------------------------------------------------------------
+
+class CharSet:
+    """A set of characters given as inclusive code point ranges (optionally negated)"""
+
+    def __init__(self, ranges: List[Tuple[int, int]], negated: bool = False):
+        self.ranges = ranges
+        self.negated = negated
+
+    def matches(self, ch: str) -> bool:
+        code = ord(ch)
+        inside = any(lo <= code <= hi for lo, hi in self.ranges)
+        return inside != self.negated
+
+
+_CLASS_ESCAPES = {
+    "d": [(ord("0"), ord("9"))],
+    "w": [(ord("a"), ord("z")), (ord("A"), ord("Z")), (ord("0"), ord("9")), (ord("_"), ord("_"))],
+    "s": [(ord(c), ord(c)) for c in " \t\n\r\f\v"],
+}
+_CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v"}
+_META_CHARS = set("\\.^$|?*+()[]{}")
+_HEX_DIGITS = set("0123456789abcdefABCDEF")
+
+# Limits on client-supplied constraints: every repetition is unrolled into NFA states
+MAX_REPEAT = 1000  # Largest m / n accepted in {m}, {m,} and {m,n}
+MAX_NFA_STATES = 100_000
+
+
+def escape_regex(text: str) -> str:
+    """Escape regex metacharacters so `text` matches literally"""
+    return "".join("\\" + ch if ch in _META_CHARS else ch for ch in text)
+
+
+class _RegexParser:
+    """Parses the supported regex subset into a small AST.
+
+    Supported: literals, escapes (\\d \\w \\s and negations, \\n, \\uXXXX, ...),
+    character classes with ranges and negation, `.`, groups `(...)`/`(?:...)`,
+    alternation and the quantifiers * + ? {m} {m,} {m,n} (bounds up to
+    MAX_REPEAT). The whole output must match, so leading ^ and trailing $ are
+    accepted and ignored. Anything else raises ValueError.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos != len(self.pattern):
+            raise ValueError(f"Unexpected '{self.pattern[self.pos]}' at position {self.pos} in regex")
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            raise ValueError("Unexpected end of regex")
+        ch = self.pattern[self.pos]
+        self.pos += 1
+        return ch
+
+    def _alternation(self):
+        branches = [self._concatenation()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concatenation())
+        return ("alt", branches) if len(branches) > 1 else branches[0]
+
+    def _concatenation(self):
+        items = []
+        while self._peek() is not None and self._peek() not in "|)":
+            items.append(self._repeat())
+        return ("cat", items)
+
+    def _repeat(self):
+        node = self._atom()
+        while True:
+            ch = self._peek()
+            if ch == "*":
+                node, self.pos = ("rep", node, 0, None), self.pos + 1
+            elif ch == "+":
+                node, self.pos = ("rep", node, 1, None), self.pos + 1
+            elif ch == "?":
+                node, self.pos = ("rep", node, 0, 1), self.pos + 1
+            elif ch == "{":
+                end = self.pattern.find("}", self.pos)
+                bounds = re.fullmatch(r"([0-9]*)(?:,([0-9]*))?", self.pattern[self.pos + 1:end]) \
+                    if end != -1 else None
+                if bounds is None or not bounds.group(0).strip(","):
+                    raise ValueError(f"Invalid repetition at position {self.pos} in regex")
+                low = int(bounds.group(1) or 0)
+                high = low if bounds.group(2) is None else (int(bounds.group(2)) if bounds.group(2) else None)
+                if max(low, high or 0) > MAX_REPEAT:
+                    raise ValueError(f"Repetition counts above {MAX_REPEAT} are not supported")
+                if high is not None and high < low:
+                    raise ValueError(f"Repetition {{{low},{high}}} has its bounds out of order")
+                node, self.pos = ("rep", node, low, high), end + 1
+            else:
+                return node
+            if self._peek() == "?":  # Lazy quantifiers match the same language
+                self.pos += 1
+
+    def _atom(self):
+        ch = self._next()
+        if ch == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            node = self._alternation()
+            if self._next() != ")":
+                raise ValueError("Unbalanced parenthesis in regex")
+            return node
+        if ch == "[":
+            return ("set", self._char_class())
+        if ch == ".":
+            return ("set", CharSet([(ord("\n"), ord("\n"))], negated=True))
+        if ch == "\\":
+            return ("set", self._escape())
+        if ch in "^$":
+            return ("cat", [])
+        return ("set", CharSet([(ord(ch), ord(ch))]))
+
+    def _escape(self) -> CharSet:
+        ch = self._next()
+        if ch.lower() in _CLASS_ESCAPES:
+            return CharSet(_CLASS_ESCAPES[ch.lower()], negated=ch.isupper())
+        if ch in _CHAR_ESCAPES:
+            code = ord(_CHAR_ESCAPES[ch])
+        elif ch in "ux":
+            width = 4 if ch == "u" else 2
+            digits = self.pattern[self.pos:self.pos + width]
+            if len(digits) != width or not set(digits) <= _HEX_DIGITS:
+                raise ValueError(f"\\{ch} needs {width} hex digits in regex")
+            code = int(digits, 16)
+            self.pos += width
+        else:
+            code = ord(ch)
+        return CharSet([(code, code)])
+
+    def _char_class(self) -> CharSet:
+        negated = self._peek() == "^"
+        if negated:
+            self.pos += 1
+        ranges = []
+        first = True
+        while True:
+            ch = self._next()
+            if ch == "]" and not first:
+                break
+            first = False
+            if ch == "\\":
+                escaped = self._escape()
+                if escaped.negated:
+                    raise ValueError("Negated escapes are not supported inside character classes")
+                if len(escaped.ranges) > 1 or escaped.ranges[0][0] != escaped.ranges[0][1]:
+                    ranges.extend(escaped.ranges)  # \d, \w, \s cannot start a range
+                    continue
+                low = escaped.ranges[0][0]
+            else:
+                low = ord(ch)
+            if self._peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                high_ch = self._next()
+                if high_ch == "\\":
+                    escaped = self._escape()
+                    if escaped.negated or len(escaped.ranges) > 1 or escaped.ranges[0][0] != escaped.ranges[0][1]:
+                        raise ValueError("A character class cannot end a range")
+                    high = escaped.ranges[0][0]
+                else:
+                    high = ord(high_ch)
+                if high < low:
+                    raise ValueError(f"Character range {chr(low)}-{chr(high)} is out of order")
+                ranges.append((low, high))
+            else:
+                ranges.append((low, low))
+        return CharSet(ranges, negated)
+
+
+class RegexDFA:
+    """Thompson NFA for a regex, determinized lazily one character at a time"""
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self._transitions: List[List[Tuple[Optional[CharSet], int]]] = []
+        try:
+            start, self._accept = self._compile(_RegexParser(pattern).parse())
+        except RecursionError:
+            raise ValueError("Regex is nested too deeply") from None
+
+        self._states: List[FrozenSet[int]] = []
+        self._ids: Dict[FrozenSet[int], int] = {}
+        self._steps: Dict[Tuple[int, str], Optional[int]] = {}
+        self.initial = self._intern(self._closure({start}))
+
+    def _new_state(self) -> int:
+        if len(self._transitions) >= MAX_NFA_STATES:
+            raise ValueError(f"Regex is too large (more than {MAX_NFA_STATES} automaton states)")
+        self._transitions.append([])
+        return len(self._transitions) - 1
+
+    def _compile(self, node) -> Tuple[int, int]:
+        """Build an NFA fragment for an AST node, returning (start, end) states"""
+        kind = node[0]
+        start = self._new_state()
+        if kind == "set":
+            end = self._new_state()
+            self._transitions[start].append((node[1], end))
+            return start, end
+        if kind == "cat":
+            current = start
+            for item in node[1]:
+                item_start, item_end = self._compile(item)
+                self._transitions[current].append((None, item_start))
+                current = item_end
+            return start, current
+        if kind == "alt":
+            end = self._new_state()
+            for branch in node[1]:
+                branch_start, branch_end = self._compile(branch)
+                self._transitions[start].append((None, branch_start))
+                self._transitions[branch_end].append((None, end))
+            return start, end
+
+        _, child, low, high = node
+        current = start
+        for _ in range(low):
+            child_start, child_end = self._compile(child)
+            self._transitions[current].append((None, child_start))
+            current = child_end
+        if high is None:
+            loop = self._new_state()
+            child_start, child_end = self._compile(child)
+            self._transitions[current].append((None, loop))
+            self._transitions[loop].append((None, child_start))
+            self._transitions[child_end].append((None, loop))
+            return start, loop
+        end = self._new_state()
+        for _ in range(high - low):
+            child_start, child_end = self._compile(child)
+            self._transitions[current].append((None, end))
+            self._transitions[current].append((None, child_start))
+            current = child_end
+        self._transitions[current].append((None, end))
+        return start, end
+
+    def _closure(self, states) -> FrozenSet[int]:
+        stack = list(states)
+        seen = set(states)
+        while stack:
+            state = stack.pop()
+            for charset, target in self._transitions[state]:
+                if charset is None and target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+    def _intern(self, states: FrozenSet[int]) -> int:
+        if states not in self._ids:
+            self._ids[states] = len(self._states)
+            self._states.append(states)
+        return self._ids[states]
+
+    def step(self, state: int, ch: str) -> Optional[int]:
+        """DFA transition on one character (None = no match possible)"""
+        key = (state, ch)
+        if key not in self._steps:
+            targets = {
+                target
+                for nfa_state in self._states[state]
+                for charset, target in self._transitions[nfa_state]
+                if charset is not None and charset.matches(ch)
+            }
+            self._steps[key] = self._intern(self._closure(targets)) if targets else None
+        return self._steps[key]
+
+    def walk(self, state: int, text: str) -> Optional[int]:
+        """Run the DFA over a whole string"""
+        for ch in text:
+            state = self.step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def is_accepting(self, state: int) -> bool:
+        return self._accept in self._states[state]
+
+
+# ---------------------------------------------------------------------------
+# JSON schema -> regex
+# ---------------------------------------------------------------------------
+
+_WS = r"[ \n]?"
+_STRING = r'"([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+_INTEGER = r"-?(0|[1-9][0-9]*)"
+_NUMBER = _INTEGER + r"(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+_LITERALS = {"boolean": "(true|false)", "null": "null", "integer": _INTEGER, "number": _NUMBER}
+
+
+def _any_value_regex(depth: int) -> str:
+    """Regex for any JSON value, nesting objects/arrays at most `depth` levels"""
+    scalars = [_STRING, _NUMBER, "true", "false", "null"]
+    if depth > 0:
+        inner = _any_value_regex(depth - 1)
+        member = _STRING + _WS + ":" + _WS + inner
+        scalars.append(r"\{" + _WS + f"({member}({_WS},{_WS}{member})*)?" + _WS + r"\}")
+        scalars.append(r"\[" + _WS + f"({inner}({_WS},{_WS}{inner})*)?" + _WS + r"\]")
+    return "(" + "|".join(scalars) + ")"
+
+
+def _is_count(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def schema_to_regex(schema: Dict, depth: int = 2) -> str:
+    """Translate a JSON schema into a regex matching conforming JSON text.
+
+    Supports type (incl. lists), properties, items, enum, const, anyOf/oneOf,
+    string pattern/minLength/maxLength and `true` sub-schemas. Object
+    properties are always emitted, in declaration order; schemas without
+    properties accept any object of limited nesting depth. A maxLength above
+    MAX_REPEAT leaves the length unbounded. Malformed or unsupported schemas
+    raise ValueError.
+    """
+    try:
+        return _schema_regex(schema, depth)
+    except RecursionError:
+        raise ValueError("JSON schema is nested too deeply") from None
+
+
+def _schema_regex(schema, depth: int) -> str:
+    if schema is True:
+        return _any_value_regex(depth)
+    if not isinstance(schema, dict):
+        raise ValueError(f"Unsupported schema: {json.dumps(schema)[:100]}")
+    if not schema:
+        return _any_value_regex(depth)
+    if "const" in schema:
+        return escape_regex(json.dumps(schema["const"]))
+    if "enum" in schema:
+        if not isinstance(schema["enum"], list) or not schema["enum"]:
+            raise ValueError("enum must be a non-empty list")
+        return "(" + "|".join(escape_regex(json.dumps(v)) for v in schema["enum"]) + ")"
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            if not isinstance(schema[key], list) or not schema[key]:
+                raise ValueError(f"{key} must be a non-empty list")
+            return "(" + "|".join(_schema_regex(s, depth) for s in schema[key]) + ")"
+
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        if not schema_type:
+            raise ValueError("type must not be an empty list")
+        return "(" + "|".join(_schema_regex({**schema, "type": t}, depth) for t in schema_type) + ")"
+    if schema_type is not None and not isinstance(schema_type, str):
+        raise ValueError("type must be a string or a list of strings")
+    if schema_type in _LITERALS:
+        return _LITERALS[schema_type]
+    if schema_type == "string":
+        if "pattern" in schema:
+            if not isinstance(schema["pattern"], str):
+                raise ValueError("pattern must be a string")
+            return '"' + schema["pattern"].lstrip("^").rstrip("$") + '"'
+        if "minLength" in schema or "maxLength" in schema:
+            low = schema.get("minLength", 0)
+            high = schema.get("maxLength", "")
+            if not _is_count(low) or not (high == "" or _is_count(high)):
+                raise ValueError("minLength and maxLength must be non-negative integers")
+            if high != "" and high > MAX_REPEAT:
+                high = ""
+            return r'"([^"\\\x00-\x1f]|\\["\\/bfnrt]){' + f"{low},{high}" + '}"'
+        return _STRING
+    if schema_type == "array":
+        if isinstance(schema.get("items"), list):
+            raise ValueError("Tuple-form items (a list of schemas) is not supported")
+        item = _schema_regex(schema.get("items", {}), max(depth - 1, 0))
+        return r"\[" + _WS + f"({item}({_WS},{_WS}{item})*)?" + _WS + r"\]"
+    if schema_type == "object" and schema.get("properties"):
+        if not isinstance(schema["properties"], dict):
+            raise ValueError("properties must be an object")
+        members = [
+            escape_regex(json.dumps(name)) + _WS + ":" + _WS + _schema_regex(prop, max(depth - 1, 0))
+            for name, prop in schema["properties"].items()
+        ]
+        return r"\{" + _WS + f"{_WS},{_WS}".join(members) + _WS + r"\}"
+    if schema_type == "object":
+        member = _STRING + _WS + ":" + _WS + _any_value_regex(max(depth - 1, 0))
+        return r"\{" + _WS + f"({member}({_WS},{_WS}{member})*)?" + _WS + r"\}"
+    return _any_value_regex(depth)
+
+
+# ---------------------------------------------------------------------------
+# Token-level automaton
+# ---------------------------------------------------------------------------
+
+def token_vocabulary(tokenizer) -> List[Tuple[int, str]]:
+    """(token id, text) for every non-special token that decodes to complete characters"""
+    special_ids = set(tokenizer.all_special_ids)
+    vocabulary = []
+    for token_id in range(len(tokenizer)):
+        if token_id in special_ids:
+            continue
+        token = tokenizer.convert_ids_to_tokens(token_id)
+        if token is None:
+            continue
+        text = tokenizer.convert_tokens_to_string([token])
+        # SentencePiece drops the word-boundary space when decoding a lone token
+        if token.startswith("\u2581") and not text.startswith(" "):
+            text = " " + text
+        if text and "\ufffd" not in text:
+            vocabulary.append((token_id, text))
+    return vocabulary
+
+
+class TokenFSM:
+    """Token-level view of a RegexDFA over a tokenizer vocabulary.
+
+    For each DFA state the allowed tokens (and the state each one leads to)
+    are computed on first use and cached, together with a device tensor of
+    allowed ids used to mask logits.
+    """
+
+    def __init__(self, dfa: RegexDFA, vocabulary: List[Tuple[int, str]], eos_token_id: int):
+        self.dfa = dfa
+        self.eos_token_id = eos_token_id
+        self.initial_state = dfa.initial
+        self._by_first_char: Dict[str, List[Tuple[int, str]]] = {}
+        for token_id, text in vocabulary:
+            self._by_first_char.setdefault(text[0], []).append((token_id, text))
+        self._next: Dict[int, Dict[int, int]] = {}
+        self._allowed: Dict[Tuple[int, str], torch.Tensor] = {}
+        self._lock = threading.Lock()
+
+    def transitions(self, state: int) -> Dict[int, int]:
+        """Map of allowed token id -> next DFA state"""
+        if state not in self._next:
+            with self._lock:
+                if state not in self._next:
+                    table = {}
+                    for first_char, tokens in self._by_first_char.items():
+                        if self.dfa.step(state, first_char) is None:
+                            continue
+                        for token_id, text in tokens:
+                            target = self.dfa.walk(state, text)
+                            if target is not None:
+                                table[token_id] = target
+                    self._next[state] = table
+        return self._next[state]
+
+    def allowed_ids(self, state: Optional[int], device) -> torch.Tensor:
+        """Tensor of token ids allowed in `state` (None = finished, only EOS)"""
+        key = (state, str(device))
+        if key not in self._allowed:
+            if state is None:
+                ids = [self.eos_token_id]
+            else:
+                ids = list(self.transitions(state))
+                # EOS when the text is complete, or as an escape hatch at a dead end
+                if self.dfa.is_accepting(state) or not ids:
+                    ids.append(self.eos_token_id)
+            self._allowed[key] = torch.tensor(ids, dtype=torch.long, device=device)
+        return self._allowed[key]
+
+    def next_state(self, state: Optional[int], token_id: int) -> Optional[int]:
+        if state is None or token_id == self.eos_token_id:
+            return None
+        return self.transitions(state).get(token_id)
+
+
+class ConstrainedLogitsProcessor:
+    """Masks logits so each batch row stays inside the constraint automaton.
+
+    Usable as a transformers logits processor (it infers the newest tokens
+    from `input_ids`) or driven directly with advance()/apply().
+    """
+
+    def __init__(self, fsm: TokenFSM, batch_size: int = 1):
+        self.fsm = fsm
+        self.states: List[Optional[int]] = [fsm.initial_state] * batch_size
+        self._seen_length: Optional[int] = None
+        self.mask_seconds = 0.0
+        self.steps = 0
+
+    def advance(self, row: int, token_id: int):
+        """Move a row's automaton past a generated token"""
+        self.states[row] = self.fsm.next_state(self.states[row], token_id)
+
+    def apply(self, scores: torch.Tensor) -> torch.Tensor:
+        """Set the logits of every disallowed token to -inf"""
+        start = time.perf_counter()
+        masked = torch.full_like(scores, float("-inf"))
+        for row, state in enumerate(self.states):
+            ids = self.fsm.allowed_ids(state, scores.device)
+            masked[row, ids] = scores[row, ids]
+        self.mask_seconds += time.perf_counter() - start
+        self.steps += 1
+        return masked
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
+        if self._seen_length is None:
+            self._seen_length = input_ids.shape[1]  # The prompt
+            if len(self.states) != input_ids.shape[0]:
+                self.states = [self.fsm.initial_state] * input_ids.shape[0]
+        for position in range(self._seen_length, input_ids.shape[1]):
+            for row in range(input_ids.shape[0]):
+                self.advance(row, int(input_ids[row, position]))
+        self._seen_length = input_ids.shape[1]
+        return self.apply(scores)
+
+    def overhead_ms_per_token(self) -> float:
+        return 1000 * self.mask_seconds / self.steps if self.steps else 0.0
+
+
+class Constraint:
+    """A compiled constraint; creates per-request logits processors"""
+
+    def __init__(self, fsm: TokenFSM, compile_seconds: float):
+        self.fsm = fsm
+        self.compile_seconds = compile_seconds
+
+    def processor(self, batch_size: int = 1) -> ConstrainedLogitsProcessor:
+        return ConstrainedLogitsProcessor(self.fsm, batch_size)
+
+
+# Per-tokenizer caches: {"vocabulary": [...], "constraints": OrderedDict(key -> Constraint)}
+_CACHE: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_CACHE_LOCK = threading.Lock()
+MAX_CACHED_CONSTRAINTS = 32
+
+
+def compile_constraint(tokenizer, json_schema: Optional[Dict] = None,
+                       regex: Optional[str] = None) -> Constraint:
+    """Compile (or fetch from cache) the constraint for a JSON schema or regex.
+
+    Raises ValueError if the schema or regex is malformed, unsupported or too large.
+    """
+    if regex is None:
+        regex = schema_to_regex(json_schema if json_schema is not None else {})
+    with _CACHE_LOCK:
+        entry = _CACHE.get(tokenizer)
+        if entry is None:
+            entry = {"vocabulary": token_vocabulary(tokenizer), "constraints": OrderedDict()}
+            _CACHE[tokenizer] = entry
+        constraints = entry["constraints"]
+        if regex in constraints:
+            constraints.move_to_end(regex)
+            return constraints[regex]
+
+    start = time.perf_counter()
+    fsm = TokenFSM(RegexDFA(regex), entry["vocabulary"], tokenizer.eos_token_id)
+    fsm.allowed_ids(fsm.initial_state, "cpu")  # Fail fast on unusable constraints
+    constraint = Constraint(fsm, time.perf_counter() - start)
+
+    with _CACHE_LOCK:
+        constraints[regex] = constraint
+        while len(constraints) > MAX_CACHED_CONSTRAINTS:
+            constraints.popitem(last=False)
+    return constraint
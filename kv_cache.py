@@ -0,0 +1,79 @@
+"""
+Helpers for manipulating model KV caches across transformers versions
+"""
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only understands tuple caches
+    DynamicCache = None
+
+
+def to_legacy(past) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+    """Convert a cache object to a tuple of per-layer (key, value) tensors"""
+    if past is None or isinstance(past, (tuple, list)):
+        return past
+    if hasattr(past, "layers"):  # transformers >= 4.56
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    if hasattr(past, "key_cache"):
+        return tuple(zip(past.key_cache, past.value_cache))
+    return past.to_legacy_cache()
+
+
+def from_legacy(legacy):
+    """Build a cache object the model accepts from per-layer (key, value) tensors"""
+    if DynamicCache is None:
+        return tuple(legacy)
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(legacy):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def repeat_batch(past, n: int):
+    """Repeat every batch row `n` times (e.g. to fork one prefill into n samples)"""
+    if n == 1:
+        return past
+    return from_legacy(tuple(
+        (key.repeat_interleave(n, dim=0), value.repeat_interleave(n, dim=0))
+        for key, value in to_legacy(past)
+    ))
+
+
+def cache_length(past) -> int:
+    """Number of token positions currently held in the cache"""
+    if past is None:
+        return 0
+    legacy = to_legacy(past)
+    if not legacy:
+        return 0
+    return legacy[0][0].shape[-2]
+
+
+def pad_left(past, tokens: int):
+    """Insert `tokens` empty positions before every sequence (the caller masks them out)"""
+    if tokens == 0:
+        return past
+    return from_legacy(tuple(
+        (F.pad(key, (0, 0, tokens, 0)), F.pad(value, (0, 0, tokens, 0)))
+        for key, value in to_legacy(past)
+    ))
+
+
+def cat_batch(pasts):
+    """Concatenate caches of equal length along the batch dimension"""
+    return from_legacy(tuple(
+        (torch.cat([key for key, _ in layer]), torch.cat([value for _, value in layer]))
+        for layer in zip(*(to_legacy(past) for past in pasts))
+    ))
+
+
+def select_batch(past, index: torch.Tensor, start: int = 0):
+    """Keep the batch rows in `index`, dropping the first `start` positions"""
+    return from_legacy(tuple(
+        (key[index, :, start:, :], value[index, :, start:, :])
+        for key, value in to_legacy(past)
+    ))
@@ -0,0 +1,177 @@
+"""
+Disk tier for KV caches of idle conversations
+
+Each entry is a raw data file holding a list of tensors back to back (each
+optionally zlib-compressed) plus a JSON sidecar with their dtypes, shapes and
+offsets and the caller's metadata. Reading an entry memory-maps the data file
+and builds the tensors straight on top of the mapping, so restoring a cache
+costs a disk read instead of a prefill. Entries are evicted least recently
+used first to keep the store under its disk quota.
+
+Keys are per-process session ids, so entries left by earlier runs can never be
+restored; a new store deletes them.
+"""
+import json
+import os
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+_ENTRY_SUFFIXES = (".kv", ".json", ".kv.tmp", ".json.tmp")
+_OPEN_STORES: "weakref.WeakSet" = weakref.WeakSet()  # Stores of this process, to spare their entries
+
+
+class KVStore:
+    """Memory-mapped file store of tensor lists, with a disk quota and LRU eviction"""
+
+    def __init__(self, path: str, quota_mb: float = 4096, compress: bool = False):
+        """Open (or create) a store in directory `path`, keeping at most `quota_mb` on disk"""
+        self.path = path
+        self.quota_bytes = int(quota_mb * 1024**2)
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> bytes on disk, LRU first
+
+        self.spills = 0
+        self.loads = 0
+        self.evictions = 0
+        self._spill_seconds = 0.0
+        self._load_seconds = 0.0
+
+        os.makedirs(path, exist_ok=True)
+        # Purge entries of earlier runs; another store of this process on the same directory
+        # (the old chatbot during a hot reload) keeps its own
+        live = {
+            key
+            for store in list(_OPEN_STORES) if os.path.abspath(store.path) == os.path.abspath(path)
+            for key in list(store._entries)
+        }
+        for name in os.listdir(path):
+            suffix = next((s for s in _ENTRY_SUFFIXES if name.endswith(s)), None)
+            if suffix is not None and name[:-len(suffix)] not in live:
+                try:
+                    os.remove(os.path.join(path, name))
+                except OSError:
+                    pass
+        _OPEN_STORES.add(self)
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".kv")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".json")
+
+    def put(self, key: str, tensors: List[torch.Tensor], metadata: Optional[Dict] = None) -> bool:
+        """Write tensors under `key`, replacing any previous entry; False if it exceeds the quota"""
+        start = time.perf_counter()
+        blobs = []
+        layout = []
+        offset = 0
+        for tensor in tensors:
+            tensor = tensor.detach().contiguous().cpu()
+            data = tensor.view(torch.uint8).numpy() if tensor.numel() else np.zeros(0, dtype=np.uint8)
+            if self.compress:
+                data = np.frombuffer(zlib.compress(data, 1), dtype=np.uint8)
+            layout.append({
+                "dtype": str(tensor.dtype).replace("torch.", ""),
+                "shape": list(tensor.shape),
+                "offset": offset,
+                "nbytes": data.nbytes,
+            })
+            blobs.append(data)
+            offset += data.nbytes
+
+        with self._lock:
+            self._delete(key)
+            if offset > self.quota_bytes:
+                return False
+            self._evict(self.quota_bytes - offset)
+
+            tmp_path = self._data_path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for data in blobs:
+                    f.write(memoryview(data))
+            os.replace(tmp_path, self._data_path(key))
+            # The sidecar is written last, so an entry without one is incomplete and ignored
+            tmp_path = self._meta_path(key) + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"compressed": self.compress, "tensors": layout, "metadata": metadata or {}}, f)
+            os.replace(tmp_path, self._meta_path(key))
+
+            self._entries[key] = offset
+            self.spills += 1
+            self._spill_seconds += time.perf_counter() - start
+        return True
+
+    def get(self, key: str, device=None) -> Optional[Tuple[List[torch.Tensor], Dict]]:
+        """Map an entry back as (tensors, metadata), or None if it is not stored"""
+        start = time.perf_counter()
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            with open(self._meta_path(key), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            os.utime(self._meta_path(key))
+
+            # Copy-on-write mapping: pages are read lazily and the tensors may be modified in place
+            data = None
+            if self._entries[key]:
+                data = np.memmap(self._data_path(key), dtype=np.uint8, mode="c")
+            tensors = []
+            for spec in meta["tensors"]:
+                dtype = getattr(torch, spec["dtype"])
+                if spec["nbytes"] == 0:
+                    tensors.append(torch.empty(spec["shape"], dtype=dtype, device=device))
+                    continue
+                raw = data[spec["offset"]:spec["offset"] + spec["nbytes"]]
+                if meta["compressed"]:
+                    raw = bytearray(zlib.decompress(raw))
+                tensor = torch.frombuffer(raw, dtype=torch.uint8).view(dtype).reshape(spec["shape"])
+                if device is not None:
+                    tensor = tensor.to(device)
+                tensors.append(tensor)
+
+            self.loads += 1
+            self._load_seconds += time.perf_counter() - start
+        return tensors, meta["metadata"]
+
+    def delete(self, key: str):
+        """Remove an entry if present"""
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key: str):
+        if self._entries.pop(key, None) is None:
+            return
+        for path in (self._meta_path(key), self._data_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self, keep_bytes: int):
+        """Drop least recently used entries until at most `keep_bytes` are stored"""
+        while self._entries and sum(self._entries.values()) > keep_bytes:
+            key = next(iter(self._entries))
+            self._delete(key)
+            self.evictions += 1
+
+    def get_stats(self) -> Dict[str, float]:
+        """Entry count, disk usage and spill/load timings"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "disk_mb": round(sum(self._entries.values()) / 1024**2, 1),
+                "quota_mb": round(self.quota_bytes / 1024**2, 1),
+                "compressed": self.compress,
+                "spills": self.spills,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "avg_spill_ms": round(1000 * self._spill_seconds / self.spills, 2) if self.spills else 0.0,
+                "avg_load_ms": round(1000 * self._load_seconds / self.loads, 2) if self.loads else 0.0,
+            }
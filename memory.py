@@ -0,0 +1,191 @@
+"""
+Memory estimation and admission control for generation requests
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+import torch
+
+
+def available_memory_bytes(device: str) -> int:
+    """Memory that can still be allocated on the device (free VRAM or available RAM)"""
+    if device == "cuda" and torch.cuda.is_available():
+        free, _total = torch.cuda.mem_get_info()
+        # Blocks cached by PyTorch's allocator are free for our purposes too
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """Whether an exception means an allocation failed"""
+    if isinstance(error, MemoryError):
+        return True
+    oom_type = getattr(torch, "OutOfMemoryError", None) or getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_type is not None and isinstance(error, oom_type):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def release_cached_memory():
+    """Return cached allocator blocks after an out-of-memory error"""
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class MemoryBudget:
+    """Estimates per-request KV/activation memory and admits work within a budget.
+
+    The budget covers memory used by generation on top of the loaded weights.
+    It is `budget_mb` when configured, otherwise a fraction of whatever the
+    device reports as available; memory reserved by in-flight requests is
+    subtracted in both cases.
+    """
+
+    def __init__(self, model_config, dtype: torch.dtype, device: str,
+                 budget_mb: int = 0, safety_fraction: float = 0.9):
+        self.device = device
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.safety_fraction = safety_fraction
+        self.reserved_bytes = 0
+        self._lock = threading.Lock()
+
+        dtype_bytes = torch.finfo(dtype).bits // 8 if dtype.is_floating_point else 2
+        layers = model_config.num_hidden_layers
+        heads = model_config.num_attention_heads
+        kv_heads = getattr(model_config, "num_key_value_heads", None) or heads
+        hidden = model_config.hidden_size
+        head_dim = getattr(model_config, "head_dim", None) or hidden // heads
+        intermediate = getattr(model_config, "intermediate_size", None) or 4 * hidden
+
+        # Keys and values for every layer
+        self.kv_bytes_per_token = 2 * layers * kv_heads * head_dim * dtype_bytes
+        # Transient per-token activations of one layer during prefill (residual, qkv, MLP)
+        self.activation_bytes_per_token = (4 * hidden + 2 * intermediate) * dtype_bytes
+        # Last-position logits in float32, plus a copy for sampling
+        self.logits_bytes_per_sequence = 2 * model_config.vocab_size * 4
+
+    def estimate_bytes(self, batch_size: int, prompt_tokens: int, new_tokens: int,
+                       shared_prefill: bool = True) -> int:
+        """Peak memory for generating `new_tokens` for `batch_size` sequences"""
+        prefill_sequences = 1 if shared_prefill else batch_size
+        return (
+            batch_size * (prompt_tokens + new_tokens) * self.kv_bytes_per_token
+            + prefill_sequences * prompt_tokens * self.activation_bytes_per_token
+            + batch_size * self.logits_bytes_per_sequence
+        )
+
+    def headroom_bytes(self) -> int:
+        """Memory still available to new requests"""
+        available = int(available_memory_bytes(self.device) * self.safety_fraction)
+        with self._lock:
+            # Reservations count even before their KV caches are allocated (conservative once they are)
+            available -= self.reserved_bytes
+            if self.budget_bytes:
+                available = min(available, self.budget_bytes - self.reserved_bytes)
+        return max(0, available)
+
+    def plan(self, batch_size: int, prompt_tokens: int, new_tokens: int,
+             min_new_tokens: int = 16) -> Tuple[int, int]:
+        """Shrink a request to fit the headroom.
+
+        Returns (sequences per batch, max new tokens). The batch is shrunk
+        first; a single sequence that still does not fit gets fewer new
+        tokens. Raises MemoryError if even that is impossible.
+        """
+        headroom = self.headroom_bytes()
+        for size in range(batch_size, 0, -1):
+            if self.estimate_bytes(size, prompt_tokens, new_tokens) <= headroom:
+                return size, new_tokens
+
+        fixed = self.estimate_bytes(1, prompt_tokens, 0)
+        affordable = (headroom - fixed) // self.kv_bytes_per_token
+        if affordable >= min_new_tokens:
+            return 1, int(affordable)
+
+        raise MemoryError(
+            f"Not enough memory for a {prompt_tokens}-token prompt "
+            f"({headroom / 1024**2:.0f} MB available)"
+        )
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        """Account for memory held by an in-flight request"""
+        with self._lock:
+            self.reserved_bytes += nbytes
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.reserved_bytes -= nbytes
+
+    def get_status(self) -> Dict[str, float]:
+        """Current budget and headroom in MB"""
+        mb = 1024 * 1024
+        return {
+            "device": self.device,
+            "available_mb": round(available_memory_bytes(self.device) / mb, 1),
+            "budget_mb": round(self.budget_bytes / mb, 1) if self.budget_bytes else None,
+            "reserved_mb": round(self.reserved_bytes / mb, 1),
+            "headroom_mb": round(self.headroom_bytes() / mb, 1),
+            "kv_bytes_per_token": self.kv_bytes_per_token,
+            "process_rss_mb": round(current_rss_bytes() / mb, 1),
+        }
+
+
+class PeakMemoryMonitor:
+    """Tracks peak process RSS (and CUDA allocations) from a background thread"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak_rss_bytes = 0
+        self.peak_cuda_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss_bytes = max(self.peak_rss_bytes, current_rss_bytes())
+            self._stop.wait(self.interval)
+
+    def start(self) -> "PeakMemoryMonitor":
+        """Start sampling"""
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, float]:
+        """Stop sampling and return the peaks in MB"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.peak_rss_bytes = max(self.peak_rss_bytes, current_rss_bytes())
+        if torch.cuda.is_available():
+            self.peak_cuda_bytes = torch.cuda.max_memory_allocated()
+        mb = 1024 * 1024
+        return {
+            "peak_rss_mb": round(self.peak_rss_bytes / mb, 1),
+            "peak_cuda_mb": round(self.peak_cuda_bytes / mb, 1) if torch.cuda.is_available() else None,
+        }
@@ -0,0 +1,322 @@
+"""
+Staged generation pipeline - keeps CPU text work off the model thread
+
+Requests flow through three worker threads connected by queues:
+
+    preprocess (chat template + batch tokenization)
+        -> model (generate, streaming new token ids out as they are produced)
+        -> postprocess (incremental detokenization + cleanup)
+
+so templating/tokenizing the next request and detokenizing the current one
+overlap with the model's forward passes. Completion requests (stream()) go
+through all three stages as well: the model thread only samples, and their
+sampled tokens are turned into text and checked for stop strings in the
+postprocess stage. Chat turns of the single conversation are serialized by the
+caller, so the overlap comes from concurrent completion requests alongside them.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import torch
+
+from config import DEVICE
+from profiling import PROFILER
+
+_END = object()  # Marks the end of a job's token stream
+_STOP = object()  # Shuts a stage down after the jobs queued before it
+
+
+class IncrementalDetokenizer:
+    """Decodes a growing token sequence, returning only newly completed text.
+
+    Only a short window of recent tokens is re-decoded per step, and text
+    ending in an incomplete multi-byte character is held back.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens: List[int] = []
+        self.text = ""
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def add(self, token_ids: List[int]) -> str:
+        """Append tokens and return the text they completed (possibly empty)"""
+        self.tokens.extend(token_ids)
+        prefix_text = self.tokenizer.decode(
+            self.tokens[self._prefix_offset:self._read_offset],
+            skip_special_tokens=self.skip_special_tokens
+        )
+        new_text = self.tokenizer.decode(
+            self.tokens[self._prefix_offset:],
+            skip_special_tokens=self.skip_special_tokens
+        )
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        delta = new_text[len(prefix_text):]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.tokens)
+        self.text += delta
+        return delta
+
+
+class StageStats:
+    """Thread-safe counters for one pipeline stage"""
+
+    def __init__(self, name: str, input_queue: queue.Queue):
+        self.name = name
+        self.input_queue = input_queue
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, items: int = 1):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "queue_depth": self.input_queue.qsize(),
+                "items": self.items,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "avg_ms": round(1000 * self.busy_seconds / self.items, 3) if self.items else 0.0,
+            }
+
+
+class _QueueStreamer:
+    """transformers streamer that forwards new token ids to the postprocess queue"""
+
+    def __init__(self, job: Dict, output_queue: queue.Queue):
+        self.job = job
+        self.output_queue = output_queue
+        self._prompt_seen = False
+
+    def put(self, value: torch.Tensor):
+        if not self._prompt_seen:  # generate() first passes the prompt
+            self._prompt_seen = True
+            return
+        self.output_queue.put((self.job, value.reshape(-1).tolist()))
+
+    def end(self):
+        pass
+
+
+class GenerationPipeline:
+    """Runs chat generation as overlapping preprocess/model/postprocess stages"""
+
+    def __init__(self, chatbot, max_length: int = 2048):
+        self.chatbot = chatbot
+        self.tokenizer = chatbot.tokenizer
+        self.max_length = max_length
+
+        self._preprocess_queue: queue.Queue = queue.Queue()
+        self._model_queue: queue.Queue = queue.Queue()
+        self._postprocess_queue: queue.Queue = queue.Queue()
+
+        self.stats = {
+            "preprocess": StageStats("preprocess", self._preprocess_queue),
+            "model": StageStats("model", self._model_queue),
+            "postprocess": StageStats("postprocess", self._postprocess_queue),
+        }
+
+        self._threads = [
+            threading.Thread(target=target, daemon=True)
+            for target in (self._preprocess_worker, self._model_worker, self._postprocess_worker)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, messages: List[Dict[str, str]], max_new_tokens: int, logits_processor=None,
+               adapter: Optional[str] = None) -> Future:
+        """Queue a generation request; the future resolves to the cleaned reply"""
+        job = {
+            "messages": messages,
+            "max_new_tokens": max_new_tokens,
+            "logits_processor": logits_processor,
+            "adapter": adapter,
+            "future": Future(),
+            "detokenizer": IncrementalDetokenizer(self.tokenizer),
+        }
+        self._preprocess_queue.put(job)
+        return job["future"]
+
+    def stream(self, messages: List[Dict[str, str]], choices: List[Dict], max_new_tokens: int,
+               temperature: float, top_p: float, stop: Optional[List[str]] = None, constraint=None,
+               adapter: Optional[str] = None, usage: Optional[Dict[str, int]] = None):
+        """Sample len(choices) replies, yielding ChatBot._sample_choices events.
+
+        The model stage samples tokens and the postprocess stage detokenizes
+        them and applies the stop strings; a choice that hits one is finished
+        by the model stage at its next step. The prompt keeps its most recent
+        `max_length` tokens. If a `usage` dict is given, its "prompt_tokens" is
+        set once the prompt is tokenized.
+        """
+        job = {
+            "messages": messages,
+            "choices": choices,
+            "sampling": {
+                "max_new_tokens": max_new_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "stop": stop,
+                "constraint": constraint,
+                "adapter": adapter,
+            },
+            "events": queue.Queue(),
+            "cancelled": False,
+        }
+        self._preprocess_queue.put(job)
+        try:
+            while True:
+                item = job["events"].get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            job["cancelled"] = True  # The model stage stops sampling if the caller went away
+        if usage is not None:
+            usage["prompt_tokens"] = len(job["input_ids"])
+
+    def stop(self):
+        """Finish the queued jobs, then stop the stage threads"""
+        self._preprocess_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+    @staticmethod
+    def _fail(job: Dict, error: Exception):
+        if "events" in job:
+            job["events"].put(error)
+        else:
+            job["future"].set_exception(error)
+
+    def _preprocess_worker(self):
+        """Template and tokenize everything waiting, in one fast-tokenizer batch call"""
+        stopping = False
+        while not stopping:
+            jobs = [self._preprocess_queue.get()]
+            while True:
+                try:
+                    jobs.append(self._preprocess_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in jobs:
+                jobs = jobs[:jobs.index(_STOP)]
+                stopping = True
+
+            start = time.perf_counter()
+            try:
+                prompts = [self.chatbot.format_messages(job["messages"]) for job in jobs]
+                encoded = self.tokenizer(prompts)["input_ids"] if prompts else []
+            except Exception as e:
+                for job in jobs:
+                    self._fail(job, e)
+                encoded = []
+                jobs = []
+            if jobs:
+                self.stats["preprocess"].record(time.perf_counter() - start, len(jobs))
+
+            for job, input_ids in zip(jobs, encoded):
+                # Completions keep the end of the conversation, chat turns the start
+                if "events" in job:
+                    job["input_ids"] = input_ids[-self.max_length:]
+                else:
+                    job["input_ids"] = input_ids[:self.max_length]
+                self._model_queue.put(job)
+        self._model_queue.put(_STOP)
+
+    def _model_worker(self):
+        """Drive the model; new tokens stream to the postprocess stage as they appear"""
+        while True:
+            job = self._model_queue.get()
+            if job is _STOP:
+                self._postprocess_queue.put(_STOP)
+                return
+            start = time.perf_counter()
+            if "events" in job:
+                self._run_completion(job)
+                self.stats["model"].record(time.perf_counter() - start)
+                continue
+            try:
+                input_ids = torch.tensor([job["input_ids"]], device=DEVICE)
+                inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+                with PROFILER.capture("pipeline_generate"), self.chatbot._adapter(job["adapter"]):
+                    _, max_new_tokens = self.chatbot.memory_budget.plan(
+                        1, input_ids.shape[1], job["max_new_tokens"])
+                    self.chatbot._generate_with_retry(
+                        inputs, max_new_tokens, streamer=_QueueStreamer(job, self._postprocess_queue),
+                        logits_processor=job["logits_processor"])
+                self._postprocess_queue.put((job, _END))
+            except Exception as e:
+                self._postprocess_queue.put((job, e))
+            self.stats["model"].record(time.perf_counter() - start)
+
+    def _run_completion(self, job: Dict):
+        """Sample a completion job's choices, passing token events on to the postprocess stage"""
+        try:
+            input_ids = torch.tensor([job["input_ids"]], device=DEVICE)
+            with PROFILER.capture("pipeline_completions"):
+                sampler = self.chatbot._sample_choices(input_ids, job["choices"], **job["sampling"],
+                                                       detokenize=False)
+                try:
+                    for event in sampler:
+                        if job["cancelled"]:
+                            break
+                        self._postprocess_queue.put((job, event))
+                finally:
+                    sampler.close()
+            self._postprocess_queue.put((job, _END))
+        except Exception as e:
+            self._postprocess_queue.put((job, e))
+
+    def _postprocess_worker(self):
+        """Detokenize incrementally and finish jobs once their stream ends"""
+        while True:
+            entry = self._postprocess_queue.get()
+            if entry is _STOP:
+                return
+            job, item = entry
+            start = time.perf_counter()
+            if "events" in job:
+                self._postprocess_completion(job, item)
+            elif isinstance(item, Exception):
+                job["future"].set_exception(item)
+            elif item is _END:
+                text = job["detokenizer"].text
+                job["future"].set_result(self.chatbot._finish_reply(text, job["logits_processor"] is not None))
+            else:
+                job["detokenizer"].add(item)
+            self.stats["postprocess"].record(time.perf_counter() - start)
+
+    def _postprocess_completion(self, job: Dict, item):
+        """Turn a completion job's token events into text events for the waiting request"""
+        events = job["events"]
+        if isinstance(item, Exception):
+            events.put(item)
+        elif item is _END:
+            # Tokens sampled after a stop string (before the model stage saw it) are not part of the reply
+            for choice in job["choices"]:
+                if choice["stop_requested"]:
+                    del choice["tokens"][len(choice["detokenizer"].tokens):]
+            events.put(_END)
+        elif not job["cancelled"]:
+            index, token, finish_reason = item
+            stop = [s for s in (job["sampling"]["stop"] or []) if s]
+            try:
+                for event in self.chatbot._accept_text(job["choices"][index], index, token, finish_reason, stop):
+                    events.put(event)
+            except Exception as e:
+                job["cancelled"] = True  # The model stage stops sampling for it
+                events.put(e)
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-stage queue depths and timings"""
+        return {name: stage.snapshot() for name, stage in self.stats.items()}
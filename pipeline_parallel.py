@@ -0,0 +1,351 @@
+"""
+Layer-sharded pipeline-parallel execution across local processes
+
+The decoder layers are split into contiguous shards, one per worker process.
+Each stage loads only its own layers straight from the safetensors files
+(the first stage also the embeddings, the last one the final norm and LM
+head), so no process ever holds the whole model. Stages are chained with
+torch.multiprocessing queues, which move activations through shared memory:
+
+    coordinator -> stage 0 -> stage 1 -> ... -> stage N-1 -> coordinator
+
+Every message is one micro-batch: a prompt chunk or a single decode step of
+one sequence. Each stage keeps the KV cache of its own layers per sequence
+and handles messages in order, so while stage 1 works on one micro-batch
+stage 0 is already running the next (the following prompt chunk, or another
+request's token), and with several sequences in flight all stages stay busy.
+
+Supports Llama-style decoders (Llama, Mistral, Qwen2, ...) whose base model
+has `embed_tokens`, `layers` and `norm`, stored as safetensors.
+"""
+import copy
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import torch
+import torch.multiprocessing as mp
+
+import kv_cache
+from config import TRUST_REMOTE_CODE
+
+
+def layer_ranges(num_layers: int, num_stages: int) -> List[range]:
+    """Split decoder layers into contiguous, nearly equal shards"""
+    if not 1 < num_stages <= num_layers:
+        raise ValueError(f"Cannot split {num_layers} layers into {num_stages} stages")
+    base, extra = divmod(num_layers, num_stages)
+    ranges = []
+    start = 0
+    for stage in range(num_stages):
+        end = start + base + (1 if stage < extra else 0)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+
+def stage_cpus(stage: int, num_stages: int) -> List[int]:
+    """A contiguous block of this process's CPUs for one stage (keeps a stage on one socket)"""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    per_stage = max(1, len(cpus) // num_stages)
+    block = cpus[stage * per_stage:(stage + 1) * per_stage]
+    return block or cpus
+
+
+def _checkpoint_files(model_path: str) -> Dict[str, str]:
+    """Map every tensor name in a safetensors checkpoint to the file holding it"""
+    index_path = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        return {name: os.path.join(model_path, file) for name, file in weight_map.items()}
+
+    single = os.path.join(model_path, "model.safetensors")
+    if not os.path.exists(single):
+        raise ValueError(f"No safetensors checkpoint found in {model_path}")
+    from safetensors import safe_open
+    with safe_open(single, framework="pt") as f:
+        return {name: single for name in f.keys()}
+
+
+def load_stage(model_path: str, stage: int, num_stages: int, dtype: torch.dtype):
+    """Build the model of one stage, reading only the weights it needs"""
+    from accelerate import init_empty_weights
+    from accelerate.utils import set_module_tensor_to_device
+    from safetensors import safe_open
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=TRUST_REMOTE_CODE)
+    layers = layer_ranges(config.num_hidden_layers, num_stages)[stage]
+    first, last = stage == 0, stage == num_stages - 1
+
+    # The stage model only has its own layers, numbered from 0, so its KV cache is local too
+    stage_config = copy.deepcopy(config)
+    stage_config.num_hidden_layers = len(layers)
+    if getattr(config, "layer_types", None):
+        stage_config.layer_types = config.layer_types[layers.start:layers.stop]
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(stage_config, torch_dtype=dtype, trust_remote_code=TRUST_REMOTE_CODE)
+
+    base = model.base_model
+    if not all(hasattr(base, attr) for attr in ("embed_tokens", "layers", "norm")):
+        raise ValueError(f"Pipeline stages need a Llama-style decoder, got {type(model).__name__}")
+    if not first:
+        base.embed_tokens = torch.nn.Identity()  # Later stages receive hidden states
+    if not last:
+        base.norm = torch.nn.Identity()  # The final norm belongs to the last stage only
+        model.set_output_embeddings(torch.nn.Identity())
+
+    prefix = model.base_model_prefix
+    files = _checkpoint_files(model_path)
+    handles = {}
+    try:
+        for name in model.state_dict():
+            source = name
+            if name.startswith(f"{prefix}.layers."):
+                local, rest = name[len(f"{prefix}.layers."):].split(".", 1)
+                source = f"{prefix}.layers.{layers.start + int(local)}.{rest}"
+            if source not in files and name == "lm_head.weight":
+                source = f"{prefix}.embed_tokens.weight"  # Tied input/output embeddings
+            if source not in files:
+                raise ValueError(f"Weight {source} not found in the checkpoint")
+            if files[source] not in handles:
+                handles[files[source]] = safe_open(files[source], framework="pt")
+            tensor = handles[files[source]].get_tensor(source)
+            if tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            set_module_tensor_to_device(model, name, "cpu", value=tensor)
+    finally:
+        handles.clear()
+
+    model.eval()
+    return model, layers
+
+
+def _stage_main(model_path: str, stage: int, num_stages: int, dtype: torch.dtype,
+                input_queue, output_queue, stats):
+    """Worker process: run this stage's layers for every message, in order.
+
+    `stats` is a shared array; this stage keeps its busy seconds and cached
+    sequence count in slots 2 * stage and 2 * stage + 1.
+    """
+    cpus = stage_cpus(stage, num_stages)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+
+    try:
+        model, layers = load_stage(model_path, stage, num_stages, dtype)
+    except Exception as e:
+        output_queue.put(("error", None, None, f"stage {stage} failed to load: {e}"))
+        return
+    output_queue.put(("ready", None, stage, {"layers": [layers.start, layers.stop], "cpus": len(cpus)}))
+
+    first, last = stage == 0, stage == num_stages - 1
+    caches = {}  # sequence id -> KV cache of this stage's layers
+    failed = set()  # Sequences whose cache missed a micro-batch; their later work is refused
+    with torch.no_grad():
+        while True:
+            op, message_id, sequence, payload = input_queue.get()
+            if op == "forward" and sequence in failed:
+                op, payload = "error", f"stage {stage}: sequence {sequence} failed earlier"
+            elif op == "forward":
+                start = time.perf_counter()
+                try:
+                    past = caches.get(sequence)
+                    length = kv_cache.cache_length(past) + payload.shape[1]
+                    outputs = model.base_model(
+                        input_ids=payload if first else None,
+                        inputs_embeds=None if first else payload,
+                        attention_mask=torch.ones((1, length), dtype=torch.long),
+                        past_key_values=past,
+                        use_cache=True
+                    )
+                    caches[sequence] = outputs.past_key_values
+                    hidden = outputs.last_hidden_state
+                    if last:
+                        payload = model.get_output_embeddings()(hidden[:, -1, :]).float()
+                    else:
+                        payload = hidden
+                except Exception as e:
+                    op, payload = "error", f"stage {stage}: {e}"
+                    failed.add(sequence)
+                stats[2 * stage] += time.perf_counter() - start
+            elif op == "fork":
+                # Children share the prompt's tensors; decode steps concatenate into new ones
+                if sequence in failed:
+                    failed.update(payload)
+                elif sequence in caches:
+                    for child in payload:
+                        caches[child] = kv_cache.from_legacy(kv_cache.to_legacy(caches[sequence]))
+            elif op == "free":
+                for seq in sequence:
+                    caches.pop(seq, None)
+                    failed.discard(seq)
+            elif op == "stop":
+                output_queue.put((op, message_id, sequence, payload))
+                return
+            stats[2 * stage + 1] = len(caches)
+            output_queue.put((op, message_id, sequence, payload))
+
+
+class PipelineParallelModel:
+    """Coordinator for the stage processes; forward() calls may come from many threads.
+
+    If a stage process dies (e.g. killed for running out of memory), every
+    pending and later future fails instead of waiting forever.
+    """
+
+    POLL_SECONDS = 1.0  # How often an idle coordinator checks that the stages are alive
+
+    def __init__(self, model_path: str, num_stages: int, dtype: torch.dtype = torch.float32,
+                 prefill_chunk: int = 256):
+        from transformers import AutoConfig
+
+        self.config = AutoConfig.from_pretrained(model_path, trust_remote_code=TRUST_REMOTE_CODE)
+        self.dtype = dtype
+        self.num_stages = num_stages
+        self.prefill_chunk = prefill_chunk
+        self.layer_ranges = layer_ranges(self.config.num_hidden_layers, num_stages)
+
+        context = mp.get_context("spawn")
+        self._queues = [context.Queue() for _ in range(num_stages + 1)]
+        self._stage_stats = context.Array("d", 2 * num_stages, lock=False)  # Written by the stages
+        self._processes = [
+            context.Process(
+                target=_stage_main,
+                args=(model_path, stage, num_stages, dtype, self._queues[stage], self._queues[stage + 1],
+                      self._stage_stats),
+                daemon=True
+            )
+            for stage in range(num_stages)
+        ]
+        for process in self._processes:
+            process.start()
+
+        self._futures: Dict[int, Future] = {}
+        self._futures_lock = threading.Lock()
+        self._error: Optional[str] = None  # Set once the stages are gone; new work fails at once
+        self._ids = itertools.count()
+        self.stage_info = {}
+
+        # Ready messages travel down the chain behind each stage's own load
+        while len(self.stage_info) < num_stages:
+            message = self._receive()
+            op, _, stage, payload = message if message is not None else ("error", None, None, self._error)
+            if op == "error":
+                self.close()
+                raise RuntimeError(payload)
+            self.stage_info[stage] = payload
+            print(f"Pipeline stage {stage} ready: layers {payload['layers'][0]}-{payload['layers'][1] - 1}, "
+                  f"{payload['cpus']} CPUs")
+
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _receive(self):
+        """Next message from the last stage, or None once a stage process has exited"""
+        while True:
+            try:
+                return self._queues[-1].get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                for stage, process in enumerate(self._processes):
+                    if not process.is_alive():
+                        self._error = f"pipeline stage {stage} exited (exit code {process.exitcode})"
+                        return None
+
+    def _fail_pending(self, error: str):
+        """Fail every unresolved future and refuse new work"""
+        with self._futures_lock:
+            self._error = error
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(RuntimeError(error))
+
+    def _collect(self):
+        """Resolve futures as results come out of the last stage"""
+        while True:
+            message = self._receive()
+            if message is None:
+                print(f"Error: {self._error}; failing its pending requests")
+                self._fail_pending(self._error)
+                return
+            op, message_id, _, payload = message
+            if op == "stop":
+                return
+            with self._futures_lock:
+                future = self._futures.pop(message_id, None)
+            if future is None:
+                continue
+            if op == "error":
+                future.set_exception(RuntimeError(payload))
+            else:
+                future.set_result(payload)
+
+    def _send(self, op: str, sequence, payload=None, reply: bool = False) -> Optional[Future]:
+        message_id = next(self._ids)
+        future = None
+        if reply:
+            future = Future()
+            with self._futures_lock:
+                if self._error is not None:
+                    future.set_exception(RuntimeError(self._error))
+                    return future
+                self._futures[message_id] = future
+        self._queues[0].put((op, message_id, sequence, payload))
+        return future
+
+    def new_sequence(self) -> int:
+        """Id for a new sequence (its KV cache is created by its first forward)"""
+        return next(self._ids)
+
+    def forward(self, sequence: int, input_ids: torch.Tensor) -> Future:
+        """Feed tokens (1, T) of a sequence; resolves to last-position logits (1, vocab)"""
+        return self._send("forward", sequence, input_ids.cpu(), reply=True)
+
+    def prefill(self, sequence: int, input_ids: torch.Tensor) -> Future:
+        """Feed a prompt in chunks that flow through the stages back to back.
+
+        Only the last chunk's future is returned: a stage that fails a chunk
+        refuses every later micro-batch of the sequence, so the error surfaces there.
+        """
+        future = None
+        for start in range(0, input_ids.shape[1], self.prefill_chunk):
+            future = self.forward(sequence, input_ids[:, start:start + self.prefill_chunk])
+        return future
+
+    def fork(self, sequence: int, children: List[int]):
+        """Give each child sequence a copy of the parent's KV cache"""
+        self._send("fork", sequence, children)
+
+    def free(self, sequences: List[int]):
+        """Drop the KV caches of finished sequences"""
+        self._send("free", list(sequences))
+
+    def get_stats(self) -> Dict:
+        """Layer split and per-stage busy time (read from shared memory, not queued behind work)"""
+        with self._futures_lock:
+            in_flight = len(self._futures)
+        stats = {"stages": self.num_stages, "in_flight": in_flight, "stage_info": self.stage_info}
+        if self._error is not None:
+            stats["error"] = self._error
+        for stage in range(self.num_stages):
+            stats[f"stage_{stage}"] = {
+                "busy_seconds": round(self._stage_stats[2 * stage], 3),
+                "sequences": int(self._stage_stats[2 * stage + 1]),
+                "alive": self._processes[stage].is_alive(),
+            }
+        return stats
+
+    def close(self):
+        """Stop the stage processes and fail whatever is still pending"""
+        self._queues[0].put(("stop", None, None, None))
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._fail_pending("pipeline stages were stopped")
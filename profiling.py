@@ -0,0 +1,199 @@
+"""
+On-demand profiling of live generation requests
+
+A profiling session is armed for the next N requests and/or T seconds. While
+it is active, each generation request runs under the torch profiler (one
+Chrome trace per request) and a background thread samples the Python stacks
+of every server thread into a folded-stack file that flamegraph.pl or
+speedscope can render.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+
+from config import PROFILE_OUTPUT_DIR, PROFILE_MAX_SECONDS, PROFILE_SAMPLE_INTERVAL
+
+
+class ProfileSession:
+    """State of one armed profiling session"""
+
+    def __init__(self, requests: Optional[int], seconds: Optional[float], output_dir: str):
+        self.id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        self.remaining = requests
+        self.started = time.time()
+        self.deadline = self.started + min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        self.output_dir = output_dir
+        self.done = threading.Event()
+        self.result: Optional[Dict] = None
+
+        self.trace_files: List[str] = []
+        self.operators: Dict[str, Dict[str, float]] = {}
+        self.stacks: Counter = Counter()
+        self.leaf_frames: Counter = Counter()
+        self.capture_lock = threading.Lock()  # The torch profiler cannot run twice at once
+
+    def add_profile(self, prof, label: str):
+        """Export a finished torch profile and merge its operator totals"""
+        path = os.path.join(self.output_dir, f"{self.id}_trace_{len(self.trace_files)}_{label}.json")
+        prof.export_chrome_trace(path)
+        self.trace_files.append(path)
+
+        for event in prof.key_averages():
+            totals = self.operators.setdefault(event.key, {
+                "count": 0, "cpu_time_ms": 0.0, "self_cpu_time_ms": 0.0, "device_time_ms": 0.0
+            })
+            totals["count"] += event.count
+            totals["cpu_time_ms"] += event.cpu_time_total / 1000
+            totals["self_cpu_time_ms"] += event.self_cpu_time_total / 1000
+            device_time = getattr(event, "device_time_total", None)
+            if device_time is None:
+                device_time = getattr(event, "cuda_time_total", 0)
+            totals["device_time_ms"] += device_time / 1000
+
+    def sample_stacks(self, interval: float):
+        """Sample the Python stacks of all other threads until the session ends"""
+        own_id = threading.get_ident()
+        while not self.done.is_set() and time.time() < self.deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if names:
+                    self.leaf_frames[names[0]] += 1
+                    self.stacks[";".join(reversed(names))] += 1
+            time.sleep(interval)
+
+    def write_results(self, top: int = 20) -> Dict:
+        """Write the folded stacks and summary files and return the summary"""
+        stacks_path = os.path.join(self.output_dir, f"{self.id}_stacks.folded")
+        with open(stacks_path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        total_samples = sum(self.leaf_frames.values())
+        operators = sorted(self.operators.items(), key=lambda item: item[1]["self_cpu_time_ms"], reverse=True)
+        summary = {
+            "id": self.id,
+            "requests_profiled": len(self.trace_files),
+            "duration_s": round(time.time() - self.started, 3),
+            "files": {
+                "chrome_traces": self.trace_files,
+                "folded_stacks": stacks_path,
+            },
+            "top_operators": [
+                dict(name=name, **{k: round(v, 3) for k, v in totals.items()})
+                for name, totals in operators[:top]
+            ],
+            "top_python_frames": [
+                {"frame": frame, "samples": count, "fraction": round(count / total_samples, 4)}
+                for frame, count in self.leaf_frames.most_common(top)
+            ],
+        }
+
+        summary_path = os.path.join(self.output_dir, f"{self.id}_summary.json")
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        summary["files"]["summary"] = summary_path
+        return summary
+
+
+class RequestProfiler:
+    """Arms profiling sessions and wraps generation requests while one is active"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.session: Optional[ProfileSession] = None
+        self.last_result: Optional[Dict] = None
+
+    def start(self, requests: Optional[int] = None, seconds: Optional[float] = None,
+              output_dir: str = PROFILE_OUTPUT_DIR) -> ProfileSession:
+        """Arm a session for the next `requests` requests and/or `seconds` seconds"""
+        if requests is None and seconds is None:
+            requests = 1
+        with self._lock:
+            if self.session is not None:
+                raise RuntimeError(f"Profiling session {self.session.id} is already running")
+            os.makedirs(output_dir, exist_ok=True)
+            session = ProfileSession(requests, seconds, output_dir)
+            self.session = session
+
+        threading.Thread(target=self._run_sampler, args=(session,), daemon=True).start()
+        return session
+
+    def _run_sampler(self, session: ProfileSession):
+        """Sample stacks until the session ends, then finish it on timeout"""
+        session.sample_stacks(PROFILE_SAMPLE_INTERVAL)
+        # Let an in-flight capture finish before writing results
+        with session.capture_lock:
+            self._finish(session)
+
+    def _finish(self, session: ProfileSession):
+        """Close a session and publish its summary (idempotent)"""
+        with self._lock:
+            if self.session is not session:
+                return
+            self.session = None
+        try:
+            session.result = session.write_results()
+        except Exception as e:
+            session.result = {"id": session.id, "error": f"Failed to write profile: {e}"}
+        self.last_result = session.result
+        session.done.set()
+
+    @contextmanager
+    def capture(self, label: str):
+        """Profile the enclosed block if a session is active and has requests left"""
+        session = self.session
+        if session is None or time.time() >= session.deadline or not session.capture_lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            if session.done.is_set() or session.remaining == 0:
+                yield
+                return
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities) as prof:
+                with torch.profiler.record_function(label):
+                    yield
+            session.add_profile(prof, label)
+
+            if session.remaining is not None:
+                session.remaining -= 1
+                if session.remaining == 0:
+                    session.done.set()  # Stops the sampler
+                    self._finish(session)
+        finally:
+            session.capture_lock.release()
+
+    def status(self) -> Dict:
+        """Describe the active session (if any) and the last finished one"""
+        session = self.session
+        return {
+            "active": None if session is None else {
+                "id": session.id,
+                "requests_remaining": session.remaining,
+                "seconds_remaining": round(max(0.0, session.deadline - time.time()), 1),
+                "requests_profiled": len(session.trace_files),
+            },
+            "last_result": self.last_result,
+        }
+
+
+# Process-wide profiler shared by the chatbot and the web server
+PROFILER = RequestProfiler()
@@ -0,0 +1,25 @@
+"""
+Token sampling helpers for the custom decode loops
+"""
+import torch
+
+
+def sample_next_tokens(logits: torch.Tensor, temperature: float, top_p: float,
+                       do_sample: bool = True) -> torch.Tensor:
+    """Pick one token per row of `logits` (batch, vocab) with temperature/top-p sampling"""
+    if not do_sample or temperature <= 0:
+        return logits.argmax(dim=-1)
+
+    logits = logits.float() / temperature
+
+    if 0 < top_p < 1:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        cumulative = sorted_probs.cumsum(dim=-1)
+        # Drop tokens once the mass before them already exceeds top_p (always keeps the first)
+        remove = (cumulative - sorted_probs) > top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(-1, sorted_indices, sorted_logits)
+
+    probs = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1).squeeze(-1)
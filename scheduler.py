@@ -0,0 +1,461 @@
+"""
+Continuous request scheduler with chunked prefill
+
+One worker thread owns the model and advances every admitted request one
+step at a time. Each step first decodes one token for every sequence that
+is already generating, then spends what is left of the per-step token
+budget on prefill chunks of prompts that are still being read. A long
+prompt is therefore prefilled over many steps instead of in one huge
+forward pass, and the time between tokens of the streams already running
+is bounded by the budget rather than by the longest prompt anyone sends.
+
+Generating sequences share one left-padded KV cache, so a decode step is a
+single forward pass over all of them, whatever LoRA adapter each uses. If
+that forward pass runs out of memory, the newest groups are taken out of the
+batch and the step is retried; each of their unfinished choices later
+re-prefills its prompt plus the tokens it already generated and carries on.
+"""
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from typing import Deque, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from torch.profiler import record_function
+
+import kv_cache
+import sampling
+from config import DEVICE, DO_SAMPLE
+from memory import is_out_of_memory, release_cached_memory
+from profiling import PROFILER
+
+_END = object()  # Marks the end of a request's event stream
+
+
+class ScheduledRequest:
+    """One generation request; iterate it for (index, text_delta, finish_reason) events"""
+
+    def __init__(self, input_ids: torch.Tensor, choices: List[Dict], max_new_tokens: int,
+                 temperature: float, top_p: float, stop: Optional[List[str]] = None, constraint=None,
+                 adapter: Optional[str] = None):
+        self.input_ids = input_ids
+        self.choices = choices
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = [s for s in (stop or []) if s]
+        self.constraint = constraint
+        self.adapter = adapter
+        self.events: queue.Queue = queue.Queue()
+        self.cancelled = False
+        self.pending_groups = 0
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self.input_ids.shape[1]
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.events.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # A consumer that stops early (e.g. a disconnected client) frees its sequences
+            self.cancelled = True
+
+
+class _Group:
+    """Choices of one request that share one prefill and then decode as rows of the batch"""
+
+    def __init__(self, request: ScheduledRequest, indexes: List[int], max_new_tokens: int,
+                 resources: ExitStack, resumed_tokens: Optional[List[int]] = None):
+        self.request = request
+        self.indexes = indexes
+        self.max_new_tokens = max_new_tokens
+        self.resources = resources  # Memory reservation and adapter reference
+        self.processor = request.constraint.processor(len(indexes)) if request.constraint is not None else None
+        # A resumed choice (always alone in its group) re-prefills the tokens it already generated
+        self.input_ids = request.input_ids
+        if resumed_tokens:
+            self.input_ids = torch.cat([self.input_ids, self.input_ids.new_tensor([resumed_tokens])], dim=1)
+            if self.processor is not None:
+                for token in resumed_tokens:
+                    self.processor.advance(0, token)
+        self.prefilled = 0
+        self.past = None  # Own cache while prefilling; afterwards it lives in the decode batch
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self.input_ids.shape[1]
+
+    @property
+    def decoding(self) -> bool:
+        return self.prefilled == self.prompt_tokens
+
+
+class _DecodeBatch:
+    """KV caches of all generating groups merged into one left-padded batch"""
+
+    def __init__(self):
+        self.groups: List[_Group] = []
+        self.past = None
+        self.logits = None  # (rows, vocab) next-token logits
+        self.attention_mask = None  # (rows, positions); zeros mark left padding
+        self.positions = None  # (rows,) position id of each row's next token
+
+    @property
+    def rows(self) -> int:
+        return sum(len(g.indexes) for g in self.groups)
+
+    def slices(self):
+        """(group, row slice) pairs in batch order"""
+        start = 0
+        for group in self.groups:
+            yield group, slice(start, start + len(group.indexes))
+            start += len(group.indexes)
+
+    def add(self, group: _Group, past, logits: torch.Tensor, attention_mask: torch.Tensor):
+        """Append a freshly prefilled group, padding whichever side is shorter"""
+        positions = attention_mask.sum(dim=1)
+        if not self.groups:
+            self.past, self.logits, self.attention_mask, self.positions = past, logits, attention_mask, positions
+        else:
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            own_pad = length - self.attention_mask.shape[1]
+            new_pad = length - attention_mask.shape[1]
+            self.past = kv_cache.cat_batch([kv_cache.pad_left(self.past, own_pad), kv_cache.pad_left(past, new_pad)])
+            self.attention_mask = torch.cat([F.pad(self.attention_mask, (own_pad, 0)),
+                                             F.pad(attention_mask, (new_pad, 0))])
+            self.logits = torch.cat([self.logits, logits])
+            self.positions = torch.cat([self.positions, positions])
+        self.groups.append(group)
+
+    def remove(self, groups: List[_Group]) -> torch.Tensor:
+        """Drop the rows of `groups`; returns the indexes of the rows that were kept"""
+        keep = [row for group, rows in self.slices() if group not in groups
+                for row in range(rows.start, rows.stop)]
+        self.groups = [g for g in self.groups if g not in groups]
+        index = torch.tensor(keep, dtype=torch.long, device=self.attention_mask.device)
+        if not self.groups:
+            self.past = self.logits = self.attention_mask = self.positions = None
+            return index
+
+        # Padding columns that no remaining row needs are trimmed away
+        mask = self.attention_mask[index]
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.past = kv_cache.select_batch(self.past, index, start)
+        self.attention_mask = mask[:, start:]
+        self.logits = self.logits[index]
+        self.positions = self.positions[index]
+        return index
+
+
+class ChunkedPrefillScheduler:
+    """Interleaves chunked prompt prefill with the decode steps of running requests"""
+
+    def __init__(self, chatbot, token_budget: int, min_prefill_chunk: int, max_sequences: int):
+        self.chatbot = chatbot
+        self.token_budget = token_budget
+        self.min_prefill_chunk = min_prefill_chunk
+        self.max_sequences = max_sequences
+
+        self._incoming: queue.Queue = queue.Queue()
+        self._waiting: Deque[ScheduledRequest] = deque()
+        self._resuming: Deque = deque()  # (request, choice index, max_new_tokens) taken out on OOM
+        self._row_limit: Optional[int] = None  # Rows that fit when memory last ran out
+        self._groups: List[_Group] = []
+        self._batch = _DecodeBatch()
+        self._stopped = False
+
+        self._stats_lock = threading.Lock()
+        self._step_ms: Deque[float] = deque(maxlen=1024)
+        self.steps = 0
+        self.prefill_tokens = 0
+        self.decode_tokens = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids: torch.Tensor, choices: List[Dict], max_new_tokens: int,
+               temperature: float, top_p: float, stop: Optional[List[str]] = None,
+               constraint=None, adapter: Optional[str] = None) -> ScheduledRequest:
+        """Queue len(choices) samples of `input_ids`; the choice dicts are filled as they decode"""
+        self.chatbot._init_choices(choices)
+        request = ScheduledRequest(input_ids, choices, max_new_tokens, temperature, top_p, stop, constraint,
+                                   adapter)
+        self._incoming.put(request)
+        return request
+
+    def stop(self):
+        """Stop the worker thread (requests still queued never finish)"""
+        self._stopped = True
+        self._incoming.put(None)
+
+    def _run(self):
+        while not self._stopped:
+            self._admit(block=not self._groups and not self._resuming)
+            for group in [g for g in self._groups if g.request.cancelled]:
+                self._release(group)
+            if not self._groups:
+                continue
+
+            start = time.perf_counter()
+            # All model work runs on this thread, so profiling captures steps (one per profiled request)
+            with torch.no_grad(), PROFILER.capture("scheduler_step"):
+                prefill_tokens, decode_tokens = self._step()
+            if DEVICE == "cuda":
+                torch.cuda.synchronize()
+            with self._stats_lock:
+                self._step_ms.append(1000 * (time.perf_counter() - start))
+                self.steps += 1
+                self.prefill_tokens += prefill_tokens
+                self.decode_tokens += decode_tokens
+
+    def _admit(self, block: bool):
+        """Move new requests into the running set while sequences and memory allow"""
+        try:
+            while True:
+                request = self._incoming.get(timeout=1.0) if block else self._incoming.get_nowait()
+                block = False
+                if request is not None:
+                    self._waiting.append(request)
+        except queue.Empty:
+            pass
+
+        # Choices taken out of the batch resume before new requests start
+        while self._resuming:
+            request, index, max_new_tokens = self._resuming[0]
+            if request.cancelled:
+                self._resuming.popleft()
+                continue
+            if not self._has_room(1):
+                return
+            self._resuming.popleft()
+            self._add_group(request, [index], max_new_tokens, resumed_tokens=request.choices[index]["tokens"])
+
+        budget = self.chatbot.memory_budget
+        while self._waiting:
+            request = self._waiting[0]
+            if request.cancelled:
+                self._waiting.popleft()
+                continue
+            n = len(request.choices)
+            if not self._has_room(n):
+                return
+            try:
+                batch_size, max_new_tokens = budget.plan(n, request.prompt_tokens, request.max_new_tokens)
+            except MemoryError as e:
+                if self._groups:
+                    return  # Wait for running requests to free their memory
+                self._waiting.popleft()
+                request.events.put(e)
+                continue
+
+            self._waiting.popleft()
+            indexes = list(range(n))
+            for i in range(0, n, batch_size):
+                if not self._add_group(request, indexes[i:i + batch_size], max_new_tokens):
+                    break
+
+    def _has_room(self, rows: int) -> bool:
+        """Whether `rows` more sequences may start (one group always may, so nothing stalls)"""
+        running = sum(len(g.indexes) for g in self._groups)
+        limit = self.max_sequences if self._row_limit is None else min(self.max_sequences, self._row_limit)
+        return not self._groups or running + rows <= limit
+
+    def _add_group(self, request: ScheduledRequest, indexes: List[int], max_new_tokens: int,
+                   resumed_tokens: Optional[List[int]] = None) -> bool:
+        """Reserve memory and the adapter for a group and start prefilling it; False if the request failed"""
+        budget = self.chatbot.memory_budget
+        resources = ExitStack()
+        try:
+            if request.adapter is not None:
+                self.chatbot.adapters.acquire(request.adapter)
+                resources.callback(self.chatbot.adapters.release, request.adapter)
+        except Exception as e:
+            self._fail(request, e)
+            return False
+        prompt_tokens = request.prompt_tokens + len(resumed_tokens or [])
+        resources.enter_context(budget.reserve(budget.estimate_bytes(len(indexes), prompt_tokens, max_new_tokens)))
+        self._groups.append(_Group(request, indexes, max_new_tokens, resources, resumed_tokens))
+        request.pending_groups += 1
+        return True
+
+    def _step(self):
+        """Decode every generating row once, then prefill with the remaining budget"""
+        budget = self.token_budget
+        decode_tokens = self._batch.rows
+        if decode_tokens:
+            try:
+                self._decode()
+            except Exception as e:
+                # The rows share one forward pass, so they fail together
+                if is_out_of_memory(e):
+                    release_cached_memory()
+                    e = MemoryError("Out of memory while generating, try again later")
+                for request in {g.request for g in self._batch.groups}:
+                    self._fail(request, e)
+        budget -= decode_tokens
+
+        # The oldest prompt always advances by at least min_prefill_chunk so it cannot starve
+        prefill_tokens = 0
+        for group in [g for g in self._groups if not g.decoding]:
+            if group.request.cancelled:  # Failed earlier in this step
+                continue
+            remaining = group.prompt_tokens - group.prefilled
+            chunk = min(remaining, max(budget, 0 if prefill_tokens else self.min_prefill_chunk))
+            if chunk <= 0:
+                break
+            try:
+                self._prefill(group, chunk)
+            except Exception as e:
+                if is_out_of_memory(e):
+                    release_cached_memory()
+                    e = MemoryError("Out of memory while generating, try again later")
+                self._fail(group.request, e)
+            prefill_tokens += chunk
+            budget -= chunk
+        return prefill_tokens, decode_tokens
+
+    def _prefill(self, group: _Group, chunk: int):
+        """Feed the next `chunk` prompt tokens; the last chunk forks the cache into the decode batch"""
+        request = group.request
+        input_ids = group.input_ids[:, group.prefilled:group.prefilled + chunk]
+        attention_mask = torch.ones((1, group.prefilled + chunk), dtype=torch.long, device=input_ids.device)
+        with self.chatbot._use_adapters([request.adapter]), record_function("scheduler.prefill_chunk"):
+            logits, past = self.chatbot._forward(input_ids, attention_mask, group.past)
+        group.past = past
+        group.prefilled += chunk
+
+        if group.decoding:
+            n = len(group.indexes)
+            self._batch.add(group, kv_cache.repeat_batch(past, n), logits.repeat(n, 1), attention_mask.repeat(n, 1))
+            group.past = None
+
+    def _decode(self):
+        """Sample one token for every row of the batch and run them through the model together"""
+        batch = self._batch
+        with record_function("chatbot.sample"):
+            next_tokens = []
+            for group, rows in batch.slices():
+                request = group.request
+                logits = batch.logits[rows]
+                if group.processor is not None:
+                    logits = group.processor.apply(logits)
+                next_tokens.append(sampling.sample_next_tokens(logits, request.temperature, request.top_p,
+                                                               do_sample=DO_SAMPLE))
+            next_tokens = torch.cat(next_tokens)
+
+        finished_rows = []
+        finished_groups = []
+        for group, rows in batch.slices():
+            request = group.request
+            for event in self.chatbot._accept_tokens(request.choices, group.indexes, next_tokens[rows],
+                                                     group.max_new_tokens, request.stop, group.processor):
+                request.events.put(event)
+            finished = [request.choices[i]["finish_reason"] is not None for i in group.indexes]
+            finished_rows += finished
+            if all(finished):
+                finished_groups.append(group)
+
+        # Finished rows of running groups keep decoding EOS so every group stays rectangular
+        next_tokens = next_tokens.masked_fill(torch.tensor(finished_rows, device=next_tokens.device),
+                                              self.chatbot.tokenizer.eos_token_id)
+        if finished_groups:
+            next_tokens = next_tokens[batch.remove(finished_groups)]
+            for group in finished_groups:
+                self._finish(group)
+        while batch.groups:
+            attention_mask = torch.cat([batch.attention_mask, batch.attention_mask.new_ones((batch.rows, 1))],
+                                       dim=1)
+            adapters = [g.request.adapter for g, rows in batch.slices() for _ in range(rows.start, rows.stop)]
+            try:
+                with self.chatbot._use_adapters(adapters), record_function("scheduler.decode"):
+                    logits, past = self.chatbot._forward(next_tokens[:, None], attention_mask, batch.past,
+                                                         position_ids=batch.positions[:, None])
+            except Exception as e:
+                if not is_out_of_memory(e):
+                    raise
+                release_cached_memory()
+                next_tokens = next_tokens[self._evict_newest()]
+                continue
+            batch.logits, batch.past, batch.attention_mask = logits, past, attention_mask
+            batch.positions = batch.positions + 1
+            return
+
+    def _evict_newest(self) -> torch.Tensor:
+        """Take the newest groups (about half the rows) out of the batch after an OOM.
+
+        Their unfinished choices are queued to resume one by one, and no more
+        rows than are left start until a group finishes. Returns the indexes
+        of the rows that stay in the batch.
+        """
+        batch = self._batch
+        if batch.rows == 1:
+            raise MemoryError("Out of memory generating a single sequence")
+        evicted = []
+        rows = 0
+        for group in reversed(batch.groups):
+            evicted.append(group)
+            rows += len(group.indexes)
+            if 2 * rows >= batch.rows:
+                break
+        print(f"Scheduler out of memory with {batch.rows} sequences, pausing {rows} of them")
+        keep = batch.remove(evicted)
+        self._row_limit = max(1, batch.rows)
+
+        for group in evicted:
+            request = group.request
+            self._release(group)
+            request.pending_groups -= 1
+            for index in group.indexes:
+                if request.choices[index]["finish_reason"] is None:
+                    self._resuming.append((request, index, group.max_new_tokens))
+                    request.pending_groups += 1
+        return keep
+
+    def _release(self, group: _Group):
+        """Drop a group's KV cache and return its memory reservation and adapter"""
+        if group in self._batch.groups:
+            self._batch.remove([group])
+        group.past = None
+        group.resources.close()
+        if group in self._groups:
+            self._groups.remove(group)
+
+    def _finish(self, group: _Group):
+        self._release(group)
+        self._row_limit = None  # Memory was freed; let the batch grow again
+        request = group.request
+        request.pending_groups -= 1
+        if request.pending_groups == 0:
+            request.events.put(_END)
+
+    def _fail(self, request: ScheduledRequest, error: Exception):
+        request.cancelled = True
+        for group in [g for g in self._groups if g.request is request]:
+            self._release(group)
+        request.events.put(error)
+
+    def get_stats(self) -> Dict[str, float]:
+        """Queue depth, running sequences and per-step latency (the inter-token latency of streams)"""
+        with self._stats_lock:
+            ordered = sorted(self._step_ms)
+            return {
+                "waiting_requests": self._incoming.qsize() + len(self._waiting),
+                "paused_sequences": len(self._resuming),
+                "running_sequences": sum(len(g.indexes) for g in self._groups),
+                "token_budget": self.token_budget,
+                "steps": self.steps,
+                "prefill_tokens": self.prefill_tokens,
+                "decode_tokens": self.decode_tokens,
+                "step_ms_p50": round(ordered[len(ordered) // 2], 2) if ordered else 0.0,
+                "step_ms_p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2) if ordered else 0.0,
+            }
@@ -0,0 +1,167 @@
+"""
+Semantic response cache - returns stored replies for near-duplicate questions
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """In-memory vector index of (message embedding -> reply) pairs.
+
+    Embeddings are L2-normalized and stored as rows of a float32 matrix, so a
+    lookup is a single matrix-vector (or matrix-matrix for batches) dot product.
+    When a path is given, the matrix lives in a memory-mapped .npy file and the
+    messages/replies in a JSON sidecar, so the cache survives restarts.
+    """
+
+    def __init__(self, dim: int, threshold: float = 0.95, max_entries: int = 1024,
+                 path: Optional[str] = None, models: Optional[Dict[str, str]] = None):
+        """Create (or reopen) a cache for embeddings of size `dim`.
+
+        `models` names what produced the entries (e.g. the embedding and chat
+        models); a saved cache written for other models is discarded.
+        """
+        self.dim = dim
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.models = models or {}
+        self._lock = threading.Lock()
+
+        self.messages: List[str] = []
+        self.responses: List[str] = []
+        self._next = 0  # Ring-buffer slot for the next insert
+
+        self.hits = 0
+        self.misses = 0
+        self._lookup_seconds = 0.0
+        self._lookups = 0
+
+        if path:
+            self._open_persistent(path)
+        else:
+            self.matrix = np.zeros((max_entries, dim), dtype=np.float32)
+
+    def _open_persistent(self, path: str):
+        """Open the memory-mapped matrix and metadata, recreating them on mismatch"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        matrix_path = path + ".npy"
+        meta_path = path + ".json"
+        shape = (self.max_entries, self.dim)
+
+        if os.path.exists(matrix_path) and os.path.exists(meta_path):
+            try:
+                matrix = np.lib.format.open_memmap(matrix_path, mode="r+")
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("models", {}) != self.models:
+                    print("Warning: semantic cache on disk was built with other models, recreating it")
+                elif matrix.shape == shape and matrix.dtype == np.float32:
+                    self.matrix = matrix
+                    self.messages = meta.get("messages", [])
+                    self.responses = meta.get("responses", [])
+                    self._next = meta.get("next", len(self.messages)) % self.max_entries
+                    print(f"Semantic cache loaded {len(self.messages)} entries from {path}")
+                    return
+                else:
+                    print("Warning: semantic cache on disk has a different shape, recreating it")
+            except (OSError, ValueError) as e:
+                print(f"Warning: could not open semantic cache at {path}: {e}")
+
+        self.matrix = np.lib.format.open_memmap(matrix_path, mode="w+", dtype=np.float32, shape=shape)
+        self._save_metadata()  # Record the models right away, even before the first entry
+
+    def _save_metadata(self):
+        """Flush the matrix and write the messages/replies sidecar"""
+        if not self.path:
+            return
+        self.matrix.flush()
+        tmp_path = self.path + ".json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "messages": self.messages,
+                "responses": self.responses,
+                "next": self._next,
+                "models": self.models,
+            }, f)
+        os.replace(tmp_path, self.path + ".json")
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """L2-normalize rows so dot products are cosine similarities"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings[None, :]
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def lookup_batch(self, embeddings: np.ndarray) -> List[Optional[Tuple[str, float]]]:
+        """Find the best cached reply for each embedding row.
+
+        Returns one (response, similarity) tuple per row, or None where the
+        best match is below the threshold.
+        """
+        start = time.perf_counter()
+        queries = self._normalize(embeddings)
+        with self._lock:
+            size = len(self.responses)
+            results: List[Optional[Tuple[str, float]]] = [None] * len(queries)
+            if size:
+                scores = queries @ self.matrix[:size].T  # (queries, entries)
+                best = scores.argmax(axis=1)
+                for i, j in enumerate(best):
+                    score = float(scores[i, j])
+                    if score >= self.threshold:
+                        results[i] = (self.responses[j], score)
+
+            found = sum(1 for r in results if r is not None)
+            self.hits += found
+            self.misses += len(results) - found
+            self._lookup_seconds += time.perf_counter() - start
+            self._lookups += 1
+        return results
+
+    def lookup(self, embedding: np.ndarray) -> Optional[str]:
+        """Return the cached reply for a single embedding, if similar enough"""
+        result = self.lookup_batch(embedding)[0]
+        return result[0] if result is not None else None
+
+    def add(self, message: str, embedding: np.ndarray, response: str):
+        """Store a reply, overwriting the oldest entry once the cache is full"""
+        vector = self._normalize(embedding)[0]
+        with self._lock:
+            slot = self._next
+            self.matrix[slot] = vector
+            if slot < len(self.responses):
+                self.messages[slot] = message
+                self.responses[slot] = response
+            else:
+                self.messages.append(message)
+                self.responses.append(response)
+            self._next = (slot + 1) % self.max_entries
+            self._save_metadata()
+
+    def clear(self):
+        """Remove all entries (statistics are kept)"""
+        with self._lock:
+            self.messages = []
+            self.responses = []
+            self._next = 0
+            self._save_metadata()
+
+    def get_stats(self) -> Dict[str, float]:
+        """Hit rate and lookup latency metrics"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.responses),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "avg_lookup_ms": 1000 * self._lookup_seconds / self._lookups if self._lookups else 0.0,
+            }
@@ -0,0 +1,103 @@
+"""
+Bounded-memory streaming context with attention sinks (StreamingLLM-style)
+
+The KV cache keeps the first few "sink" positions (the system prompt) plus a
+rolling window of the most recent positions; everything in between is evicted
+as the conversation grows. Positions are compressed, so after an eviction the
+cached keys of the window are re-rotated (RoPE) to their new, lower positions
+and the model keeps seeing contiguous positions that never exceed the window.
+"""
+from typing import Optional
+
+import torch
+
+import kv_cache
+
+
+def rotary_inv_freq(model) -> Optional[torch.Tensor]:
+    """Find the RoPE inverse frequencies used by the model (None if it has no rotary embedding)"""
+    for name, buffer in model.named_buffers():
+        if name.endswith("inv_freq"):
+            return buffer.detach().float()
+
+    config = model.config
+    if getattr(config, "rope_theta", None) is None:
+        return None
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    rotary_dim = int(head_dim * getattr(config, "partial_rotary_factor", 1.0))
+    return 1.0 / (config.rope_theta ** (torch.arange(0, rotary_dim, 2, dtype=torch.float32) / rotary_dim))
+
+
+def _rotate_half(x: torch.Tensor) -> torch.Tensor:
+    half = x.shape[-1] // 2
+    return torch.cat((-x[..., half:], x[..., :half]), dim=-1)
+
+
+def shift_key_positions(keys: torch.Tensor, delta: int, inv_freq: torch.Tensor) -> torch.Tensor:
+    """Re-rotate RoPE keys (batch, heads, seq, dim) as if they were `delta` positions later"""
+    rotary_dim = 2 * inv_freq.shape[0]
+    angles = delta * inv_freq.to(keys.device)
+    emb = torch.cat((angles, angles))
+    cos, sin = emb.cos(), emb.sin()
+    rotary = keys[..., :rotary_dim].float()
+    rotated = (rotary * cos + _rotate_half(rotary) * sin).to(keys.dtype)
+    return torch.cat((rotated, keys[..., rotary_dim:]), dim=-1)
+
+
+class SinkKVCache:
+    """A model KV cache holding sink positions plus a rolling window of recent positions.
+
+    Eviction happens in chunks of `evict_chunk` positions so the re-rotation
+    cost is amortized; the cache never holds more than
+    num_sink_tokens + window_tokens + evict_chunk positions.
+    """
+
+    def __init__(self, num_sink_tokens: int, window_tokens: int, inv_freq: Optional[torch.Tensor],
+                 evict_chunk: int = 64):
+        self.num_sink_tokens = num_sink_tokens
+        self.window_tokens = window_tokens
+        self.evict_chunk = evict_chunk
+        self.inv_freq = inv_freq
+        self.past = None
+        self.evicted_tokens = 0
+        self.seen_tokens = 0
+
+    @property
+    def length(self) -> int:
+        """Positions currently cached"""
+        return kv_cache.cache_length(self.past)
+
+    def update(self, past, new_tokens: int):
+        """Store the cache returned by the model after feeding `new_tokens` tokens"""
+        self.past = past
+        self.seen_tokens += new_tokens
+        if self.length >= self.num_sink_tokens + self.window_tokens + self.evict_chunk:
+            self._evict()
+
+    def _evict(self):
+        """Drop the positions between the sinks and the window"""
+        length = self.length
+        drop = length - self.num_sink_tokens - self.window_tokens
+        sink = self.num_sink_tokens
+        layers = []
+        for key, value in kv_cache.to_legacy(self.past):
+            window_keys = key[:, :, sink + drop:, :]
+            if self.inv_freq is not None:
+                window_keys = shift_key_positions(window_keys, -drop, self.inv_freq)
+            layers.append((
+                torch.cat((key[:, :, :sink, :], window_keys), dim=2),
+                torch.cat((value[:, :, :sink, :], value[:, :, sink + drop:, :]), dim=2),
+            ))
+        self.past = kv_cache.from_legacy(layers)
+        self.evicted_tokens += drop
+
+    def attention_mask(self, new_tokens: int, device) -> torch.Tensor:
+        """All-ones mask covering the cached positions plus `new_tokens`"""
+        return torch.ones((1, self.length + new_tokens), dtype=torch.long, device=device)
+
+    def nbytes(self) -> int:
+        """Memory held by the cached keys and values"""
+        if self.past is None:
+            return 0
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size()
+                   for k, v in kv_cache.to_legacy(self.past))
@@ -0,0 +1,119 @@
+"""download_model against a local stand-in for the Hub's HTTP endpoints"""
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_model
+
+MODEL = "org/tiny-model"
+
+
+class FakeHub(BaseHTTPRequestHandler):
+    """Serves the revision listing and ranged file downloads for one model"""
+
+    files = {}  # name -> bytes
+    lfs = set()  # Names listed as LFS files (SHA256) rather than git blobs
+    redirect_to = None  # "host:port" that /resolve/ requests are redirected to
+    requests = []  # (path, headers) of every request
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        FakeHub.requests.append((self.path, dict(self.headers)))
+        if self.path.startswith(f"/api/models/{MODEL}/revision/"):
+            return self._send(200, json.dumps({"siblings": [self._sibling(n) for n in self.files]}).encode())
+        prefix = f"/{MODEL}/resolve/main/"
+        if self.path.startswith(prefix):
+            if self.redirect_to and self.headers["Host"] != self.redirect_to:
+                self.send_response(302)
+                self.send_header("Location", f"http://{self.redirect_to}{self.path}")
+                self.end_headers()
+                return
+            data = self.files[self.path[len(prefix):]]
+            if self.headers["Range"]:
+                start, end = (int(x) for x in self.headers["Range"].split("=")[1].split("-"))
+                return self._send(206, data[start:end + 1])
+            return self._send(200, data)
+        self._send(404, b"")
+
+    def _sibling(self, name):
+        data = self.files[name]
+        if name in self.lfs:
+            return {"rfilename": name, "lfs": {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}}
+        blob_id = hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+        return {"rfilename": name, "size": len(data), "blobId": blob_id}
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    monkeypatch.setattr(download_model.time, "sleep", lambda seconds: None)
+    FakeHub.files = {
+        "config.json": b'{"model_type": "llama"}',
+        "model.safetensors": os.urandom(2 * 1024 * 1024 + 123),  # Three 1 MB parts
+    }
+    FakeHub.lfs = {"model.safetensors"}
+    FakeHub.redirect_to = None
+    FakeHub.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeHub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _download(server, path):
+    download_model.download_model(MODEL, str(path), workers=4, chunk_size_mb=1,
+                                  endpoint=f"http://127.0.0.1:{server.server_port}")
+
+
+def test_downloads_and_verifies_every_file(hub, tmp_path):
+    _download(hub, tmp_path)
+    for name, data in FakeHub.files.items():
+        assert (tmp_path / name).read_bytes() == data
+    assert not list(tmp_path.glob("*.part*"))
+    ranges = [h["Range"] for p, h in FakeHub.requests if p.endswith("model.safetensors")]
+    assert len(ranges) == 3
+
+
+def test_existing_file_with_wrong_content_is_downloaded_again(hub, tmp_path):
+    data = FakeHub.files["model.safetensors"]
+    (tmp_path / "model.safetensors").write_bytes(b"\0" * len(data))
+    _download(hub, tmp_path)
+    assert (tmp_path / "model.safetensors").read_bytes() == data
+
+    # Verified files are recorded, so the next run neither hashes nor fetches them
+    FakeHub.requests = []
+    _download(hub, tmp_path)
+    assert [p for p, _ in FakeHub.requests if "/resolve/" in p] == []
+
+
+def test_checksum_mismatch_fails(hub, tmp_path, monkeypatch):
+    real_sibling = FakeHub._sibling
+    monkeypatch.setattr(FakeHub, "_sibling", lambda self, name: {**real_sibling(self, name), "blobId": "0" * 40})
+    with pytest.raises(SystemExit):
+        _download(hub, tmp_path)
+    assert not (tmp_path / "config.json").exists()
+
+
+def test_token_is_not_sent_to_another_host(hub, tmp_path, monkeypatch):
+    monkeypatch.setenv("HF_TOKEN", "secret")
+    FakeHub.redirect_to = f"localhost:{hub.server_port}"
+    _download(hub, tmp_path)
+    assert (tmp_path / "model.safetensors").read_bytes() == FakeHub.files["model.safetensors"]
+    assert any(headers["Host"] == FakeHub.redirect_to for _, headers in FakeHub.requests)
+    for _, headers in FakeHub.requests:
+        if headers["Host"] == FakeHub.redirect_to:
+            assert "Authorization" not in headers
+        else:
+            assert headers["Authorization"] == "Bearer secret"
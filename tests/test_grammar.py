@@ -0,0 +1,48 @@
+"""Regression tests for the regex subset used by grammar-constrained decoding"""
+import pytest
+
+pytest.importorskip("torch")
+
+from grammar import _STRING, RegexDFA, schema_to_regex  # noqa: E402
+
+
+def _matches(dfa: RegexDFA, text: str) -> bool:
+    state = dfa.walk(dfa.initial, text)
+    return state is not None and dfa.is_accepting(state)
+
+
+def test_escaped_range_in_character_class():
+    dfa = RegexDFA(r"[\x00-\x1f]")
+    assert _matches(dfa, "\x05")
+    assert not _matches(dfa, "-")
+
+
+@pytest.mark.parametrize("pattern", [_STRING, schema_to_regex({"type": "string", "maxLength": 20})])
+def test_json_string_allows_hyphen_and_rejects_control_characters(pattern):
+    dfa = RegexDFA(pattern)
+    assert _matches(dfa, '"2024-01-02"')
+    assert _matches(dfa, '"a\\nb"')  # Escaped newline
+    assert not _matches(dfa, '"a\nb"')  # Raw newline
+    assert not _matches(dfa, '"a\x05b"')
+
+
+@pytest.mark.parametrize("pattern", [r"\u12", "a{3,1}", "a{x}", "[z-a]", "a{200000}", "(a{1000}){1000}", "(" * 5000])
+def test_invalid_or_oversized_regex_raises_value_error(pattern):
+    with pytest.raises(ValueError):
+        RegexDFA(pattern)
+
+
+@pytest.mark.parametrize("schema", [
+    {"type": "array", "items": [{"type": "string"}]},
+    {"type": "object", "properties": {"a": {"type": "string", "maxLength": "10"}}},
+    {"type": "object", "properties": ["a"]},
+    [{"type": "string"}],
+])
+def test_unsupported_schema_raises_value_error(schema):
+    with pytest.raises(ValueError):
+        schema_to_regex(schema)
+
+
+def test_true_sub_schema_accepts_any_value():
+    dfa = RegexDFA(schema_to_regex({"type": "object", "properties": {"a": True}}))
+    assert _matches(dfa, '{"a": [1, "x"]}')
@@ -1,19 +1,36 @@
 """
 Web server for the chatbot - Access from your local machine
 """
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, Response, render_template_string, request, jsonify, stream_with_context
 from flask_cors import CORS
 from chatbot import ChatBot
+from config import MODEL_NAME, MAX_COMPLETION_CHOICES, ADMIN_TOKEN, PROFILE_MAX_SECONDS
+from memory import PeakMemoryMonitor, release_cached_memory
+from profiling import PROFILER
+from contextlib import contextmanager, nullcontext
 import threading
+import gc
+import hmac
+import json
+import time
+import uuid
 import os
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for API access
 
-# Global chatbot instance (loaded once)
+# Global chatbot instance (loaded once, swapped atomically by /admin/reload)
 chatbot = None
 chatbot_lock = threading.Lock()
 
+# Requests pin the instance they started on so a reload can wait for them
+inflight_counts = {}  # id(chatbot) -> number of requests using it
+inflight_cond = threading.Condition()
+
+# Status of the most recent hot reload
+reload_state = {'status': 'idle'}
+reload_lock = threading.Lock()
+
 def init_chatbot():
     """Initialize chatbot in a separate thread"""
     global chatbot
@@ -21,9 +38,104 @@ def init_chatbot():
     chatbot = ChatBot()
     print("Chatbot ready!")
 
-# Initialize chatbot in background
-init_thread = threading.Thread(target=init_chatbot, daemon=True)
-init_thread.start()
+def pin_chatbot():
+    """Get the current chatbot and mark it in use (None while initializing)"""
+    with inflight_cond:
+        bot = chatbot
+        if bot is not None:
+            inflight_counts[id(bot)] = inflight_counts.get(id(bot), 0) + 1
+        return bot
+
+def unpin_chatbot(bot):
+    """Release a chatbot obtained from pin_chatbot"""
+    if bot is None:
+        return
+    with inflight_cond:
+        inflight_counts[id(bot)] -= 1
+        if inflight_counts[id(bot)] == 0:
+            del inflight_counts[id(bot)]
+            inflight_cond.notify_all()
+
+@contextmanager
+def active_chatbot():
+    """Pin the current chatbot for the duration of a request"""
+    bot = pin_chatbot()
+    try:
+        yield bot
+    finally:
+        unpin_chatbot(bot)
+
+@contextmanager
+def locked_chatbot():
+    """Hold chatbot_lock and pin the chatbot that is current under it.
+    
+    For routes that read or change the conversation: a reload swaps bots (and
+    copies the history) under the same lock, so the bot yielded here is never
+    one that has already been replaced.
+    """
+    with chatbot_lock, active_chatbot() as bot:
+        yield bot
+
+def generation_lock(bot):
+    """Lock held while generating; none if the bot's scheduler or pipeline stages interleave requests"""
+    if bot is not None and (bot.scheduler is not None or bot.pipeline is not None or bot.parallel is not None):
+        return nullcontext()
+    return chatbot_lock
+
+def reload_chatbot(options):
+    """Load a new chatbot, warm it up, swap it in and free the old one"""
+    global chatbot
+    start = time.time()
+    monitor = PeakMemoryMonitor().start()
+    try:
+        print(f"Hot reload: loading new chatbot with {options}...")
+        new_bot = ChatBot(**options)
+        new_bot.warmup()
+        load_seconds = time.time() - start
+        
+        # Swap while no request holds the model; the conversation carries over
+        with chatbot_lock, inflight_cond:
+            old_bot = chatbot
+            if old_bot is not None:
+                new_bot.conversation_history = old_bot.get_history()
+                try:
+                    new_bot.set_adapter(old_bot.adapter)
+                except ValueError:
+                    print(f"Hot reload: adapter '{old_bot.adapter}' is not available, using the base model")
+            chatbot = new_bot
+        print("Hot reload: new chatbot is serving requests")
+        
+        # Requests that pinned the old instance finish on it before it is freed
+        if old_bot is not None:
+            with inflight_cond:
+                inflight_cond.wait_for(lambda: id(old_bot) not in inflight_counts)
+            old_bot.close()
+            del old_bot
+            gc.collect()
+            release_cached_memory()
+        
+        with reload_lock:
+            reload_state.update({
+                'status': 'succeeded',
+                'load_seconds': round(load_seconds, 2),
+                'duration_seconds': round(time.time() - start, 2),
+                **monitor.stop(),
+            })
+        print(f"Hot reload finished in {time.time() - start:.1f}s")
+    except Exception as e:
+        with reload_lock:
+            reload_state.update({
+                'status': 'failed',
+                'error': str(e),
+                'duration_seconds': round(time.time() - start, 2),
+                **monitor.stop(),
+            })
+        print(f"Hot reload failed, keeping the current chatbot: {e}")
+
+# Initialize chatbot in background (pipeline stage processes re-import this script as __mp_main__)
+if __name__ != '__mp_main__':
+    init_thread = threading.Thread(target=init_chatbot, daemon=True)
+    init_thread.start()
 
 # HTML template for the web interface
 HTML_TEMPLATE = """
@@ -333,38 +445,78 @@ def index():
 @app.route('/api/status')
 def status():
     """Check if chatbot is ready"""
-    return jsonify({
-        'ready': chatbot is not None
-    })
+    with active_chatbot() as bot:
+        result = {
+            'ready': bot is not None,
+            'reloading': reload_state['status'] == 'loading'
+        }
+        if bot is not None:
+            result['memory'] = bot.get_memory_status()
+            pipeline_stats = bot.get_pipeline_stats()
+            if pipeline_stats is not None:
+                result['pipeline'] = pipeline_stats
+            scheduler_stats = bot.get_scheduler_stats()
+            if scheduler_stats is not None:
+                result['scheduler'] = scheduler_stats
+            parallel_stats = bot.get_parallel_stats()
+            if parallel_stats is not None:
+                result['pipeline_parallel'] = parallel_stats
+            streaming_stats = bot.get_streaming_stats()
+            if streaming_stats is not None:
+                result['streaming_context'] = streaming_stats
+            adapter_stats = bot.get_adapter_stats()
+            if adapter_stats is not None:
+                result['adapters'] = adapter_stats
+            cache_stats = bot.get_cache_stats()
+            if cache_stats is not None:
+                result['semantic_cache'] = cache_stats
+    return jsonify(result)
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """Handle chat requests"""
-    if chatbot is None:
-        return jsonify({'error': 'Chatbot is still initializing. Please wait...'}), 503
-    
-    data = request.get_json()
-    message = data.get('message', '').strip()
-    
-    if not message:
-        return jsonify({'error': 'Message is required'}), 400
+    with active_chatbot() as bot:
+        if bot is None:
+            return jsonify({'error': 'Chatbot is still initializing. Please wait...'}), 503
+        
+        data = request.get_json()
+        message = data.get('message', '').strip()
+        
+        if not message:
+            return jsonify({'error': 'Message is required'}), 400
+        
+        json_schema = data.get('json_schema')
+        regex = data.get('regex')
+        if json_schema is not None and not isinstance(json_schema, dict):
+            return jsonify({'error': 'json_schema must be an object'}), 400
+        if regex is not None and not isinstance(regex, str):
+            return jsonify({'error': 'regex must be a string'}), 400
+        adapter = data.get('adapter')
+        try:
+            # Validate without the lock; compiling a constraint can take a moment
+            bot.check_adapter(adapter)
+            bot.get_constraint(json_schema, regex)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     
     try:
-        with chatbot_lock:
-            response = chatbot.chat(message)
+        # A reload may have swapped bots while we waited for the lock
+        with locked_chatbot() as bot:
+            response = bot.chat(message, json_schema=json_schema, regex=regex, adapter=adapter)
         return jsonify({'response': response})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/clear', methods=['POST'])
 def clear():
     """Clear conversation history"""
-    if chatbot is None:
-        return jsonify({'error': 'Chatbot is not ready'}), 503
-    
     try:
-        with chatbot_lock:
-            chatbot.clear_history()
+        with locked_chatbot() as bot:
+            if bot is None:
+                return jsonify({'error': 'Chatbot is not ready'}), 503
+            bot.clear_history()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -372,16 +524,306 @@ def clear():
 @app.route('/api/history', methods=['GET'])
 def history():
     """Get conversation history"""
-    if chatbot is None:
-        return jsonify({'error': 'Chatbot is not ready'}), 503
-    
     try:
-        with chatbot_lock:
-            history = chatbot.get_history()
+        with locked_chatbot() as bot:
+            if bot is None:
+                return jsonify({'error': 'Chatbot is not ready'}), 503
+            history = bot.get_history()
         return jsonify({'history': history})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/adapter', methods=['GET'])
+def get_adapter():
+    """Get the conversation's LoRA adapter and the available ones"""
+    with active_chatbot() as bot:
+        if bot is None:
+            return jsonify({'error': 'Chatbot is not ready'}), 503
+        return jsonify({
+            'adapter': bot.adapter,
+            'available': bot.adapters.names() if bot.adapters is not None else [],
+        })
+
+@app.route('/api/adapter', methods=['POST'])
+def set_adapter():
+    """Select the LoRA adapter for the conversation ({"adapter": "name"}, null for the base model)"""
+    data = request.get_json(silent=True) or {}
+    with locked_chatbot() as bot:
+        if bot is None:
+            return jsonify({'error': 'Chatbot is not ready'}), 503
+        try:
+            bot.set_adapter(data.get('adapter'))
+            return jsonify({'adapter': bot.adapter})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+def parse_response_format(response_format):
+    """Map an OpenAI response_format to (json_schema, regex, error).
+    
+    Supports {"type": "json_object"}, {"type": "json_schema", "json_schema": {"schema": {...}}}
+    and the extension {"type": "regex", "regex": "..."}.
+    """
+    if response_format is None:
+        return None, None, None
+    if not isinstance(response_format, dict):
+        return None, None, 'response_format must be an object'
+    kind = response_format.get('type', 'text')
+    if kind == 'text':
+        return None, None, None
+    if kind == 'json_object':
+        return {'type': 'object'}, None, None
+    if kind == 'json_schema':
+        schema = (response_format.get('json_schema') or {}).get('schema')
+        if not isinstance(schema, dict):
+            return None, None, 'response_format.json_schema.schema must be an object'
+        return schema, None, None
+    if kind == 'regex':
+        if not isinstance(response_format.get('regex'), str):
+            return None, None, 'response_format.regex must be a string'
+        return None, response_format['regex'], None
+    return None, None, f'Unsupported response_format type: {kind}'
+
+def parse_completion_request(data):
+    """Validate an OpenAI-style chat completion request, returning (params, error)"""
+    messages = data.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return None, 'messages must be a non-empty list'
+    for msg in messages:
+        if not isinstance(msg, dict) or msg.get('role') not in ('system', 'user', 'assistant') \
+                or not isinstance(msg.get('content'), str):
+            return None, 'each message needs a role (system/user/assistant) and string content'
+    
+    n = data.get('n', 1)
+    if not isinstance(n, int) or not 1 <= n <= MAX_COMPLETION_CHOICES:
+        return None, f'n must be an integer between 1 and {MAX_COMPLETION_CHOICES}'
+    
+    max_tokens = data.get('max_tokens')
+    if max_tokens is not None and (not isinstance(max_tokens, int) or max_tokens < 1):
+        return None, 'max_tokens must be a positive integer'
+    
+    temperature = data.get('temperature')
+    if temperature is not None and (not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2):
+        return None, 'temperature must be between 0 and 2'
+    
+    top_p = data.get('top_p')
+    if top_p is not None and (not isinstance(top_p, (int, float)) or not 0 < top_p <= 1):
+        return None, 'top_p must be in (0, 1]'
+    
+    stop = data.get('stop')
+    if isinstance(stop, str):
+        stop = [stop]
+    if stop is not None and (not isinstance(stop, list) or len(stop) > 4
+                             or not all(isinstance(s, str) for s in stop)):
+        return None, 'stop must be a string or a list of up to 4 strings'
+    
+    json_schema, regex, error = parse_response_format(data.get('response_format'))
+    if error:
+        return None, error
+    
+    # `model` selects a LoRA adapter; the base model's name (or nothing) means no adapter
+    model = data.get('model')
+    if model is not None and not isinstance(model, str):
+        return None, 'model must be a string'
+    
+    return {
+        'adapter': None if model in (None, MODEL_NAME) else model,
+        'messages': [{'role': m['role'], 'content': m['content']} for m in messages],
+        'json_schema': json_schema,
+        'regex': regex,
+        'n': n,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'top_p': top_p,
+        'stop': stop,
+    }, None
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    """OpenAI-compatible chat completions (n samples share one prompt prefill)"""
+    if chatbot is None:
+        return jsonify({'error': {'message': 'Chatbot is still initializing. Please wait...'}}), 503
+    
+    data = request.get_json(silent=True) or {}
+    params, error = parse_completion_request(data)
+    if error:
+        return jsonify({'error': {'message': error, 'type': 'invalid_request_error'}}), 400
+    
+    try:
+        chatbot.check_adapter(params['adapter'])
+    except ValueError:
+        return jsonify({'error': {'message': f"The model '{params['adapter']}' does not exist",
+                                  'type': 'invalid_request_error', 'code': 'model_not_found'}}), 404
+    try:
+        chatbot.get_constraint(params['json_schema'], params['regex'])
+    except ValueError as e:
+        return jsonify({'error': {'message': f'Invalid response_format: {e}', 'type': 'invalid_request_error'}}), 400
+    model_name = params['adapter'] or MODEL_NAME
+    
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    
+    if data.get('stream'):
+        include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+        
+        def chunk(choices, usage=None):
+            body = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model_name,
+                'choices': choices,
+            }
+            if usage is not None:
+                body['usage'] = usage
+            return f"data: {json.dumps(body)}\n\n"
+        
+        def generate():
+            usage = {}
+            for index in range(params['n']):
+                yield chunk([{'index': index, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+            try:
+                with active_chatbot() as bot, generation_lock(bot):
+                    for index, delta, finish_reason in bot.stream_completions(usage=usage, **params):
+                        if delta:
+                            yield chunk([{'index': index, 'delta': {'content': delta}, 'finish_reason': None}])
+                        if finish_reason is not None:
+                            yield chunk([{'index': index, 'delta': {}, 'finish_reason': finish_reason}])
+            except Exception as e:
+                yield f"data: {json.dumps({'error': {'message': str(e)}})}\n\n"
+            if include_usage:
+                yield chunk([], usage)
+            yield "data: [DONE]\n\n"
+        
+        return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    
+    try:
+        with active_chatbot() as bot, generation_lock(bot):
+            result = bot.generate_completions(**params)
+    except MemoryError as e:
+        return jsonify({'error': {'message': str(e), 'type': 'server_overloaded'}}), 503
+    except ValueError as e:
+        return jsonify({'error': {'message': f'Invalid response_format: {e}', 'type': 'invalid_request_error'}}), 400
+    except Exception as e:
+        return jsonify({'error': {'message': str(e)}}), 500
+    
+    return jsonify({
+        'id': completion_id,
+        'object': 'chat.completion',
+        'created': created,
+        'model': model_name,
+        'choices': [
+            {
+                'index': c['index'],
+                'message': {'role': 'assistant', 'content': c['text']},
+                'finish_reason': c['finish_reason'],
+            }
+            for c in result['choices']
+        ],
+        'usage': result['usage'],
+    })
+
+@app.route('/v1/models', methods=['GET'])
+def list_models():
+    """OpenAI-compatible model list: the base model plus every LoRA adapter"""
+    with active_chatbot() as bot:
+        adapters = bot.adapters.names() if bot is not None and bot.adapters is not None else []
+    return jsonify({
+        'object': 'list',
+        'data': [{'id': name, 'object': 'model', 'owned_by': 'local'} for name in [MODEL_NAME] + adapters],
+    })
+
+def check_admin():
+    """Return an error response unless the request carries the admin token"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled (set ADMIN_TOKEN)'}), 404
+    header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(header, f'Bearer {ADMIN_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return None
+
+@app.route('/debug/profile', methods=['GET'])
+def profile_status():
+    """Get the active profiling session and the last profiling summary"""
+    denied = check_admin()
+    if denied:
+        return denied
+    return jsonify(PROFILER.status())
+
+@app.route('/debug/profile', methods=['POST'])
+def profile():
+    """Profile the next N requests and/or T seconds of generation.
+    
+    JSON body: {"requests": N, "seconds": T, "wait": true}. With wait (the
+    default) the call blocks until the session ends and returns its summary.
+    """
+    denied = check_admin()
+    if denied:
+        return denied
+    
+    data = request.get_json(silent=True) or {}
+    requests_count = data.get('requests')
+    seconds = data.get('seconds')
+    if requests_count is not None and (not isinstance(requests_count, int) or requests_count < 1):
+        return jsonify({'error': 'requests must be a positive integer'}), 400
+    if seconds is not None and (not isinstance(seconds, (int, float)) or not 0 < seconds <= PROFILE_MAX_SECONDS):
+        return jsonify({'error': f'seconds must be between 0 and {PROFILE_MAX_SECONDS}'}), 400
+    
+    try:
+        session = PROFILER.start(requests=requests_count, seconds=seconds)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    if not data.get('wait', True):
+        return jsonify({'id': session.id, 'status': 'armed'}), 202
+    
+    session.done.wait(timeout=PROFILE_MAX_SECONDS + 30)
+    if session.result is None:
+        return jsonify({'id': session.id, 'status': 'running'}), 202
+    return jsonify(session.result)
+
+@app.route('/admin/reload', methods=['GET'])
+def reload_status():
+    """Get the status of the last hot reload"""
+    denied = check_admin()
+    if denied:
+        return denied
+    with reload_lock:
+        return jsonify(dict(reload_state))
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_model():
+    """Load a new model in the background and swap it in without downtime.
+    
+    JSON body (all optional, defaults from config.py):
+    {"local_model_path": "...", "load_in_8bit": false, "load_in_4bit": false}
+    """
+    denied = check_admin()
+    if denied:
+        return denied
+    if chatbot is None:
+        return jsonify({'error': 'Chatbot is still initializing'}), 409
+    
+    data = request.get_json(silent=True) or {}
+    options = {}
+    if 'local_model_path' in data:
+        if data['local_model_path'] is not None and not isinstance(data['local_model_path'], str):
+            return jsonify({'error': 'local_model_path must be a string'}), 400
+        options['local_model_path'] = data['local_model_path']
+    for key in ('load_in_8bit', 'load_in_4bit'):
+        if key in data:
+            if not isinstance(data[key], bool):
+                return jsonify({'error': f'{key} must be a boolean'}), 400
+            options[key] = data[key]
+    
+    with reload_lock:
+        if reload_state['status'] == 'loading':
+            return jsonify({'error': 'A reload is already in progress'}), 409
+        reload_state.clear()
+        reload_state.update({'status': 'loading', 'options': options, 'started': time.time()})
+    
+    threading.Thread(target=reload_chatbot, args=(options,), daemon=True).start()
+    return jsonify({'status': 'loading', 'options': options}), 202
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Web server for chatbot')